@@ -14,6 +14,11 @@ from dreamcoder.utilities import eprint, timing, callCompiled, get_root_dir
 from dreamcoder.vs import induceGrammar_Beta
 
 
+# Set to True to save the messages sent to the compressors:
+# compressionMessages/<timestamp> for ocaml, jsonDebug for rust
+SAVEMESSAGES = False
+
+
 def induceGrammar(*args, **kwargs):
     if sum(not f.empty for f in args[1]) == 0:
         eprint("No nonempty frontiers, exiting grammar induction early.")
@@ -39,9 +44,11 @@ def induceGrammar(*args, **kwargs):
             g, newFrontiers = rustInduce(*args, **kwargs)
         elif backend == "vs":
             g, newFrontiers = rustInduce(*args, vs=True, **kwargs)
-        elif backend == "pypy_vs":
+        elif backend in {"pypy_vs", "pypy_vs_incremental"}:
             kwargs.pop('iteration')
             kwargs.pop('topk_use_only_likelihood')
+            # Keep the version table between the rounds that each add an invention
+            kwargs['incremental'] = backend == "pypy_vs_incremental"
             fn = '/tmp/vs.pickle'
             with open(fn, 'wb') as handle:
                 pickle.dump((args, kwargs), handle)
@@ -138,8 +145,8 @@ def ocamlInduce(g, frontiers, _=None,
                    "frontiers": [f.json()
                                  for f in frontiers]}
 
-        message = json.dumps(message)
-        if True:
+        message = json.dumps(message, separators=(',', ':'))
+        if SAVEMESSAGES:
             timestamp = datetime.datetime.now().isoformat()
             os.system("mkdir  -p compressionMessages")
             fn = "compressionMessages/%s" % timestamp
@@ -222,10 +229,11 @@ def rustInduce(g0, frontiers, _=None,
 
     eprint("running rust compressor")
 
-    messageJson = json.dumps(message)
+    messageJson = json.dumps(message, separators=(',', ':'))
 
-    with open("jsonDebug", "w") as f:
-        f.write(messageJson)
+    if SAVEMESSAGES:
+        with open("jsonDebug", "w") as f:
+            f.write(messageJson)
 
     # check which version of python we are using
     # if >=3.6 do:
@@ -56,3 +56,17 @@ f1 = Primitive("1.", treal, 1.)
 f0 = Primitive("0.", treal, 0)
 real = Primitive("REAL", treal, None)
 fpi = Primitive("pi", treal, 3.14)
+
+
+def _batchedArithmetic(operator, bound):
+    def batched(xs, ys):
+        a, b = integerColumn(xs, bound), integerColumn(ys, bound)
+        if a is not None and b is not None:
+            return operator(a, b).tolist()
+        return [operator(x, y) for x, y in zip(xs, ys)]
+    return batched
+
+
+vectorized(addition.value, 2)(_batchedArithmetic(lambda x, y: x + y, 2**62))
+vectorized(subtraction.value, 2)(_batchedArithmetic(lambda x, y: x - y, 2**62))
+vectorized(multiplication.value, 2)(_batchedArithmetic(lambda x, y: x * y, 2**31))
@@ -1,4 +1,4 @@
-from dreamcoder.program import Primitive, Program
+from dreamcoder.program import Primitive, Program, integerColumn, vectorized
 from dreamcoder.grammar import Grammar
 from dreamcoder.type import tlist, tint, tbool, arrow, t0, t1, t2
 
@@ -50,6 +50,13 @@ def _cdr(x): return x[1:]
 def _isEmpty(x): return x == []
 
 
+# Rather than the builtins, so that their batched implementations are only used for these primitives
+def _length(l): return len(l)
+
+
+def _sum(l): return sum(l)
+
+
 def _single(x): return [x]
 
 
@@ -237,6 +244,100 @@ def _match(l):
     return lambda b: lambda f: b if l == [] else f(l[0])(l[1:])
 
 
+# Batched implementations, used when evaluating a program on many examples at once
+@vectorized(_addition, 2)
+def _batchedAddition(xs, ys):
+    a, b = integerColumn(xs), integerColumn(ys)
+    if a is not None and b is not None: return (a + b).tolist()
+    return [x + y for x, y in zip(xs, ys)]
+
+
+@vectorized(_subtraction, 2)
+def _batchedSubtraction(xs, ys):
+    a, b = integerColumn(xs), integerColumn(ys)
+    if a is not None and b is not None: return (a - b).tolist()
+    return [x - y for x, y in zip(xs, ys)]
+
+
+@vectorized(_multiplication, 2)
+def _batchedMultiplication(xs, ys):
+    a, b = integerColumn(xs, 2**31), integerColumn(ys, 2**31)
+    if a is not None and b is not None: return (a * b).tolist()
+    return [x * y for x, y in zip(xs, ys)]
+
+
+@vectorized(_mod, 2)
+def _batchedMod(xs, ys):
+    a, b = integerColumn(xs), integerColumn(ys)
+    if a is not None and b is not None and b.all(): return (a % b).tolist()
+    return [x % y for x, y in zip(xs, ys)]
+
+
+@vectorized(_negate, 1)
+def _batchedNegate(xs):
+    a = integerColumn(xs)
+    if a is not None: return (-a).tolist()
+    return [-x for x in xs]
+
+
+@vectorized(_eq, 2)
+def _batchedEq(xs, ys):
+    a, b = integerColumn(xs), integerColumn(ys)
+    if a is not None and b is not None: return (a == b).tolist()
+    return [x == y for x, y in zip(xs, ys)]
+
+
+@vectorized(_gt, 2)
+def _batchedGt(xs, ys):
+    a, b = integerColumn(xs), integerColumn(ys)
+    if a is not None and b is not None: return (a > b).tolist()
+    return [x > y for x, y in zip(xs, ys)]
+
+
+@vectorized(_eq0, 1)
+def _batchedEq0(xs): return [x == 0 for x in xs]
+
+
+@vectorized(_a1, 1)
+def _batchedA1(xs): return [x + 1 for x in xs]
+
+
+@vectorized(_d1, 1)
+def _batchedD1(xs): return [x - 1 for x in xs]
+
+
+@vectorized(_length, 1)
+def _batchedLength(ls): return [len(l) for l in ls]
+
+
+@vectorized(_sum, 1)
+def _batchedSum(ls): return [sum(l) for l in ls]
+
+
+@vectorized(_car, 1)
+def _batchedCar(ls): return [l[0] for l in ls]
+
+
+@vectorized(_cdr, 1)
+def _batchedCdr(ls): return [l[1:] for l in ls]
+
+
+@vectorized(_cons, 2)
+def _batchedCons(xs, ls): return [[x] + l for x, l in zip(xs, ls)]
+
+
+@vectorized(_isEmpty, 1)
+def _batchedIsEmpty(ls): return [l == [] for l in ls]
+
+
+@vectorized(_append, 2)
+def _batchedAppend(ks, ls): return [k + l for k, l in zip(ks, ls)]
+
+
+@vectorized(_index, 2)
+def _batchedIndex(js, ls): return [l[j] for j, l in zip(js, ls)]
+
+
 def primitives():
     return [Primitive(str(j), tint, j) for j in range(6)] + [
         Primitive("empty", tlist(t0), []),
@@ -287,7 +388,7 @@ def primitives():
         # these are achievable with above primitives, but unlikely
         #Primitive("flatten", arrow(tlist(tlist(t0)), tlist(t0)), _flatten),
         # (lambda (reduce (lambda (lambda (++ $1 $0))) empty $0))
-        Primitive("sum", arrow(tlist(tint), tint), sum),
+        Primitive("sum", arrow(tlist(tint), tint), _sum),
         # (lambda (lambda (reduce (lambda (lambda (+ $0 $1))) 0 $0)))
         Primitive("reverse", arrow(tlist(t0), tlist(t0)), _reverse),
         # (lambda (reduce (lambda (lambda (++ (singleton $0) $1))) empty $0))
@@ -335,7 +436,7 @@ def bootstrapTarget():
         Primitive("range", arrow(tint, tlist(tint)), _range),
         Primitive("index", arrow(tint, tlist(t0), t0), _index),
         Primitive("fold", arrow(tlist(t0), t1, arrow(t0, t1, t1), t1), _fold),
-        Primitive("length", arrow(tlist(t0), tint), len),
+        Primitive("length", arrow(tlist(t0), tint), _length),
 
         # built-ins
         Primitive("if", arrow(tbool, t0, t0, t0), _if),
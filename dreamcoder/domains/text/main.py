@@ -67,8 +67,9 @@ except:
 
 def competeOnOneTask(checkpoint, task,
                      CPUs=8, timeout=3600, evaluationTimeout=0.0005):
-    if checkpoint.recognitionModel is not None:
-        recognizer = checkpoint.recognitionModel
+    """checkpoint: an ECResult, or an InferenceModel exported next to one"""
+    recognizer = checkpoint if hasattr(checkpoint, "enumerateFrontiers") else checkpoint.recognitionModel
+    if recognizer is not None:
         challengeFrontiers, times, bestSearchTime = \
                 recognizer.enumerateFrontiers([task], 
                                               CPUs=CPUs,
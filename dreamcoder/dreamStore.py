@@ -0,0 +1,212 @@
+"""On-disk store of dreams, so that they outlive the iteration, and the run, that made them.
+
+Dreams only depend on the generative grammar, so they are filed under a digest
+of the grammar and of the requested type, and under where they came from:
+SAMPLED dreams are drawn at random from the grammar, ENUMERATED dreams are every
+program that Helmholtz enumeration found for the request. Each bucket is a
+directory holding:
+  dreams.pickle, a log of records, each one frontier: the source of its programs
+    with their log priors, its task, and optionally the likelihood summaries of
+    its programs;
+  arrays.bin and arrays.json, the features of the tasks when they are numpy arrays
+    (e.g. images) of the same shape, one after the other; these are memory mapped
+    when the bucket is loaded rather than read into memory;
+  complete, once everything that was being added to the bucket has been
+    (see DreamBucket.markComplete).
+A bucket skips programs it already holds, and tasks whose examples (or array
+features) it already holds, i.e. observationally equivalent dreams.
+Appends take a lock on the bucket, so several processes may share a store."""
+
+import copy
+import fcntl
+import json
+import os
+import pickle
+
+from dreamcoder.evaluationCache import digest, inputKey, programKey
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.program import Program
+from dreamcoder.utilities import eprint
+
+try:
+    import numpy as np
+except:
+    eprint("WARNING: Could not import np. This is only okay when doing pypy compression.")
+
+
+SAMPLED = "sampled"
+ENUMERATED = "enumerated"
+
+
+def grammarKey(g):
+    return digest(json.dumps(g.json(), sort_keys=True).encode("utf-8")).hex()
+
+
+def requestKey(request):
+    return digest(str(request).encode("utf-8")).hex()
+
+
+class DreamStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.buckets = {}
+
+    def bucket(self, grammar, request, source=SAMPLED):
+        """The DreamBucket of the dreams of grammar for request. source: SAMPLED or ENUMERATED"""
+        path = os.path.join(self.directory, grammarKey(grammar), requestKey(request), source)
+        if path not in self.buckets:
+            self.buckets[path] = DreamBucket(path, request)
+        return self.buckets[path]
+
+
+class DreamBucket(object):
+    def __init__(self, path, request):
+        self.path = path
+        self.request = request
+        self.loaded = False
+        self.records = []
+        self.programs = set()
+        self.observations = set()
+        # Memory map of arrays.bin, opened on demand
+        self._arrays = None
+
+    def __len__(self):
+        self.load()
+        return len(self.records)
+
+    def file(self, name): return os.path.join(self.path, name)
+
+    @property
+    def complete(self): return os.path.exists(self.file("complete"))
+
+    def markComplete(self):
+        """Records that every dream meant for the bucket is in it, e.g. all of the
+        frontiers of an enumeration. A bucket that was being filled by a run that died
+        is not complete."""
+        os.makedirs(self.path, exist_ok=True)
+        open(self.file("complete"), "w").close()
+
+    def load(self):
+        """Reads the records that were appended since the bucket was created"""
+        if self.loaded: return
+        self.loaded = True
+        if not os.path.exists(self.file("dreams.pickle")): return
+        with open(self.file("dreams.pickle"), "rb") as handle:
+            while True:
+                try:
+                    record = pickle.load(handle)
+                except EOFError:
+                    break
+                except Exception:
+                    eprint("WARNING: Ignoring the end of", self.file("dreams.pickle"),
+                           "which was probably being written")
+                    break
+                if self.novel(record):
+                    self.remember(record)
+
+    def observation(self, task, features):
+        if isinstance(features, np.ndarray):
+            return digest(features.tobytes())
+        if task.examples:
+            return inputKey(task.examples)
+        return None
+
+    def novel(self, record):
+        return not any(k in self.programs for k in record["programKeys"]) and \
+            (record["observation"] is None or record["observation"] not in self.observations)
+
+    def remember(self, record):
+        self.records.append(record)
+        self.programs.update(record["programKeys"])
+        if record["observation"] is not None:
+            self.observations.add(record["observation"])
+
+    @property
+    def arrays(self):
+        if self._arrays is None or len(self._arrays) < self.arrayRows():
+            with open(self.file("arrays.json")) as handle:
+                meta = json.load(handle)
+            self._arrays = np.memmap(self.file("arrays.bin"), dtype=meta["dtype"], mode="r",
+                                     shape=(self.arrayRows(meta),) + tuple(meta["shape"]))
+        return self._arrays
+
+    def arrayRows(self, meta=None):
+        if meta is None:
+            if not os.path.exists(self.file("arrays.json")): return 0
+            with open(self.file("arrays.json")) as handle:
+                meta = json.load(handle)
+        rowSize = np.dtype(meta["dtype"]).itemsize * int(np.prod(meta["shape"]))
+        return os.path.getsize(self.file("arrays.bin")) // rowSize
+
+    def appendArray(self, array):
+        """Row of array in arrays.bin, or None if it does not have the shape of the others.
+        Must hold the lock."""
+        meta = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        if not os.path.exists(self.file("arrays.json")):
+            with open(self.file("arrays.json"), "w") as handle:
+                json.dump(meta, handle)
+            open(self.file("arrays.bin"), "wb").close()
+        with open(self.file("arrays.json")) as handle:
+            if json.load(handle) != meta: return None
+        row = self.arrayRows(meta)
+        with open(self.file("arrays.bin"), "ab") as handle:
+            handle.write(np.ascontiguousarray(array).tobytes())
+        return row
+
+    def add(self, frontier, summaries=None):
+        """Stores the frontier, less the programs already in the bucket, unless
+        nothing is left or its task is observationally equivalent to one already
+        there. summaries: (kind, the likelihood summaries of its programs), where
+        kind names the grammar that made them. Returns whether anything was stored."""
+        self.load()
+        keep = [j for j, e in enumerate(frontier.entries) if programKey(e.program) not in self.programs]
+        task = frontier.task
+        features = getattr(task, "features", None)
+        observation = self.observation(task, features)
+        if not keep or (observation is not None and observation in self.observations):
+            return False
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file("lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            row = None
+            if isinstance(features, np.ndarray):
+                row = self.appendArray(features)
+                if row is not None:
+                    task = copy.copy(task)
+                    task.features = None
+            entries = [frontier.entries[j] for j in keep]
+            record = {"programs": [(str(e.program), e.logPrior, e.logLikelihood) for e in entries],
+                      "programKeys": [programKey(e.program) for e in entries],
+                      "observation": observation,
+                      "task": task,
+                      "row": row,
+                      "summaries": None if summaries is None else
+                      (summaries[0], [summaries[1][j] for j in keep])}
+            with open(self.file("dreams.pickle"), "ab") as handle:
+                handle.write(pickle.dumps(record, protocol=4))
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.remember(record)
+        return True
+
+    def frontiers(self, kind=None):
+        """Every frontier in the bucket. With kind, the frontiers whose likelihood
+        summaries were made by that kind of grammar have those summaries in place
+        of their programs."""
+        self.load()
+        frontiers = []
+        arrays = None
+        for record in self.records:
+            task = record["task"]
+            if record["row"] is not None:
+                if arrays is None: arrays = self.arrays
+                task = copy.copy(task)
+                task.features = arrays[record["row"]]
+            if kind is not None and record["summaries"] is not None and record["summaries"][0] == kind:
+                programs = record["summaries"][1]
+            else:
+                programs = [Program.parse(source) for source, _, _ in record["programs"]]
+            frontiers.append(Frontier([FrontierEntry(program=p, logPrior=logPrior, logLikelihood=logLikelihood)
+                                       for p, (_, logPrior, logLikelihood) in zip(programs, record["programs"])],
+                                      task=task))
+        return frontiers
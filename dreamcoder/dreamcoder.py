@@ -13,6 +13,7 @@ from dreamcoder.fragmentGrammar import *
 from dreamcoder.taskBatcher import *
 from dreamcoder.primitiveGraph import graphPrimitives
 from dreamcoder.dreaming import backgroundHelmholtzEnumeration
+from dreamcoder.dreamStore import DreamStore
 
 
 class ECResult():
@@ -79,6 +80,9 @@ class ECResult():
                      "ensembleSize": "ES",
                      "recognitionTimeout": "RT",
                      "recognitionSteps": "RS",
+                     "recognitionBatchSize": "RBS",
+                     "recognitionDataParallel": "RDP",
+                     "learnSymmetryRules": "LSR",
                      "iterations": "it",
                      "maximumFrontier": "MF",
                      "pseudoCounts": "pc",
@@ -158,6 +162,8 @@ def ecIterator(grammar, tasks,
                useRecognitionModel=True,
                recognitionTimeout=None,
                recognitionSteps=None,
+               recognitionBatchSize=None,
+               recognitionDataParallel=None,
                helmholtzRatio=0.,
                featureExtractor=None,
                activation='relu',
@@ -168,6 +174,10 @@ def ecIterator(grammar, tasks,
                pseudoCounts=1.0, aic=1.0,
                structurePenalty=0.001, arity=0,
                evaluationTimeout=1.0,  # seconds
+               evaluationCache=False,
+               dreamStore=None,
+               learnSymmetryRules=False,
+               observationalEquivalence=False,
                taskBatchSize=None,
                taskReranker='default',
                CPUs=1,
@@ -233,12 +243,16 @@ def ecIterator(grammar, tasks,
             "addFullTaskMetrics",
             "featureExtractor",
             "evaluationTimeout",
+            "evaluationCache",
+            "observationalEquivalence",
+            "dreamStore",
             "testingTasks",
             "compressor",
             "custom_wake_generative"} and v is not None}
     if not useRecognitionModel:
         for k in {"helmholtzRatio", "recognitionTimeout", "biasOptimal", "mask",
-                  "contextual", "matrixRank", "reuseRecognition", "auxiliaryLoss", "ensembleSize"}:
+                  "contextual", "matrixRank", "reuseRecognition", "auxiliaryLoss", "ensembleSize",
+                  "recognitionBatchSize", "recognitionDataParallel"}:
             if k in parameters: del parameters[k]
     else: del parameters["useRecognitionModel"];
     if useRecognitionModel and not contextual:
@@ -248,6 +262,7 @@ def ecIterator(grammar, tasks,
             del parameters["mask"]
     if not mask and 'mask' in parameters: del parameters["mask"]
     if not auxiliaryLoss and 'auxiliaryLoss' in parameters: del parameters['auxiliaryLoss']
+    if not learnSymmetryRules: del parameters['learnSymmetryRules']
     if not useDSL:
         for k in {"structurePenalty", "pseudoCounts", "aic"}:
             del parameters[k]
@@ -270,12 +285,25 @@ def ecIterator(grammar, tasks,
     for k, v in parameters.items():
         eprint("\t", k, " = ", v)
     eprint("\t", "evaluationTimeout", " = ", evaluationTimeout)
+    eprint("\t", "evaluationCache", " = ", evaluationCache)
+    eprint("\t", "observationalEquivalence", " = ", observationalEquivalence)
     eprint("\t", "cuda", " = ", cuda)
     eprint()
 
     if addFullTaskMetrics:
         assert resume is not None, "--addFullTaskMetrics requires --resume"
 
+    if observationalEquivalence and solver not in {"python", "pypy"}:
+        eprint("Warning: only the python and pypy solvers prune by observational equivalence,",
+               "the %s solver will ignore it." % solver)
+
+    if evaluationCache:
+        for t in tasks + testingTasks:
+            t.cache = True
+
+    if dreamStore is not None:
+        dreamStore = DreamStore(dreamStore)
+
     def reportMemory():
         eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
     
@@ -338,6 +366,7 @@ def ecIterator(grammar, tasks,
                                                      maximumFrontier=maximumFrontier, 
                                                      CPUs=CPUs, evaluationTimeout=evaluationTimeout,
                                                      solver=solver,
+                                                     observationalEquivalence=observationalEquivalence,
                                                      **kw)
         trainFrontiers, _, trainingTimes = enumerator(tasks, enumerationTimeout=enumerationTimeout)
         testFrontiers, _, testingTimes = enumerator(testingTasks, enumerationTimeout=testingTimeout, testing=True)
@@ -366,6 +395,10 @@ def ecIterator(grammar, tasks,
         sys.exit(0)
     
     
+    # The last grammar that we learned symmetry rules for
+    symmetricGrammar = None
+    # The last recognition model that we exported an inference model of
+    exportedRecognitionModel = None
     for j in range(resume or 0, iterations):
         if storeTaskMetrics and rewriteTaskMetrics:
             eprint("Resetting task metrics for next iteration.")
@@ -373,12 +406,16 @@ def ecIterator(grammar, tasks,
 
         reportMemory()
 
+        # Compression makes new primitives, so relearn the rules whenever the grammar changes
+        if learnSymmetryRules and grammar is not symmetricGrammar:
+            grammar = symmetricGrammar = grammar.learnSymmetryRules(tasks)
+
         # Evaluate on held out tasks if we have them
         if testingTimeout > 0 and ((j % testEvery == 0) or (j == iterations - 1)):
             eprint("Evaluating on held out testing tasks for iteration: %d" % (j))
             evaluateOnTestingTasks(result, testingTasks, grammar,
                                    CPUs=CPUs, maximumFrontier=maximumFrontier,
-                                   solver=solver,
+                                   solver=solver, observationalEquivalence=observationalEquivalence,
                                    enumerationTimeout=testingTimeout, evaluationTimeout=evaluationTimeout)            
         # If we have to also enumerate Helmholtz frontiers,
         # do this extra sneaky in the background
@@ -388,7 +425,8 @@ def ecIterator(grammar, tasks,
             if useDSL or 'helmholtzFrontiers' not in locals():
                 helmholtzFrontiers = backgroundHelmholtzEnumeration(tasks, grammar, enumerationTimeout,
                                                                     evaluationTimeout=evaluationTimeout,
-                                                                    special=featureExtractor.special)
+                                                                    special=featureExtractor.special,
+                                                                    store=dreamStore)
             else:
                 print("Reusing dreams from previous iteration.")
         else:
@@ -405,6 +443,7 @@ def ecIterator(grammar, tasks,
             wake_generative = custom_wake_generative if custom_wake_generative is not None else default_wake_generative
             topDownFrontiers, times = wake_generative(grammar, wakingTaskBatch,
                                                       solver=solver,
+                                                      observationalEquivalence=observationalEquivalence,
                                                       maximumFrontier=maximumFrontier,
                                                       enumerationTimeout=enumerationTimeout,
                                                       CPUs=CPUs,
@@ -447,7 +486,10 @@ def ecIterator(grammar, tasks,
                                enumerationTimeout=enumerationTimeout,
                                helmholtzRatio=thisRatio, helmholtzFrontiers=helmholtzFrontiers(),
                                auxiliaryLoss=auxiliaryLoss, cuda=cuda, CPUs=CPUs, solver=solver,
-                               recognitionSteps=recognitionSteps, maximumFrontier=maximumFrontier)
+                               observationalEquivalence=observationalEquivalence,
+                               recognitionSteps=recognitionSteps, recognitionBatchSize=recognitionBatchSize,
+                               recognitionDataParallel=recognitionDataParallel,
+                               maximumFrontier=maximumFrontier, dreamStore=dreamStore)
 
             showHitMatrix(tasksHitTopDown, tasksHitBottomUp, wakingTaskBatch)
             
@@ -484,6 +526,14 @@ def ecIterator(grammar, tasks,
             eprint("Exported checkpoint to", path)
             if useRecognitionModel:
                 ECResult.clearRecognitionModel(path)
+                # Only a newly trained model is worth the copy and the tracing
+                if result.recognitionModel is not None and \
+                   result.recognitionModel is not exportedRecognitionModel:
+                    try:
+                        result.recognitionModel.exportInference(path[:-len(".pickle")] + "_inference=True.pickle")
+                        exportedRecognitionModel = result.recognitionModel
+                    except Exception as e:
+                        eprint("Could not export the inference model:", e)
 
             graphPrimitives(result, "%s_primitives_%d_"%(outputPrefix,j))
             
@@ -508,7 +558,8 @@ def showHitMatrix(top, bottom, tasks):
                                              len(top & bottom)))
 
 def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
-                           CPUs=None, solver=None, maximumFrontier=None, enumerationTimeout=None, evaluationTimeout=None):
+                           CPUs=None, solver=None, maximumFrontier=None, enumerationTimeout=None, evaluationTimeout=None,
+                           observationalEquivalence=False):
     if result.recognitionModel is not None:
         recognizer = result.recognitionModel
         testingFrontiers, times = \
@@ -518,6 +569,7 @@ def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
                                        maximumFrontier=maximumFrontier,
                                        enumerationTimeout=enumerationTimeout,
                                        evaluationTimeout=evaluationTimeout,
+                                       observationalEquivalence=observationalEquivalence,
                                        testing=True)
         updateTaskSummaryMetrics(result.recognitionTaskMetrics, recognizer.taskGrammarLogProductions(testingTasks), 'heldoutTaskLogProductions')
         updateTaskSummaryMetrics(result.recognitionTaskMetrics, recognizer.taskGrammarEntropies(testingTasks), 'heldoutTaskGrammarEntropies')
@@ -529,6 +581,7 @@ def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
                                                        enumerationTimeout=enumerationTimeout,
                                                        CPUs=CPUs,
                                                        evaluationTimeout=evaluationTimeout,
+                                                       observationalEquivalence=observationalEquivalence,
                                                        testing=True)
     updateTaskSummaryMetrics(result.recognitionTaskMetrics, times, 'heldoutTestingTimes')
     updateTaskSummaryMetrics(result.recognitionTaskMetrics,
@@ -548,13 +601,15 @@ def default_wake_generative(grammar, tasks,
                     enumerationTimeout=None,
                     CPUs=None,
                     solver=None,
-                    evaluationTimeout=None):
+                    evaluationTimeout=None,
+                    observationalEquivalence=False):
     topDownFrontiers, times = multicoreEnumeration(grammar, tasks, 
                                                    maximumFrontier=maximumFrontier,
                                                    enumerationTimeout=enumerationTimeout,
                                                    CPUs=CPUs,
                                                    solver=solver,
-                                                   evaluationTimeout=evaluationTimeout)
+                                                   evaluationTimeout=evaluationTimeout,
+                                                   observationalEquivalence=observationalEquivalence)
     eprint("Generative model enumeration results:")
     eprint(Frontier.describe(topDownFrontiers))
     summaryStatistics("Generative model", [t for t in times.values() if t is not None])
@@ -563,10 +618,12 @@ def default_wake_generative(grammar, tasks,
 def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFrontiers, _=None,
                       ensembleSize=1, featureExtractor=None, matrixRank=None, mask=False,
                       activation=None, contextual=True, biasOptimal=True,
-                      previousRecognitionModel=None, recognitionSteps=None,
+                      previousRecognitionModel=None, recognitionSteps=None, recognitionBatchSize=None,
+                      recognitionDataParallel=None,
                       timeout=None, enumerationTimeout=None, evaluationTimeout=None,
                       helmholtzRatio=None, helmholtzFrontiers=None, maximumFrontier=None,
-                      auxiliaryLoss=None, cuda=None, CPUs=None, solver=None):
+                      auxiliaryLoss=None, cuda=None, CPUs=None, solver=None, dreamStore=None,
+                      observationalEquivalence=False):
     eprint("Using an ensemble size of %d. Note that we will only store and test on the best recognition model." % ensembleSize)
 
     featureExtractorObjects = [featureExtractor(tasks, testingTasks=testingTasks, cuda=cuda) for i in range(ensembleSize)]
@@ -590,7 +647,10 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
                                                                          steps=recognitionSteps,
                                                                          helmholtzRatio=helmholtzRatio,
                                                                          auxLoss=auxiliaryLoss,
-                                                                         vectorized=True),
+                                                                         vectorized=True,
+                                                                         batchSize=recognitionBatchSize or 1,
+                                                                         dreamStore=dreamStore,
+                                                                         dataParallel=recognitionDataParallel or 1),
                                      recognizers,
                                      seedRandom=True)
     eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
@@ -608,7 +668,8 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
                                                       maximumFrontier=maximumFrontier,
                                                       enumerationTimeout=enumerationTimeout,
                                                       evaluationTimeout=evaluationTimeout,
-                                                      solver=solver)
+                                                      solver=solver,
+                                                      observationalEquivalence=observationalEquivalence)
         ensembleFrontiers.append(bottomupFrontiers)
         ensembleTimes.append([t for t in allRecognitionTimes.values() if t is not None])
         ensembleRecognitionTimes.append(allRecognitionTimes)
@@ -750,6 +811,15 @@ def commandlineArguments(_=None,
                         default=None,
                         help="Number of gradient steps to train the recognition model. Can be specified instead of train time.",
                         type=int)
+    parser.add_argument("--recognitionBatchSize",
+                        default=None,
+                        help="Number of frontiers in each gradient step of recognition model training. Default: 1",
+                        type=int)
+    parser.add_argument("--recognitionDataParallel",
+                        default=None,
+                        help="""Number of processes that train each recognition model together, averaging
+                        their gradients at every step. Each one takes minibatches of --recognitionBatchSize. Default: 1""",
+                        type=int)
     parser.add_argument(
         "-k",
         "--topK",
@@ -848,10 +918,11 @@ def commandlineArguments(_=None,
         "--solver",
         choices=[
             "ocaml",
+            "ocamlPool",
             "pypy",
             "python"],
         default=solver,
-        help="""Solver for enumeration.
+        help="""Solver for enumeration. ocamlPool keeps the OCaml solvers running between jobs.
                         Default: %s""" %
         solver)
     parser.add_argument(
@@ -865,7 +936,9 @@ def commandlineArguments(_=None,
     parser.add_argument(
         "--compressor",
         default=compressor,
-        choices=["pypy","rust","vs","pypy_vs","ocaml","memorize"])
+        help="""pypy_vs_incremental is pypy_vs, but keeps the version table and the beams of
+        candidate inventions from one invention to the next, at the cost of more memory.""",
+        choices=["pypy","rust","vs","pypy_vs","pypy_vs_incremental","ocaml","memorize"])
     parser.add_argument(
         "--matrixRank",
         help="Maximum rank of bigram transition matrix for contextual recognition model. Defaults to full rank.",
@@ -936,6 +1009,28 @@ def commandlineArguments(_=None,
                         action="store_true", default=False,
                         help="Add auxiliary classification loss to recognition network training",
                         dest="auxiliaryLoss")
+    parser.add_argument("--evaluationCache",
+                        help="""Cache the outputs of programs on task inputs, across tasks, iterations
+                        and (with the python solver) enumeration workers.""",
+                        default=False,
+                        action="store_true")
+    parser.add_argument("--dreamStore",
+                        help="""Directory in which to keep Helmholtz dreams, keyed by grammar and requested
+                        type, so that later iterations and runs with the same grammar reuse them.""",
+                        default=None,
+                        type=str)
+    parser.add_argument("--learnSymmetryRules",
+                        help="""Prune enumeration with symmetry rules learned by running compositions of
+                        the primitives on sampled values, on top of the hand-coded ones. Only the python
+                        and pypy solvers use them.""",
+                        default=False,
+                        action="store_true")
+    parser.add_argument("--observationalEquivalence",
+                        help="""Prune enumeration by discarding subprograms that compute the same outputs
+                        on the examples of their job as a cheaper one. Only the python and pypy solvers
+                        use it.""",
+                        default=False,
+                        action="store_true")
     parser.add_argument("--addFullTaskMetrics",
                         help="Only to be used in conjunction with --resume. Loads checkpoint, solves both testing and training tasks, stores frontiers, solve times, and task metrics, and then dies.",
                         default=False,
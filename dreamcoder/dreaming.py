@@ -1,14 +1,21 @@
+import io
 import json
 import os
 import subprocess
 
 from dreamcoder.domains.arithmetic.arithmeticPrimitives import k1, k0, addition, subtraction, multiplication
+from dreamcoder.dreamStore import ENUMERATED
 from dreamcoder.frontier import Frontier, FrontierEntry
 from dreamcoder.grammar import Grammar
 from dreamcoder.program import Program
 from dreamcoder.task import Task
 from dreamcoder.type import arrow, tint
 from dreamcoder.utilities import tuplify, timing, eprint, get_root_dir, mean
+from dreamcoder.wireFormat import decodeStream, encodeFrontiers
+
+
+# Set to True to keep the last message sent to the helmholtz binary in /tmp/hm
+SAVEMESSAGES = False
 
 
 def helmholtzEnumeration(g, request, inputs, timeout, _=None,
@@ -20,9 +27,10 @@ def helmholtzEnumeration(g, request, inputs, timeout, _=None,
                "extras": inputs}
     if evaluationTimeout: message["evaluationTimeout"] = evaluationTimeout
     if special: message["special"] = special
-    message = json.dumps(message)
-    with open('/tmp/hm', 'w') as handle:
-        handle.write(message)
+    message = json.dumps(message, separators=(',', ':'))
+    if SAVEMESSAGES:
+        with open('/tmp/hm', 'w') as handle:
+            handle.write(message)
     try:
         binary = os.path.join(get_root_dir(), 'helmholtz')
         process = subprocess.Popen(binary,
@@ -34,35 +42,58 @@ def helmholtzEnumeration(g, request, inputs, timeout, _=None,
     return response
 
 
+def helmholtzFrontiers(g, request, inputs, timeout, _=None,
+                       special=None, evaluationTimeout=None):
+    """Runs helmholtzEnumeration and decodes its response into frontiers,
+    which are returned in the wire format; their tasks are named 0, 1, ..."""
+    response = helmholtzEnumeration(g, request, inputs, timeout,
+                                    special=special, evaluationTimeout=evaluationTimeout)
+    response = json.loads(response.decode("utf-8"))
+    return encodeFrontiers(Frontier([FrontierEntry(program=Program.parse(p),
+                                                   logPrior=entry["ll"],
+                                                   logLikelihood=0.)
+                                     for p in entry["programs"]],
+                                    task=Task(str(b), request, []))
+                           for b, entry in enumerate(response))
+
+
 def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
-                                   special=None, evaluationTimeout=None):
-    from pathos.multiprocessing import Pool
+                                   special=None, evaluationTimeout=None, store=None):
+    """store: DreamStore; requests whose enumeration under g was stored there in full
+    are not enumerated again, and the dreams of the others are added to it"""
     requests = list({t.request for t in tasks})
+    stored = [r for r in requests if store is not None and store.bucket(g, r, ENUMERATED).complete]
+    requests = [r for r in requests if r not in stored]
     inputs = {r: list({tuplify(xs)
                        for t in tasks if t.request == r
                        for xs, y in t.examples})
               for r in requests}
-    workers = Pool(len(requests))
-    promises = [workers.apply_async(helmholtzEnumeration,
-                                    args=(g, r, inputs[r], float(timeout)),
-                                    kwds={'special': special,
-                                          'evaluationTimeout': evaluationTimeout})
-                for r in requests]
+    if requests:
+        from pathos.multiprocessing import Pool
+        workers = Pool(len(requests))
+        # The workers also parse the responses, which is most of the work of decoding them
+        promises = [workers.apply_async(helmholtzFrontiers,
+                                        args=(g, r, inputs[r], float(timeout)),
+                                        kwds={'special': special,
+                                              'evaluationTimeout': evaluationTimeout})
+                    for r in requests]
 
     def get():
-        results = [p.get() for p in promises]
         frontiers = []
-        with timing("(Helmholtz enumeration) Decoded json into frontiers"):
-            for request, result in zip(requests, results):
-                response = json.loads(result.decode("utf-8"))
-                for b, entry in enumerate(response):
-                    frontiers.append(Frontier([FrontierEntry(program=Program.parse(p),
-                                                             logPrior=entry["ll"],
-                                                             logLikelihood=0.)
-                                               for p in entry["programs"]],
-                                              task=Task(str(b),
-                                                        request,
-                                                        [])))
+        if stored:
+            with timing("(Helmholtz enumeration) Loaded frontiers from the dream store"):
+                for r in stored:
+                    frontiers.extend(store.bucket(g, r, ENUMERATED).frontiers())
+        if requests:
+            results = [p.get() for p in promises]
+            with timing("(Helmholtz enumeration) Decoded frontiers"):
+                for request, result in zip(requests, results):
+                    for _, name, entries in decodeStream(io.BytesIO(result)):
+                        frontiers.append(Frontier(entries, task=Task(name, request, [])))
+                        if store is not None:
+                            store.bucket(g, request, ENUMERATED).add(frontiers[-1])
+                    if store is not None:
+                        store.bucket(g, request, ENUMERATED).markComplete()
         eprint("Total number of Helmholtz frontiers:", len(frontiers))
         return frontiers
 
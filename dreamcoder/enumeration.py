@@ -1,12 +1,18 @@
 from dreamcoder.likelihoodModel import AllOrNothingLikelihoodModel
 from dreamcoder.grammar import *
 from dreamcoder.utilities import get_root_dir
+from dreamcoder.evaluationCache import EvaluationCache
+from dreamcoder.wireFormat import decodeFrontiers, encodeFrontiers
 
 import os
 import traceback
 import subprocess
 
 
+# How many MDL windows of one job multicoreEnumeration may search at the same time
+MAXIMUMOPENWINDOWS = 2
+
+
 def multicoreEnumeration(g, tasks, _=None,
                          enumerationTimeout=None,
                          solver='ocaml',
@@ -14,8 +20,14 @@ def multicoreEnumeration(g, tasks, _=None,
                          maximumFrontier=None,
                          verbose=True,
                          evaluationTimeout=None,
-                         testing=False):
+                         testing=False,
+                         observationalEquivalence=False):
     '''g: Either a Grammar, or a map from task to grammar.
+    observationalEquivalence: (python solver only) discard subprograms that
+    compute the same outputs as a cheaper one on the examples of their job.
+    Windows are then not split into shards.
+    CPUs are kept busy by splitting jobs into shards, see below; with verbose,
+    reports how busy each CPU was.
     Returns (list-of-frontiers, map-from-task-to-search-time)'''
 
     # We don't use actual threads but instead use the multiprocessing
@@ -28,15 +40,24 @@ def multicoreEnumeration(g, tasks, _=None,
     import dill
 
     solvers = {"ocaml": solveForTask_ocaml,   
+               "ocamlPool": solveForTask_ocamlPool,
                "pypy": solveForTask_pypy,   
                "python": solveForTask_python}   
-    assert solver in solvers, "You must specify a valid solver. options are ocaml, pypy, or python." 
+    assert solver in solvers, "You must specify a valid solver. options are ocaml, ocamlPool, pypy, or python." 
 
+    solverName = solver
     likelihoodModel = None
     if solver == 'pypy' or solver == 'python':
       # Use an all or nothing likelihood model.
       likelihoodModel = AllOrNothingLikelihoodModel(timeout=evaluationTimeout) 
       
+    # The OCaml solver parallelizes a window itself, but cannot split it into subtrees
+    canShard = solver not in {'ocaml', 'ocamlPool'}
+    # Shards would each prune with their own fingerprint table, and could
+    # prune each other's representatives, losing the programs of both
+    splitWindows = canShard and not observationalEquivalence
+    # Pooled solvers are separate processes already, so they are driven from threads
+    launchWorker = launchThread if solver == 'ocamlPool' else launchParallelProcess
     solver = solvers[solver]
 
     if not isinstance(g, dict):
@@ -56,12 +77,15 @@ def multicoreEnumeration(g, tasks, _=None,
             k = (task2grammar[t], t.request)
         jobs[k] = jobs.get(k, []) + [t]
 
-    disableParallelism = len(jobs) == 1
-    parallelCallback = launchParallelProcess if not disableParallelism else lambda f, * \
+    disableParallelism = len(jobs) == 1 and (CPUs == 1 or not canShard)
+    parallelCallback = launchWorker if not disableParallelism else lambda f, * \
         a, **k: f(*a, **k)
     if disableParallelism:
         eprint("Disabling parallelism on the Python side because we only have one job.")
         eprint("If you are using ocaml, there could still be parallelism.")
+    elif solverName == 'python' and any(t.cache for t in tasks):
+        # Workers are forked, and so share the evaluation cache's table
+        EvaluationCache.get().share()
 
     # Map from task to the shortest time to find a program solving it
     bestSearchTime = {t: None for t in task2grammar}
@@ -116,65 +140,116 @@ def multicoreEnumeration(g, tasks, _=None,
                 jobs[k] = v
             else:
                 del jobs[k]
+                pendingShards[k] = []
 
     # Workers put their messages in here
     q = Queue()
 
+    # Each job is searched in shards: an MDL window lowerBound <= MDL < upperBound
+    # and, if the solver can split one, (index, count) of that window's subtrees.
+    # Idle CPUs take pending shards first; when there are none, they steal work by
+    # opening the next MDL window of the job that has made the least progress.
+    # job -> [(lowerBound, upperBound, shard)]
+    pendingShards = {k: [] for k in jobs}
+    # job -> number of shards being worked on
+    runningShards = {k: 0 for k in jobs}
+    # job -> lower bounds of the windows that still have pending or running shards
+    openWindows = {k: {} for k in jobs}
+
     # How many CPUs are we using?
     activeCPUs = 0
+    # CPUs that are not running anything, and how long each CPU has been busy
+    idleCPUs = list(range(CPUs))
+    busyTime = [0.] * CPUs
+    startTime = time.time()
 
-    # How many CPUs was each job allocated?
-    id2CPUs = {}
-    # What job was each ID working on?
-    id2job = {}
+    # What job, window, CPUs, start time and tasks does each ID have?
+    id2shard = {}
     nextID = 0
 
-    while True:
-        refreshJobs()
-        # Don't launch a job that we are already working on
-        # We run the stopwatch whenever the job is being worked on
-        # freeJobs are things that we are not working on but could be
-        freeJobs = [j for j in jobs if not stopwatches[j].running
-                    and stopwatches[j].elapsed < enumerationTimeout - 0.5]
-        if freeJobs and activeCPUs < CPUs:
-            # Allocate a CPU to each of the jobs that we have made the least
-            # progress on
+    def openWindow(j, allocation):
+        bi = budgetIncrement(lowerBounds[j])
+        lowerBound, upperBound = lowerBounds[j], lowerBounds[j] + bi
+        lowerBounds[j] = upperBound
+        if splitWindows:
+            shards = [(lowerBound, upperBound, (i, allocation)) for i in range(allocation)]
+        else:
+            shards = [(lowerBound, upperBound, None)]
+        pendingShards[j].extend(shards)
+        openWindows[j][lowerBound] = len(shards)
+
+    def launchShard(j, lowerBound, upperBound, shard, allocation):
+        nonlocal activeCPUs, nextID
+        g, request = j[:2]
+        thisTimeout = enumerationTimeout - stopwatches[j].elapsed
+        eprint("(python) Launching %s (%d tasks) w/ %d CPUs. %f <= MDL < %f. %sTimeout %f." %
+               (request, len(jobs[j]), allocation, lowerBound, upperBound,
+                "Shard %d/%d. " % (shard[0] + 1, shard[1]) if shard and shard[1] > 1 else "",
+                thisTimeout))
+        if runningShards[j] == 0:
+            stopwatches[j].start()
+        runningShards[j] += 1
+        cpus = [idleCPUs.pop() for _ in range(allocation)]
+        activeCPUs += allocation
+        id2shard[nextID] = (j, lowerBound, cpus, time.time(), jobs[j])
+        ID = nextID
+        nextID += 1
+        parallelCallback(wrapInThread(solverOverWire(solver)),
+                         q=q, g=g, ID=ID,
+                         elapsedTime=stopwatches[j].elapsed,
+                         CPUs=allocation,
+                         tasks=jobs[j],
+                         lowerBound=lowerBound,
+                         upperBound=upperBound,
+                         budgetIncrement=upperBound - lowerBound,
+                         timeout=thisTimeout,
+                         evaluationTimeout=evaluationTimeout,
+                         maximumFrontiers=maximumFrontiers(j),
+                         testing=testing,
+                         likelihoodModel=likelihoodModel,
+                         observationalEquivalence=observationalEquivalence,
+                         shard=shard)
+
+    def schedule():
+        # Open windows for jobs that nobody is working on, and then steal work
+        # for the remaining CPUs by opening windows ahead of time
+        for stealing in [False, True]:
+            availableCPUs = CPUs - activeCPUs - sum(len(s) for s in pendingShards.values())
+            if availableCPUs <= 0:
+                break
+            freeJobs = [j for j in jobs
+                        if stopwatches[j].elapsed < enumerationTimeout - 0.5
+                        and not pendingShards[j]
+                        and (runningShards[j] > 0) == stealing
+                        and len(openWindows[j]) < MAXIMUMOPENWINDOWS]
+            if not freeJobs:
+                continue
+            # Allocate CPUs to the jobs that we have made the least progress on
             freeJobs.sort(key=lambda j: lowerBounds[j])
-            # Launch some more jobs until all of the CPUs are being used
-            availableCPUs = CPUs - activeCPUs
             allocation = allocateCPUs(availableCPUs, freeJobs)
             for j in freeJobs:
-                if allocation[j] == 0:
-                    continue
-                g, request = j[:2]
-                bi = budgetIncrement(lowerBounds[j])
-                thisTimeout = enumerationTimeout - stopwatches[j].elapsed
-                eprint("(python) Launching %s (%d tasks) w/ %d CPUs. %f <= MDL < %f. Timeout %f." %
-                       (request, len(jobs[j]), allocation[j], lowerBounds[j], lowerBounds[j] + bi, thisTimeout))
-                stopwatches[j].start()
-                parallelCallback(wrapInThread(solver),
-                                 q=q, g=g, ID=nextID,
-                                 elapsedTime=stopwatches[j].elapsed,
-                                 CPUs=allocation[j],
-                                 tasks=jobs[j],
-                                 lowerBound=lowerBounds[j],
-                                 upperBound=lowerBounds[j] + bi,
-                                 budgetIncrement=bi,
-                                 timeout=thisTimeout,
-                                 evaluationTimeout=evaluationTimeout,
-                                 maximumFrontiers=maximumFrontiers(j),
-                                 testing=testing,
-                                 likelihoodModel=likelihoodModel)
-                id2CPUs[nextID] = allocation[j]
-                id2job[nextID] = j
-                nextID += 1
-
-                activeCPUs += allocation[j]
-                lowerBounds[j] += bi
+                if allocation[j] > 0:
+                    openWindow(j, allocation[j])
+
+        # Launch pending shards, least progress first
+        while activeCPUs < CPUs:
+            waiting = [j for j in jobs if pendingShards[j]]
+            if not waiting:
+                break
+            j = min(waiting, key=lambda j: pendingShards[j][0][0])
+            lowerBound, upperBound, shard = pendingShards[j].pop(0)
+            allocation = 1 if canShard else \
+                         max(1, min(CPUs - activeCPUs,
+                                    allocateCPUs(CPUs - activeCPUs, [j])[j]))
+            launchShard(j, lowerBound, upperBound, shard, allocation)
+
+    while True:
+        refreshJobs()
+        schedule()
 
         # If nothing is running, and we just tried to launch jobs,
         # then that means we are finished
-        if all(not s.running for s in stopwatches.values()):
+        if activeCPUs == 0:
             break
 
         # Wait to get a response
@@ -185,12 +260,23 @@ def multicoreEnumeration(g, tasks, _=None,
             eprint(message.stacktrace)
             assert False
         elif message.result == "success":
-            # Mark the CPUs is no longer being used and pause the stopwatch
-            activeCPUs -= id2CPUs[message.ID]
-            stopwatches[id2job[message.ID]].stop()
+            # Mark the CPUs as no longer being used and pause the stopwatch
+            j, lowerBound, cpus, launched, shardTasks = id2shard.pop(message.ID)
+            activeCPUs -= len(cpus)
+            for c in cpus:
+                busyTime[c] += time.time() - launched
+            idleCPUs.extend(cpus)
+            runningShards[j] -= 1
+            if runningShards[j] == 0:
+                stopwatches[j].stop()
+            openWindows[j][lowerBound] -= 1
+            if openWindows[j][lowerBound] == 0:
+                del openWindows[j][lowerBound]
 
             newFrontiers, searchTimes, pc = message.value
-            for t, f in newFrontiers.items():
+            # Both are in the order of the tasks that the shard was launched with
+            newFrontiers = decodeFrontiers(newFrontiers, shardTasks)
+            for t, f, dt in zip(shardTasks, newFrontiers, searchTimes):
                 oldBest = None if len(
                     frontiers[t]) == 0 else frontiers[t].bestPosterior
                 frontiers[t] = frontiers[t].combine(f)
@@ -199,7 +285,6 @@ def multicoreEnumeration(g, tasks, _=None,
 
                 taskToNumberOfPrograms[t] += pc
 
-                dt = searchTimes[t]
                 if dt is not None:
                     if bestSearchTime[t] is None:
                         bestSearchTime[t] = dt
@@ -218,11 +303,35 @@ def multicoreEnumeration(g, tasks, _=None,
             eprint("Unknown message result:", message.result)
             assert False
 
+    if verbose:
+        wallTime = time.time() - startTime
+        if wallTime > 0:
+            utilization = [b / wallTime for b in busyTime]
+            eprint("(python) CPU utilization during enumeration: %.1f%% (%s)" %
+                   (100. * sum(utilization) / CPUs,
+                    ", ".join("%.0f%%" % (100. * u) for u in utilization)))
+
     eprint("We enumerated this many programs, for each task:\n\t",
            list(taskToNumberOfPrograms.values()))
 
     return [frontiers[t] for t in tasks], bestSearchTime
 
+def solverOverWire(solver):
+    """Makes solver return its frontiers in the wire format, and its search times
+    as a list, both in the order of its tasks, so that workers do not send back
+    every task along with its frontier"""
+    def f(*a, tasks=None, **k):
+        frontiers, searchTimes, pc = solver(*a, tasks=tasks, **k)
+        return encodeFrontiers(frontiers[t] for t in tasks), \
+            [searchTimes[t] for t in tasks], pc
+    return f
+
+def launchThread(f, *a, **k):
+    import threading
+    thread = threading.Thread(target=f, args=a, kwargs=k, daemon=True)
+    thread.start()
+    return thread
+
 def wrapInThread(f):
     """
     Returns a function that is designed to be run in a thread/threadlike process.
@@ -248,18 +357,10 @@ def wrapInThread(f):
     return _f
 
 
-def solveForTask_ocaml(_=None,
-                       elapsedTime=0.,
-                       CPUs=1,
-                       g=None, tasks=None,
+def ocamlSolverMessage(g, tasks, CPUs=1,
                        lowerBound=None, upperBound=None, budgetIncrement=None,
-                       timeout=None,
-                       testing=None, # FIXME: unused
-                       likelihoodModel=None,
-                       evaluationTimeout=None, maximumFrontiers=None):
-
-    import json
-
+                       timeout=None, evaluationTimeout=None, maximumFrontiers=None):
+    """The request for the OCaml solver, less the grammar ("DSL")"""
     def taskMessage(t):
         m = {
             "examples": [{"inputs": list(xs), "output": y} for xs, y in t.examples],
@@ -273,8 +374,7 @@ def solveForTask_ocaml(_=None,
         return m
 
 
-    message = {"DSL": g.json(),
-               "tasks": [taskMessage(t)
+    message = {"tasks": [taskMessage(t)
                          for t in tasks],
 
                "programTimeout": evaluationTimeout,
@@ -289,29 +389,10 @@ def solveForTask_ocaml(_=None,
     if hasattr(tasks[0], 'maxParameters') and tasks[0].maxParameters is not None:
         message["maxParameters"] = tasks[0].maxParameters
 
-    message = json.dumps(message)
-    # uncomment this if you want to save the messages being sent to the solver
-    
-
-    try:
-        solver_file = os.path.join(get_root_dir(), 'solver')
-        process = subprocess.Popen(solver_file,
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
-        response, error = process.communicate(bytes(message, encoding="utf-8"))
-        response = json.loads(response.decode("utf-8"))
-    except OSError as exc:
-        raise exc
-
-    except:
-        print("response:", response)
-        print("error:", error)
-        with open("message", "w") as f:
-            f.write(message)
-        print("message,", message)
-        assert False, "MAX RAISE"
-
+    return message
 
+def ocamlSolverFrontiers(response, g, tasks, elapsedTime=0.):
+    """Turns the OCaml solver's response into (frontiers, searchTimes, number of programs)"""
     pc = response.get("number_enumerated",0)  # TODO
     frontiers = {}
     searchTimes = {}
@@ -339,13 +420,192 @@ def solveForTask_ocaml(_=None,
 
     return frontiers, searchTimes, pc
 
+def solveForTask_ocaml(_=None,
+                       elapsedTime=0.,
+                       CPUs=1,
+                       g=None, tasks=None,
+                       lowerBound=None, upperBound=None, budgetIncrement=None,
+                       timeout=None,
+                       testing=None, # FIXME: unused
+                       likelihoodModel=None,
+                       evaluationTimeout=None, maximumFrontiers=None,
+                       observationalEquivalence=False, # unused: the solver does its own pruning
+                       shard=None):
+    assert shard is None or shard[1] == 1, "The OCaml solver cannot search part of a window"
+
+    import json
+
+    message = ocamlSolverMessage(g, tasks, CPUs=CPUs,
+                                 lowerBound=lowerBound, upperBound=upperBound,
+                                 budgetIncrement=budgetIncrement,
+                                 timeout=timeout, evaluationTimeout=evaluationTimeout,
+                                 maximumFrontiers=maximumFrontiers)
+    message["DSL"] = g.json()
+    message = json.dumps(message, separators=(',', ':'))
+    # uncomment this if you want to save the messages being sent to the solver
+    
+
+    try:
+        solver_file = os.path.join(get_root_dir(), 'solver')
+        process = subprocess.Popen(solver_file,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        response, error = process.communicate(bytes(message, encoding="utf-8"))
+        response = json.loads(response.decode("utf-8"))
+    except OSError as exc:
+        raise exc
+
+    except:
+        print("response:", response)
+        print("error:", error)
+        with open("message", "w") as f:
+            f.write(message)
+        print("message,", message)
+        assert False, "MAX RAISE"
+
+    return ocamlSolverFrontiers(response, g, tasks, elapsedTime=elapsedTime)
+
+def solveForTask_ocamlPool(_=None,
+                           elapsedTime=0.,
+                           CPUs=1,
+                           g=None, tasks=None,
+                           lowerBound=None, upperBound=None, budgetIncrement=None,
+                           timeout=None,
+                           testing=None,
+                           likelihoodModel=None,
+                           evaluationTimeout=None, maximumFrontiers=None,
+                           observationalEquivalence=False,
+                           shard=None):
+    """Like solveForTask_ocaml, but hands the job to a long-lived solver from the SolverPool"""
+    assert shard is None or shard[1] == 1, "The OCaml solver cannot search part of a window"
+    message = ocamlSolverMessage(g, tasks, CPUs=CPUs,
+                                 lowerBound=lowerBound, upperBound=upperBound,
+                                 budgetIncrement=budgetIncrement,
+                                 timeout=timeout, evaluationTimeout=evaluationTimeout,
+                                 maximumFrontiers=maximumFrontiers)
+    response = SolverPool.get().solve(g, message)
+    return ocamlSolverFrontiers(response, g, tasks, elapsedTime=elapsedTime)
+
+
+class SolverWorkerFailure(Exception):
+    pass
+
+
+class SolverWorker(object):
+    """A long-lived `solver --server` process; see serve in solvers/solver.ml.
+    Messages both ways are a 4 byte big-endian length followed by that much JSON."""
+
+    def __init__(self):
+        self.process = subprocess.Popen([os.path.join(get_root_dir(), 'solver'), '--server'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        # IDs of the grammars and of the task examples this worker has been sent
+        self.grammars = set()
+        self.examples = set()
+
+    def request(self, message):
+        import json
+        import struct
+
+        message = json.dumps(message, separators=(',', ':')).encode("utf-8")
+        try:
+            self.process.stdin.write(struct.pack(">I", len(message)) + message)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise SolverWorkerFailure("Could not send a request to the solver: %s" % e)
+        header = self.process.stdout.read(4)
+        if len(header) < 4:
+            raise SolverWorkerFailure("Solver exited with code %s" % self.process.poll())
+        size, = struct.unpack(">I", header)
+        response = self.process.stdout.read(size)
+        if len(response) < size:
+            raise SolverWorkerFailure("Solver exited with code %s" % self.process.poll())
+        return json.loads(response.decode("utf-8"))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except Exception:
+            self.process.kill()
+
+
+def contentID(data):
+    """ID of a JSON value for the solver server: a digest of its serialization,
+    so that equal grammars (or examples) always get the same ID"""
+    import json
+    from dreamcoder.evaluationCache import digest
+    return digest(json.dumps(data, sort_keys=True, separators=(',', ':')).encode("utf-8")).hex()
+
+
+class SolverPool(object):
+    """Long-lived OCaml solvers, shared by every multicoreEnumeration of this process.
+    Grammars and task examples are named by contentID, and are sent to a worker only
+    the first time that worker sees the ID; later jobs only name them.
+    Workers are started on demand, one for each job running at the same time."""
+
+    POOL = None
+
+    @staticmethod
+    def get():
+        if SolverPool.POOL is None:
+            import atexit
+            SolverPool.POOL = SolverPool()
+            atexit.register(SolverPool.POOL.close)
+        return SolverPool.POOL
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def solve(self, g, message):
+        """Sends message (without its DSL) to an idle worker, and returns the response"""
+        DSL = g.json()
+        ID = contentID(DSL)
+        tasks = [dict(t, examplesID=contentID(t["examples"])) for t in message["tasks"]]
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            worker = SolverWorker()
+
+        message = dict(message, grammarID=ID, tasks=tasks)
+        try:
+            response = None
+            if ID in worker.grammars:
+                # Leave out everything this worker has already been sent
+                response = worker.request(dict(message, tasks=[
+                    {k: v for k, v in t.items() if k != "examples"}
+                    if t["examplesID"] in worker.examples else t
+                    for t in tasks]))
+                if response.get("error") == "unknown":
+                    response = None
+            if response is None:
+                response = worker.request(dict(message, DSL=DSL))
+            worker.grammars.add(ID)
+            worker.examples.update(t["examplesID"] for t in tasks)
+        except BaseException:
+            worker.close()
+            raise
+
+        with self.lock:
+            self.idle.append(worker)
+        return response
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.close()
+
 def solveForTask_pypy(_=None,
                       elapsedTime=0.,
                       g=None, task=None,
                       lowerBound=None, upperBound=None, budgetIncrement=None,
                       timeout=None,
                       likelihoodModel=None,
-                      evaluationTimeout=None, maximumFrontier=None, testing=False):
+                      evaluationTimeout=None, maximumFrontier=None, testing=False,
+                      observationalEquivalence=False, shard=None):
     return callCompiled(enumerateForTasks,
                         g, tasks, likelihoodModel,
                         timeout=timeout,
@@ -354,7 +614,9 @@ def solveForTask_pypy(_=None,
                         evaluationTimeout=evaluationTimeout,
                         maximumFrontiers=maximumFrontiers,
                         budgetIncrement=budgetIncrement,
-                        lowerBound=lowerBound, upperBound=upperBound)
+                        lowerBound=lowerBound, upperBound=upperBound,
+                        observationalEquivalence=observationalEquivalence,
+                        shard=shard)
 
 def solveForTask_python(_=None,
                         elapsedTime=0.,
@@ -363,7 +625,8 @@ def solveForTask_python(_=None,
                         timeout=None,
                         CPUs=1,
                         likelihoodModel=None,
-                        evaluationTimeout=None, maximumFrontiers=None, testing=False):
+                        evaluationTimeout=None, maximumFrontiers=None, testing=False,
+                        observationalEquivalence=False, shard=None):
     return enumerateForTasks(g, tasks, likelihoodModel,
                              timeout=timeout,
                              testing=testing,
@@ -371,12 +634,99 @@ def solveForTask_python(_=None,
                              evaluationTimeout=evaluationTimeout,
                              maximumFrontiers=maximumFrontiers,
                              budgetIncrement=budgetIncrement,
-                             lowerBound=lowerBound, upperBound=upperBound)
+                             lowerBound=lowerBound, upperBound=upperBound,
+                             observationalEquivalence=observationalEquivalence,
+                             shard=shard)
 
 
 class EnumerationTimeout(Exception):
     pass
 
+
+class ObservationalEquivalence(object):
+    """Prunes subprograms that are observationally equivalent to one seen before.
+    A subprogram at the top level of a job's program (a hole whose environment
+    is exactly the task's arguments, or the whole program) is fingerprinted by
+    its outputs on every example input of every task in the job. The first
+    subprogram with a fingerprint is remembered together with its description
+    length, and later, different subprograms with that fingerprint (and the
+    same grammar and type) that are no cheaper are pruned.
+    The table stops growing once it holds maximumEntries fingerprints or the
+    machine uses more than maximumMemoryPercent of its memory; entries already
+    in it keep pruning."""
+
+    def __init__(self, tasks, evaluationTimeout=None,
+                 maximumEntries=10**6, maximumMemoryPercent=90.):
+        self.request = tasks[0].request
+        self.arity = len(self.request.functionArguments())
+        self.inputs = []
+        seen = set()
+        for t in tasks:
+            for xs, _ in t.examples:
+                k = tuplify(xs)
+                if hashable(k) and k in seen:
+                    continue
+                if hashable(k):
+                    seen.add(k)
+                self.inputs.append(xs)
+        self.evaluationTimeout = evaluationTimeout
+        self.maximumEntries = maximumEntries
+        self.maximumMemoryPercent = maximumMemoryPercent
+        self.full = False
+
+        # (grammar, request, outputs) -> (description length, subprogram)
+        self.table = {}
+        self.pruned = 0
+
+    def outputs(self, environment, request, program):
+        """Outputs of program on every input, or None if they cannot be fingerprinted"""
+        if len(environment) == 0 and request == self.request:
+            f = program.evaluate([])
+            def run(xs):
+                y = f
+                for x in xs:
+                    y = y(x)
+                return y
+        elif len(environment) == self.arity and not request.isArrow():
+            run = lambda xs: program.evaluate(list(reversed(xs)))
+        else:
+            return None
+        ys = tuplify([run(xs) for xs in self.inputs])
+        if not hashable(ys):
+            return None
+        return ys
+
+    def __call__(self, grammar, environment, request, program, descriptionLength):
+        try:
+            ys = runWithTimeout(lambda: self.outputs(environment, request, program),
+                                self.evaluationTimeout)
+        except Exception:
+            return False
+        if ys is None:
+            return False
+
+        key = (id(grammar), request.canonical(), ys)
+        previous = self.table.get(key)
+        if previous is not None:
+            previousLength, previousProgram = previous
+            if previousProgram == program:
+                return False
+            if previousLength <= descriptionLength:
+                self.pruned += 1
+                return True
+            self.table[key] = (descriptionLength, program)
+            return False
+
+        if not self.full:
+            self.table[key] = (descriptionLength, program)
+            if len(self.table) >= self.maximumEntries or \
+               (len(self.table) % 4096 == 0 and getMemoryUsageFraction() > self.maximumMemoryPercent):
+                eprint("(python) Observational equivalence table is full at %d entries" %
+                       len(self.table))
+                self.full = True
+        return False
+
+
 def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                       verbose=False,
                       timeout=None,
@@ -386,7 +736,9 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                       evaluationTimeout=None,
                       lowerBound=0.,
                       upperBound=100.,
-                      budgetIncrement=1.0, maximumFrontiers=None):
+                      budgetIncrement=1.0, maximumFrontiers=None,
+                      observationalEquivalence=False,
+                      shard=None):
     assert timeout is not None, \
         "enumerateForTasks: You must provide a timeout."
 
@@ -401,6 +753,14 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
     # we will never maintain maximumFrontier best solutions
     hits = [PQ() for _ in tasks]
 
+    # Shared across the budget windows of this call (under multicoreEnumeration,
+    # that is a single window): whatever was seen in a cheaper window can
+    # prune the more expensive ones
+    assert not observationalEquivalence or shard is None or shard[1] == 1, \
+        "enumerateForTasks: observational equivalence cannot prune part of a window"
+    pruneSubprogram = ObservationalEquivalence(tasks, evaluationTimeout=evaluationTimeout) \
+                      if observationalEquivalence else None
+
     starting = time()
     previousBudget = lowerBound
     budget = lowerBound + budgetIncrement
@@ -411,10 +771,12 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                 budget <= upperBound:
             numberOfPrograms = 0
 
-            for prior, _, p in g.enumeration(Context.EMPTY, [], request,
-                                             maximumDepth=99,
-                                             upperBound=budget,
-                                             lowerBound=previousBudget):
+            for prior, _, p in g.stackEnumeration(Context.EMPTY, [], request,
+                                                  maximumDepth=99,
+                                                  upperBound=budget,
+                                                  lowerBound=previousBudget,
+                                                  pruneSubprogram=pruneSubprogram,
+                                                  shard=shard):
                 descriptionLength = -prior
                 # Shouldn't see it on this iteration
                 assert descriptionLength <= budget
@@ -424,14 +786,17 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                 numberOfPrograms += 1
                 totalNumberOfPrograms += 1
 
-                for n in range(len(tasks)):
-                    task = tasks[n]
+                if hasattr(likelihoodModel, "scoreBatch"):
+                    scores = likelihoodModel.scoreBatch(p, tasks)
+                else:
+                    scores = [likelihoodModel.score(p, task) for task in tasks]
 
+                for n in range(len(tasks)):
                     #Warning:changed to max's new likelihood model situation
                     #likelihood = task.logLikelihood(p, evaluationTimeout)
                     #if invalid(likelihood):
                         #continue
-                    success, likelihood = likelihoodModel.score(p, task)
+                    success, likelihood = scores[n]
                     if not success:
                         continue
                         
@@ -457,6 +822,9 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
     frontiers = {tasks[n]: Frontier([e for _, e in hits[n]],
                                     task=tasks[n])
                  for n in range(len(tasks))}
+    if any(t.cache for t in tasks):
+        eprint("(python) Evaluation cache:", EvaluationCache.get().statistics())
+
     searchTimes = {
         tasks[n]: None if len(hits[n]) == 0 else \
         min(t for t,_ in hits[n]) for n in range(len(tasks))}
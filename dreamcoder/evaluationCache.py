@@ -0,0 +1,158 @@
+"""Bounded cache of the outputs of programs on task inputs.
+
+Keys are 16 byte digests of a program and of the inputs it ran on, so the same
+program on the same inputs hits no matter which task asked. There are two tiers:
+  an LRU dictionary of at most EVALUATIONCACHESIZE entries, private to the process;
+  optionally (see EvaluationCache.share), a direct mapped table in shared memory,
+    used by every process forked afterwards, e.g. the enumeration workers. Each key
+    has one slot, and storing an entry overwrites whatever was in that slot.
+Slots are written without locks. Every slot carries a checksum of its contents,
+so a reader ignores a slot that another process is halfway through writing."""
+
+import hashlib
+import os
+import pickle
+import struct
+from collections import OrderedDict
+
+
+EVALUATIONCACHESIZE = 2**18
+SHAREDCACHESLOTS = 2**16
+SHAREDCACHESLOTSIZE = 128
+
+# key, checksum, length of the pickled output
+SLOTHEADER = struct.Struct("<16s8sH")
+
+
+class CacheMiss(object):
+    def __repr__(self): return "MISSING"
+
+
+MISSING = CacheMiss()
+
+
+def digest(data, size=16): return hashlib.blake2b(data, digest_size=size).digest()
+
+
+def programKey(p): return digest(str(p).encode("utf-8"))
+
+
+def inputKey(xs, salt=b""):
+    """Digest of the inputs xs, or None if they cannot be pickled.
+    salt distinguishes tasks that turn the same program and inputs into different outputs."""
+    try:
+        return digest(salt + pickle.dumps(xs, protocol=4))
+    except Exception:
+        return None
+
+
+def evaluationKey(programKey, inputKey): return digest(programKey + inputKey)
+
+
+class EvaluationCache(object):
+    CACHE = None
+
+    @staticmethod
+    def get():
+        """The cache shared by all of the tasks of this process"""
+        if EvaluationCache.CACHE is None:
+            EvaluationCache.CACHE = EvaluationCache()
+        return EvaluationCache.CACHE
+
+    def __init__(self, maximumSize=EVALUATIONCACHESIZE):
+        self.maximumSize = maximumSize
+        self.table = OrderedDict()
+        self.shared = None
+        self.owner = None
+        self.hits = 0
+        self.sharedHits = 0
+        self.misses = 0
+
+    def share(self, slots=SHAREDCACHESLOTS, slotSize=SHAREDCACHESLOTSIZE):
+        """Backs the cache with a table in shared memory. Processes forked
+        afterwards read and write the same table. Does nothing if already shared."""
+        if self.shared is not None:
+            return
+        import atexit
+        from multiprocessing import shared_memory
+        assert slotSize > SLOTHEADER.size
+        self.shared = shared_memory.SharedMemory(create=True, size=slots * slotSize)
+        self.slots = slots
+        self.slotSize = slotSize
+        self.owner = os.getpid()
+        atexit.register(self.close)
+
+    def close(self):
+        if self.shared is None:
+            return
+        shared = self.shared
+        self.shared = None
+        shared.close()
+        if os.getpid() == self.owner:
+            shared.unlink()
+
+    def clear(self):
+        self.table.clear()
+        self.hits = self.sharedHits = self.misses = 0
+
+    def statistics(self):
+        lookups = self.hits + self.sharedHits + self.misses
+        return {"hits": self.hits,
+                "sharedHits": self.sharedHits,
+                "misses": self.misses,
+                "size": len(self.table),
+                "shared": self.shared is not None,
+                "hitRate": (self.hits + self.sharedHits) / lookups if lookups else 0.}
+
+    def lookup(self, key):
+        """The output stored under key, or MISSING"""
+        value = self.table.get(key, MISSING)
+        if value is not MISSING:
+            self.hits += 1
+            self.table.move_to_end(key)
+            return value
+        if self.shared is not None:
+            value = self.sharedLookup(key)
+            if value is not MISSING:
+                self.sharedHits += 1
+                self.remember(key, value)
+                return value
+        self.misses += 1
+        return MISSING
+
+    def store(self, key, value):
+        self.remember(key, value)
+        if self.shared is not None:
+            self.sharedStore(key, value)
+
+    def remember(self, key, value):
+        self.table[key] = value
+        self.table.move_to_end(key)
+        if len(self.table) > self.maximumSize:
+            self.table.popitem(last=False)
+
+    def slot(self, key):
+        return (int.from_bytes(key[:8], "little") % self.slots) * self.slotSize
+
+    def sharedLookup(self, key):
+        offset = self.slot(key)
+        data = bytes(self.shared.buf[offset:offset + self.slotSize])
+        storedKey, checksum, length = SLOTHEADER.unpack_from(data)
+        if storedKey != key or SLOTHEADER.size + length > self.slotSize:
+            return MISSING
+        data = data[SLOTHEADER.size:SLOTHEADER.size + length]
+        if digest(key + data, 8) != checksum:
+            return MISSING
+        return pickle.loads(data)
+
+    def sharedStore(self, key, value):
+        try:
+            data = pickle.dumps(value, protocol=4)
+        except Exception:
+            # e.g. the program returned a function
+            return
+        if SLOTHEADER.size + len(data) > self.slotSize:
+            return
+        offset = self.slot(key)
+        entry = SLOTHEADER.pack(key, digest(key + data, 8), len(data)) + data
+        self.shared.buf[offset:offset + len(entry)] = entry
@@ -222,7 +222,10 @@ class FragmentGrammar(object):
                    for l, u in frontier)
 
     def insideOutside(self, frontiers, pseudoCounts):
-        uses = self.expectedUses(frontiers)
+        return self.fromUses(self.expectedUses(frontiers), pseudoCounts)
+
+    def fromUses(self, uses, pseudoCounts):
+        """The grammar with the productions of this one, weighted by the expected uses"""
         return FragmentGrammar(log(uses.actualVariables +
                                    pseudoCounts) -
                                log(max(uses.possibleVariables, 1.)), [(log(uses.actualUses.get(p, 0.) +
@@ -311,13 +314,7 @@ class FragmentGrammar(object):
         def grammarScore(g):
             g = g.makeUniform().insideOutside(restrictedFrontiers, pseudoCounts)
             likelihood = g.jointFrontiersMDL(restrictedFrontiers)
-            structure = sum(primitiveSize(p) for p in g.primitives)
-            score = likelihood - aic * len(g) - structurePenalty * structure
-            g.clearCache()
-            if invalid(score):
-                # FIXME: This should never occur but it does anyway
-                score = float('-inf')
-            return score, g
+            return FragmentScorer.penalize(g, likelihood, aic, structurePenalty)
 
         if aic is not POSITIVEINFINITY:
             restrictedFrontiers = restrictFrontiers()
@@ -325,24 +322,24 @@ class FragmentGrammar(object):
             eprint("Starting score", bestScore)
             while True:
                 restrictedFrontiers = restrictFrontiers()
+                scorer = FragmentScorer(bestGrammar, restrictedFrontiers,
+                                        pseudoCounts=pseudoCounts, aic=aic,
+                                        structurePenalty=structurePenalty)
                 fragments = [f
-                             for f in proposeFragmentsFromFrontiers(restrictedFrontiers, a, CPUs=CPUs)
+                             for f in proposeFragmentsFromFrontiers(restrictedFrontiers, a, CPUs=CPUs,
+                                                                    index=scorer.index)
                              if f not in bestGrammar.primitives
                              and defragment(f) not in bestGrammar.primitives]
                 eprint("Proposed %d fragments." % len(fragments))
 
-                candidateGrammars = [
-                    FragmentGrammar.uniform(
-                        bestGrammar.primitives +
-                        [fragment]) for fragment in fragments]
-                if not candidateGrammars:
+                if not fragments:
                     break
 
-                scoredFragments = parallelMap(CPUs, grammarScore, candidateGrammars,
+                scoredFragments = parallelMap(CPUs, scorer.score, fragments,
                                               # Each process handles up to 100
                                               # grammars at a time, a "job"
                                               chunksize=max(
-                                                  1, min(len(candidateGrammars) // CPUs, 100)),
+                                                  1, min(len(fragments) // CPUs, 100)),
                                               # maxTasks: Maximum number of jobs allocated to a process
                                               # This means that after evaluating this*chunk many grammars,
                                               # we killed the process, freeing up its memory.
@@ -370,9 +367,8 @@ class FragmentGrammar(object):
                                                concretePrimitive.tp,
                                                concretePrimitive)
                 frontiers = parallelMap(
-                    CPUs, lambda frontier: bestGrammar.rescoreFrontier(
-                        RewriteFragments.rewriteFrontier(
-                            frontier, newPrimitive)), frontiers)
+                    CPUs, bestGrammar.rescoreFrontier,
+                    RewriteFragments.rewriteFrontiers(frontiers, newPrimitive))
                 eprint(
                     "\t(<uses> in rewritten frontiers: %f)" %
                     (bestGrammar.expectedUses(frontiers).actualUses[concretePrimitive]))
@@ -428,3 +424,214 @@ class FragmentGrammar(object):
             grammar = grammar.removeProductions(uselessProductions)
 
         return grammar, frontiers
+
+
+class SiteSummary(object):
+    """What parsing programs with a FragmentGrammar of concrete productions chose:
+    how many times each production was used (Index(0) standing for the variables),
+    and how many times each set of productions was possible, for each requested type.
+    That is enough to score the programs under any weights, and also under the
+    grammar with one more fragment that cannot match them, which only joins the
+    possibles where its type fits the request."""
+
+    def __init__(self):
+        self.uses = {}
+        # (possibles, canonical request) -> count
+        self.normalizers = {}
+        self.constant = 0.
+
+    def record(self, actual, possibles, request, constant=0.):
+        self.uses[actual] = self.uses.get(actual, 0) + 1
+        key = (possibles, request)
+        self.normalizers[key] = self.normalizers.get(key, 0) + 1
+        self.constant += constant
+
+    def join(self, other, sign=1):
+        """Adds other, or takes it away with sign = -1"""
+        self.constant += sign * other.constant
+        for table, otherTable in [(self.uses, other.uses), (self.normalizers, other.normalizers)]:
+            for k, n in otherTable.items():
+                n = table.get(k, 0) + sign * n
+                if n == 0: table.pop(k, None)
+                else: table[k] = n
+
+    def logLikelihood(self, weights, fragment, fits, normalizerCache):
+        """weights: production (and Index(0)) -> log weight. The fragment is possible
+        wherever fits(request). normalizerCache is shared by summaries scored with
+        the same weights."""
+        l = self.constant + sum(n * weights[p] for p, n in self.uses.items())
+        for (possibles, request), n in self.normalizers.items():
+            key = (possibles, fits(request))
+            z = normalizerCache.get(key)
+            if z is None:
+                z = normalizerCache[key] = lse([weights[p] for p in possibles] +
+                                               ([weights[fragment]] if key[1] else []))
+            l -= n * z
+        return l
+
+    def expectedUses(self, fragment, fits, weight=1.):
+        uses = Uses(possibleVariables=0., actualVariables=weight * self.uses.get(Index(0), 0),
+                    possibleUses={},
+                    actualUses={p: weight * n for p, n in self.uses.items() if not p.isIndex})
+        for (possibles, request), n in self.normalizers.items():
+            for p in possibles:
+                if p.isIndex: uses.possibleVariables += weight * n
+                else: uses.possibleUses[p] = uses.possibleUses.get(p, 0.) + weight * n
+            if fits(request):
+                uses.possibleUses[fragment] = uses.possibleUses.get(fragment, 0.) + weight * n
+        return uses
+
+
+class FragmentScorer(object):
+    """Scores the candidate grammars of FragmentGrammar.induceFromFrontiers, the
+    productions of grammar plus one fragment, on frontiers, as grammarScore does:
+    the likelihood of the frontiers after inside-outside, less the AIC and structure
+    penalties.
+    Every entry is parsed once with grammar, into a SiteSummary. A fragment then
+    reparses only the frontiers with an entry that it might match, which index
+    looks up; the others are scored from their summaries, which for frontiers of a
+    single entry are summed up front, so that scoring a fragment costs the frontiers
+    that it touches."""
+
+    def __init__(self, grammar, frontiers, _=None, pseudoCounts=1., aic=1., structurePenalty=0.001):
+        self.grammar = FragmentGrammar.uniform(grammar.primitives)
+        self.frontiers = frontiers
+        self.pseudoCounts = pseudoCounts
+        self.aic = aic
+        self.structurePenalty = structurePenalty
+
+        # Per entry: its SiteSummary, or None when it does not parse
+        self.summaries = [[self.summarize(f.task.request, e.program) for e in f]
+                          for f in frontiers]
+        self.grammar.clearCache()
+        # The subexpressions of the entries, keyed by frontier
+        self.index = SubexpressionIndex()
+        for j, f in enumerate(frontiers):
+            for e in f:
+                self.index.add(e.program, j)
+        # The frontiers that every fragment touches, as some of their entries do not parse
+        self.unparsed = {j for j, summaries in enumerate(self.summaries) if None in summaries}
+
+        # The frontiers of one entry that parses, summed up
+        self.total = SiteSummary()
+        self.totalLogLikelihood = 0.
+        self.singles = set()
+        for j, (f, summaries) in enumerate(zip(frontiers, self.summaries)):
+            if len(summaries) == 1 and summaries[0] is not None:
+                self.singles.add(j)
+                self.total.join(summaries[0])
+                self.totalLogLikelihood += f.entries[0].logLikelihood
+
+    def summarize(self, request, program):
+        summary = SiteSummary()
+        try:
+            context = self._summarize(Context.EMPTY, [], request, program, summary)
+        except (MatchFailure, UnificationFailure):
+            return None
+        return None if context is None else summary
+
+    def _summarize(self, context, environment, request, expression, summary):
+        """Follows FragmentGrammar._logLikelihood, given that the only parse of
+        expression is by the production at its head. Returns the new context."""
+        if request.isArrow():
+            if not isinstance(expression, Abstraction): return None
+            return self._summarize(context, [request.arguments[0]] + environment,
+                                   request.arguments[1], expression.body, summary)
+
+        candidates = self.grammar.buildCandidates(context, environment, request)
+        possibles = frozenset(p if not p.isIndex else Index(0) for _, _, _, p in candidates)
+        numberOfVariables = sum(p.isIndex for _, _, _, p in candidates)
+        f, xs = expression.applicationParse()
+        for _, newContext, tp, production in candidates:
+            if production == f: break
+        else:
+            return None
+        summary.record(Index(0) if f.isIndex else f, possibles,
+                       canonicalTypes([request.apply(context)])[0],
+                       constant=-math.log(numberOfVariables) if f.isIndex else 0.)
+
+        if not production.isIndex:
+            newContext, fragmentType, _ = Matcher.match(newContext, production, f, len(xs))
+            fragmentTypeTemplate = request
+            for _ in xs:
+                newContext, newVariable = newContext.makeVariable()
+                fragmentTypeTemplate = arrow(newVariable, fragmentTypeTemplate)
+            newContext = newContext.unify(fragmentType, fragmentTypeTemplate)
+            tp = fragmentType.apply(newContext)
+        argumentTypes = tp.functionArguments()
+        if len(xs) != len(argumentTypes): return None
+        for argumentType, x in zip(argumentTypes, xs):
+            newContext = self._summarize(newContext, environment, argumentType.apply(newContext), x, summary)
+            if newContext is None: return None
+        return newContext
+
+    def touched(self, fragment):
+        """The frontiers with an entry that fragment might match, in order"""
+        return sorted(self.index.keys(fragment) | self.unparsed)
+
+    @staticmethod
+    def penalize(g, likelihood, aic, structurePenalty):
+        structure = sum(primitiveSize(p) for p in g.primitives)
+        score = likelihood - aic * len(g) - structurePenalty * structure
+        g.clearCache()
+        if invalid(score):
+            # FIXME: This should never occur but it does anyway
+            score = float('-inf')
+        return score, g
+
+    def score(self, fragment):
+        """(score, grammar) of the grammar with fragment, as grammarScore"""
+        g = FragmentGrammar.uniform(self.grammar.primitives + [fragment])
+        fragmentType = g.productions[-1][1]
+        fitting = {}
+
+        def fits(request):
+            if request not in fitting:
+                context, [r] = instantiateTypes(Context.EMPTY, [request])
+                context, t = fragmentType.instantiate(context)
+                try:
+                    context.unify(t.returns(), r)
+                    fitting[request] = True
+                except UnificationFailure:
+                    fitting[request] = False
+            return fitting[request]
+
+        touched = self.touched(fragment)
+        rest = SiteSummary()
+        rest.join(self.total)
+        restLogLikelihood = self.totalLogLikelihood
+        for j in touched:
+            if j in self.singles:
+                rest.join(self.summaries[j][0], sign=-1)
+                restLogLikelihood -= self.frontiers[j].entries[0].logLikelihood
+        touchedSet = set(touched)
+        others = [j for j in range(len(self.frontiers))
+                  if j not in self.singles and j not in touchedSet]
+
+        def weightsOf(g):
+            weights = {p: l for l, _, p in g.productions}
+            weights[Index(0)] = g.logVariable
+            return weights
+
+        # Inside-outside
+        weights = weightsOf(g)
+        normalizers = {}
+        uses = rest.expectedUses(fragment, fits)
+        for j in others:
+            ls = [e.logLikelihood + summary.logLikelihood(weights, fragment, fits, normalizers)
+                  for e, summary in zip(self.frontiers[j], self.summaries[j])]
+            z = lse(ls)
+            for l, summary in zip(ls, self.summaries[j]):
+                uses = uses + summary.expectedUses(fragment, fits, weight=math.exp(l - z))
+        uses = uses + g.expectedUses([self.frontiers[j] for j in touched])
+        g.clearCache()
+        g = g.fromUses(uses, self.pseudoCounts)
+
+        weights = weightsOf(g)
+        normalizers = {}
+        likelihood = restLogLikelihood + rest.logLikelihood(weights, fragment, fits, normalizers)
+        for j in others:
+            likelihood += max(e.logLikelihood + summary.logLikelihood(weights, fragment, fits, normalizers)
+                              for e, summary in zip(self.frontiers[j], self.summaries[j]))
+        likelihood += g.jointFrontiersMDL([self.frontiers[j] for j in touched])
+        return FragmentScorer.penalize(g, likelihood, self.aic, self.structurePenalty)
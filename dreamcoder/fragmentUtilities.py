@@ -145,6 +145,92 @@ def mightMatch(f, e, d=0):
     assert False
 
 
+class SubexpressionIndex(object):
+    """A discrimination tree over the subexpressions of programs, each filed under
+    the keys (e.g. frontiers) of the programs that contain it. Subexpressions are
+    paths of symbols in preorder (applications, abstractions, de Bruijn indices,
+    primitives and invented primitives); a fragment is looked up by the same path,
+    with its free variables skipping whole subexpressions, which finds exactly the
+    subexpressions that mightMatch it."""
+
+    def __init__(self):
+        # symbol -> child; the subexpressions that end at a node are under None
+        self.root = {}
+        # subexpression -> set of keys
+        self.occurrences = {}
+        # node -> the nodes one subexpression below it
+        self.skips = {}
+
+    def __len__(self): return len(self.occurrences)
+
+    @staticmethod
+    def symbols(e, symbols):
+        if e.isApplication:
+            symbols.append(("@",))
+            SubexpressionIndex.symbols(e.f, symbols)
+            SubexpressionIndex.symbols(e.x, symbols)
+        elif e.isAbstraction:
+            symbols.append(("lambda",))
+            SubexpressionIndex.symbols(e.body, symbols)
+        elif e.isIndex:
+            symbols.append(("$", e.i))
+        else:
+            symbols.append(("p", e))
+        return symbols
+
+    @staticmethod
+    def arity(symbol):
+        return 2 if symbol[0] == "@" else 1 if symbol[0] == "lambda" else 0
+
+    def add(self, program, key):
+        for _, e in program.walk():
+            keys = self.occurrences.get(e)
+            if keys is None:
+                keys = self.occurrences[e] = set()
+                node = self.root
+                for symbol in SubexpressionIndex.symbols(e, []):
+                    node = node.setdefault(symbol, {})
+                node.setdefault(None, []).append(e)
+                self.skips = {}
+            keys.add(key)
+
+    def skip(self, node):
+        ends = self.skips.get(id(node))
+        if ends is None:
+            ends = []
+            stack = [(node, 1)]
+            while stack:
+                n, pending = stack.pop()
+                if pending == 0:
+                    ends.append(n)
+                    continue
+                for symbol, child in n.items():
+                    if symbol is not None:
+                        stack.append((child, pending - 1 + SubexpressionIndex.arity(symbol)))
+            self.skips[id(node)] = ends
+        return ends
+
+    def _lookup(self, fragment, nodes, d):
+        if fragment.isIndex and not fragment.bound(d):
+            return [e for n in nodes for e in self.skip(n)]
+        if fragment.isApplication:
+            nodes = [n[("@",)] for n in nodes if ("@",) in n]
+            return self._lookup(fragment.x, self._lookup(fragment.f, nodes, d), d)
+        if fragment.isAbstraction:
+            nodes = [n[("lambda",)] for n in nodes if ("lambda",) in n]
+            return self._lookup(fragment.body, nodes, d + 1)
+        symbol = ("$", fragment.i) if fragment.isIndex else ("p", fragment)
+        return [n[symbol] for n in nodes if symbol in n]
+
+    def matches(self, fragment):
+        """The subexpressions that fragment might match"""
+        return {e for n in self._lookup(fragment, [self.root], 0) for e in n.get(None, [])}
+
+    def keys(self, fragment):
+        """The keys of the programs with a subexpression that fragment might match"""
+        return {k for e in self.matches(fragment) for k in self.occurrences[e]}
+
+
 def canonicalFragment(expression):
     '''
     Puts a fragment into a canonical form:
@@ -221,9 +307,11 @@ def defragment(expression):
 
 
 class RewriteFragments(object):
-    def __init__(self, fragment):
+    def __init__(self, fragment, matches=None):
         self.fragment = fragment
         self.concrete = defragment(fragment)
+        # When given, the only subexpressions worth trying to rewrite
+        self.matches = matches
 
     def tryRewrite(self, e, numberOfArguments):
         try:
@@ -241,8 +329,12 @@ class RewriteFragments(object):
         return e
 
     def application(self, e, numberOfArguments):
-        e = Application(e.f.visit(self, numberOfArguments + 1),
-                        e.x.visit(self, 0))
+        f = e.f.visit(self, numberOfArguments + 1)
+        x = e.x.visit(self, 0)
+        if self.matches is not None:
+            # Subexpressions that were not rewritten below are only worth trying when indexed
+            if f is e.f and x is e.x and e not in self.matches: return e
+        e = Application(f, x)
         return self.tryRewrite(e, numberOfArguments) or e
 
     def index(self, e, numberOfArguments): return e
@@ -252,14 +344,30 @@ class RewriteFragments(object):
     def primitive(self, e, numberOfArguments): return e
 
     def abstraction(self, e, numberOfArguments):
-        e = Abstraction(e.body.visit(self, 0))
+        body = e.body.visit(self, 0)
+        if self.matches is not None:
+            if body is e.body and e not in self.matches: return e
+        e = Abstraction(body)
         return self.tryRewrite(e, numberOfArguments) or e
 
     def rewrite(self, e): return e.visit(self, 0)
 
     @staticmethod
-    def rewriteFrontier(frontier, fragment):
-        worker = RewriteFragments(fragment)
+    def rewriteFrontiers(frontiers, fragment):
+        """rewriteFrontier of every frontier, but only visiting the programs, and
+        the subexpressions, that fragment might match"""
+        index = SubexpressionIndex()
+        for j, frontier in enumerate(frontiers):
+            for entry in frontier:
+                index.add(entry.program, j)
+        matches = index.matches(fragment)
+        touched = index.keys(fragment)
+        return [RewriteFragments.rewriteFrontier(frontier, fragment, matches) if j in touched else frontier
+                for j, frontier in enumerate(frontiers)]
+
+    @staticmethod
+    def rewriteFrontier(frontier, fragment, matches=None):
+        worker = RewriteFragments(fragment, matches)
         return Frontier([FrontierEntry(program=worker.rewrite(e.program),
                                        logLikelihood=e.logLikelihood,
                                        logPrior=e.logPrior,
@@ -345,61 +453,58 @@ def violatesLaziness(fragment):
     return False
 
 
-def proposeFragmentsFromProgram(p, arity):
-
-    def fragment(expression, a, toplevel=True):
-        """Generates fragments that unify with expression"""
-
-        if a == 1:
-            yield FragmentVariable.single
-        if a == 0:
-            yield expression
-            return
-
-        if isinstance(expression, Abstraction):
-            # Symmetry breaking: (\x \y \z ... f(x,y,z,...)) defragments to be
-            # the same as f(x,y,z,...)
-            if not toplevel:
-                for b in fragment(expression.body, a, toplevel=False):
-                    yield Abstraction(b)
-        elif isinstance(expression, Application):
-            for fa in range(a + 1):
-                for f in fragment(expression.f, fa, toplevel=False):
-                    for x in fragment(expression.x, a - fa, toplevel=False):
-                        yield Application(f, x)
-        else:
-            assert isinstance(expression, (Invented, Primitive, Index))
-
-    def fragments(expression, a):
-        """Generates fragments that unify with subexpressions of expression"""
+def fragmentsOfExpression(expression, a, toplevel=True):
+    """Generates fragments with a holes that unify with expression"""
+
+    if a == 1:
+        yield FragmentVariable.single
+    if a == 0:
+        yield expression
+        return
+
+    if isinstance(expression, Abstraction):
+        # Symmetry breaking: (\x \y \z ... f(x,y,z,...)) defragments to be
+        # the same as f(x,y,z,...)
+        if not toplevel:
+            for b in fragmentsOfExpression(expression.body, a, toplevel=False):
+                yield Abstraction(b)
+    elif isinstance(expression, Application):
+        for fa in range(a + 1):
+            for f in fragmentsOfExpression(expression.f, fa, toplevel=False):
+                for x in fragmentsOfExpression(expression.x, a - fa, toplevel=False):
+                    yield Application(f, x)
+    else:
+        assert isinstance(expression, (Invented, Primitive, Index))
+
+
+def proposeFragmentsFromExpression(expression, arity):
+    """The fragments that unify with expression itself, as proposeFragmentsFromProgram"""
+    return {canonicalFragment(f) for b in range(arity + 1)
+            for f in fragmentsOfExpression(expression, b) if nontrivial(f)}
 
-        yield from fragment(expression, a)
-        if isinstance(expression, Application):
-            curry = True
-            if curry:
-                yield from fragments(expression.f, a)
-                yield from fragments(expression.x, a)
-            else:
-                # Pretend that it is not curried
-                function, arguments = expression.applicationParse()
-                yield from fragments(function, a)
-                for argument in arguments:
-                    yield from fragments(argument, a)
-        elif isinstance(expression, Abstraction):
-            yield from fragments(expression.body, a)
-        else:
-            assert isinstance(expression, (Invented, Primitive, Index))
 
-    return {canonicalFragment(f) for b in range(arity + 1)
-            for f in fragments(p, b) if nontrivial(f)}
-
-
-def proposeFragmentsFromFrontiers(frontiers, a, CPUs=1):
-    fragmentsFromEachFrontier = parallelMap(
-        CPUs, lambda frontier: {
-            fp for entry in frontier.entries for f in proposeFragmentsFromProgram(
-                entry.program, a) for fp in proposeFragmentsFromFragment(f)}, frontiers)
-    allFragments = Counter(f for frontierFragments in fragmentsFromEachFrontier
-                           for f in frontierFragments)
-    return [fragment for fragment, frequency in allFragments.items()
-            if frequency >= 2 and fragment.wellTyped() and nontrivial(fragment)]
+def proposeFragmentsFromProgram(p, arity):
+    """Fragments that unify with subexpressions of p"""
+    return {f for e in {e for _, e in p.walk()}
+            for f in proposeFragmentsFromExpression(e, arity)}
+
+
+def proposeFragmentsFromFrontiers(frontiers, a, CPUs=1, index=None):
+    """The fragments of the programs of at least two frontiers. Each distinct
+    subexpression proposes its fragments once, however many programs it is in.
+    index: a SubexpressionIndex of the programs keyed by frontier, if there is one"""
+    if index is None:
+        index = SubexpressionIndex()
+        for j, frontier in enumerate(frontiers):
+            for entry in frontier.entries:
+                index.add(entry.program, j)
+    expressions = list(index.occurrences)
+    fragmentsOfEachExpression = parallelMap(
+        CPUs, lambda e: {fp for f in proposeFragmentsFromExpression(e, a)
+                         for fp in proposeFragmentsFromFragment(f)}, expressions)
+    frontiersOfFragment = {}
+    for e, fragments in zip(expressions, fragmentsOfEachExpression):
+        for f in fragments:
+            frontiersOfFragment.setdefault(f, set()).update(index.occurrences[e])
+    return [fragment for fragment, js in frontiersOfFragment.items()
+            if len(js) >= 2 and fragment.wellTyped() and nontrivial(fragment)]
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from dreamcoder.frontier import *
 from dreamcoder.program import *
@@ -17,34 +17,80 @@ class NoCandidates(Exception):
     pass
 
 
+# Maximum number of (request, environment) entries remembered by Grammar.buildCandidates
+CANDIDATECACHESIZE = 2**14
+
+
 class Grammar(object):
-    def __init__(self, logVariable, productions, continuationType=None):
+    def __init__(self, logVariable, productions, continuationType=None, symmetryRules=None):
         self.logVariable = logVariable
         self.productions = productions
 
         self.continuationType = continuationType
 
+        # None: the hand-coded rules of violatesSymmetry
+        self._symmetryRules = symmetryRules
+
         self.expression2likelihood = dict((p, l) for l, _, p in productions)
         self.expression2likelihood[Index(0)] = self.logVariable
 
+        self.clearCandidateCache()
+
+    def clearCandidateCache(self):
+        # Maps canonical (mustBeLeaf, request, environment) to the candidates
+        # that unify with it; see buildCandidates
+        self.candidateCache = OrderedDict()
+        self.candidateCacheHits = 0
+        self.candidateCacheMisses = 0
+
+    def candidateCacheStatistics(self):
+        lookups = self.candidateCacheHits + self.candidateCacheMisses
+        return {"hits": self.candidateCacheHits,
+                "misses": self.candidateCacheMisses,
+                "size": len(self.candidateCache),
+                "hitRate": self.candidateCacheHits / lookups if lookups else 0.}
+
+    def __getstate__(self):
+        # The candidate cache is rebuilt on demand, so don't ship it to workers
+        return {"logVariable": self.logVariable,
+                "productions": self.productions,
+                "continuationType": self.continuationType,
+                "symmetryRules": self._symmetryRules}
+
+    @property
+    def symmetryRules(self):
+        """The SymmetryRules used to prune enumeration with this grammar"""
+        if self._symmetryRules is None:
+            self._symmetryRules = SymmetryRules.handCoded(self.primitives)
+        return self._symmetryRules
+
+    def learnSymmetryRules(self, tasks=[], **keywords):
+        """Returns a copy of this grammar that also breaks the symmetries found by SymmetryRules.learn"""
+        return Grammar(self.logVariable, self.productions,
+                       continuationType=self.continuationType,
+                       symmetryRules=self.symmetryRules | SymmetryRules.learn(self, tasks, **keywords))
+
     def randomWeights(self, r):
         """returns a new grammar with random weights drawn from r. calls `r` w/ old weight"""
         return Grammar(logVariable=r(self.logVariable),
                        productions=[(r(l),t,p)
                                     for l,t,p in self.productions ],
-                       continuationType=self.continuationType)
+                       continuationType=self.continuationType,
+                       symmetryRules=self._symmetryRules)
 
     def strip_primitive_values(self):
         return Grammar(logVariable=self.logVariable,
                        productions=[(l,t,strip_primitive_values(p))
                                     for l,t,p in self.productions ],
-                       continuationType=self.continuationType)
+                       continuationType=self.continuationType,
+                       symmetryRules=self._symmetryRules)
 
     def unstrip_primitive_values(self):
         return Grammar(logVariable=self.logVariable,
                        productions=[(l,t,unstrip_primitive_values(p))
                                     for l,t,p in self.productions ],
-                       continuationType=self.continuationType)
+                       continuationType=self.continuationType,
+                       symmetryRules=self._symmetryRules)
 
     def __setstate__(self, state):
         """
@@ -62,7 +108,8 @@ class Grammar(object):
             else:
                 continuationType = None
                 
-        self.__init__(state['logVariable'], state['productions'], continuationType=continuationType)
+        self.__init__(state['logVariable'], state['productions'], continuationType=continuationType,
+                      symmetryRules=state.get('symmetryRules'))
 
     @staticmethod
     def fromProductions(productions, logVariable=0.0, continuationType=None):
@@ -125,7 +172,8 @@ class Grammar(object):
             self.logVariable, [
                 (l, t, p) for (
                     l, t, p) in self.productions if p not in ps],
-            continuationType=self.continuationType)
+            continuationType=self.continuationType,
+            symmetryRules=self._symmetryRules)
 
     def buildCandidates(self, request, context, environment,
                         # Should the log probabilities be normalized?
@@ -136,13 +184,106 @@ class Grammar(object):
                         # Should we return probabilities vs log probabilities?
                         returnProbabilities=False,
                         # Must be a leaf (have no arguments)?
-                        mustBeLeaf=False):
+                        mustBeLeaf=False,
+                        # Only keep candidates whose normalized description
+                        # length is below this bound
+                        upperBound=None):
         """Primitives that are candidates for being used given a requested type
         If returnTable is false (default): returns [((log)likelihood, tp, primitive, context)]
         if returntable is true: returns {primitive: ((log)likelihood, tp, context)}"""
         if returnProbabilities:
             assert normalize
+        assert upperBound is None or normalize
+
+        candidates, z = self._cachedCandidates(request, context, environment, mustBeLeaf,
+                                               upperBound=upperBound)
+        if candidates is None:
+            raise NoCandidates()
+
+        if normalize:
+            if z is None:
+                z = lse([l for l, t, p, k in candidates])
+            if returnProbabilities:
+                candidates = [(exp(l - z), t, p, k)
+                              for l, t, p, k in candidates]
+            else:
+                candidates = [(l - z, t, p, k) for l, t, p, k in candidates]
+            if upperBound is not None:
+                candidates = [c for c in candidates if -c[0] < upperBound]
 
+        if returnTable:
+            return {p: (l, t, k) for l, t, p, k in candidates}
+        else:
+            return candidates
+
+    def _cachedCandidates(self, request, context, environment, mustBeLeaf, upperBound=None):
+        """Returns ([(unnormalized log likelihood, tp, primitive, context)], normalizer or None),
+        or (None, None) if nothing unifies with the request.
+        Unification only depends upon the request and environment up to a
+        renaming of type variables, so candidates are computed once in a
+        canonical context and then renamed into the caller's context. Only
+        candidates that survive upperBound are renamed."""
+        if not isinstance(self.logVariable, (int, float)):
+            # Weights coming out of the recognition model are tensors; caching
+            # those would keep their computation graphs alive
+            candidates = self._buildCandidates(request, context, environment, mustBeLeaf)
+            return candidates or None, None
+
+        bindings = {}
+        key = (mustBeLeaf,
+               request.apply(context).canonical(bindings),
+               tuple(t.apply(context).canonical(bindings) for t in environment))
+        entry = self.candidateCache.get(key)
+        if entry is None:
+            self.candidateCacheMisses += 1
+            numberOfVariables = len(bindings)
+            candidates = self._buildCandidates(key[1], Context(numberOfVariables),
+                                               list(key[2]), mustBeLeaf)
+            # For each candidate remember how many fresh variables it
+            # allocated and what the request's variables got bound to
+            # (fully applied, so bindings of fresh variables can be dropped)
+            entry = ([(l, t, p, k.nextVariable - numberOfVariables,
+                       [(j, TypeVariable(j).apply(k))
+                        for j in range(numberOfVariables)
+                        if k.substitution.lookup(j) is not None])
+                      for l, t, p, k in candidates],
+                     lse([l for l, _, _, _ in candidates]) if candidates else None,
+                     numberOfVariables)
+            self.candidateCache[key] = entry
+            if len(self.candidateCache) > CANDIDATECACHESIZE:
+                self.candidateCache.popitem(last=False)
+        else:
+            self.candidateCacheHits += 1
+            self.candidateCache.move_to_end(key)
+
+        cachedCandidates, z, numberOfVariables = entry
+        if not cachedCandidates:
+            return None, None
+        # Fresh variables must not capture anything mentioned by the request,
+        # even if the caller never allocated those variables in its context
+        nextVariable = max([context.nextVariable] + [v + 1 for v in bindings])
+        # canonical type variable -> type variable in the caller's context,
+        # built the first time that a candidate actually needs it
+        renaming = None
+        candidates = []
+        for l, t, p, fresh, substitution in cachedCandidates:
+            if upperBound is not None and not (-(l - z) < upperBound):
+                continue
+            if not substitution and not t.isPolymorphic:
+                candidates.append((l, t, p, Context(nextVariable + fresh, context.substitution)))
+                continue
+            if renaming is None:
+                renaming = {c.v: TypeVariable(v) for v, c in bindings.items()}
+                for j in range(max(fresh for _, _, _, fresh, _ in cachedCandidates)):
+                    renaming[numberOfVariables + j] = TypeVariable(nextVariable + j)
+            newSubstitution = context.substitution
+            for j, vt in substitution:
+                newSubstitution = newSubstitution.extend(renaming[j].v, vt.canonical(renaming))
+            candidates.append((l, t.canonical(renaming), p,
+                               Context(nextVariable + fresh, newSubstitution)))
+        return candidates, z
+
+    def _buildCandidates(self, request, context, environment, mustBeLeaf):
         candidates = []
         variableCandidates = []
         for l, t, p in self.productions:
@@ -174,26 +315,7 @@ class Grammar(object):
             
         candidates += [(self.logVariable - log(len(variableCandidates)), t, p, k)
                        for t, p, k in variableCandidates]
-        if candidates == []:
-            raise NoCandidates()
-        #eprint("candidates inside buildCandidates before norm:")
-        #eprint(candidates)
-
-        if normalize:
-            z = lse([l for l, t, p, k in candidates])
-            if returnProbabilities:
-                candidates = [(exp(l - z), t, p, k)
-                              for l, t, p, k in candidates]
-            else:
-                candidates = [(l - z, t, p, k) for l, t, p, k in candidates]
-
-        #eprint("candidates inside buildCandidates after norm:")
-        #eprint(candidates)
-
-        if returnTable:
-            return {p: (l, t, k) for l, t, p, k in candidates}
-        else:
-            return candidates
+        return candidates
 
 
     def sample(self, request, maximumDepth=6, maxAttempts=None):
@@ -497,6 +619,17 @@ class Grammar(object):
                                               maximumDepth=maximumDepth - 1):
                     yield aL + l, aK, application
 
+    def stackEnumeration(self, context, environment, request, upperBound,
+                         maximumDepth=20,
+                         lowerBound=0.,
+                         pruneSubprogram=None,
+                         shard=None):
+        '''Same programs, in the same order, as enumeration; see stackEnumeration'''
+        return stackEnumeration(lambda parent, parentIndex: self,
+                                context, environment, request, upperBound,
+                                maximumDepth=maximumDepth, lowerBound=lowerBound,
+                                pruneSubprogram=pruneSubprogram, shard=shard)
+
     def enumerateApplication(self, context, environment,
                              function, argumentRequests,
                              # Upper bound on the description length of all of
@@ -525,7 +658,7 @@ class Grammar(object):
                                                           upperBound=upperBound,
                                                           lowerBound=0.,
                                                           maximumDepth=maximumDepth):
-                if violatesSymmetry(originalFunction, arg, argumentIndex):
+                if self.symmetryRules.violates(originalFunction, arg, argumentIndex):
                     continue
 
                 newFunction = Application(function, arg)
@@ -740,7 +873,16 @@ class Grammar(object):
         return Grammar(self.logVariable.data.tolist()[0], 
                        [ (l.data.tolist()[0], t, p)
                          for l, t, p in self.productions],
-                       continuationType=self.continuationType)
+                       continuationType=self.continuationType,
+                       symmetryRules=self._symmetryRules)
+
+    def withLogProductions(self, logProductions):
+        """The same productions, but weighted by the list of floats
+        logProductions: one per production, then the variable"""
+        return Grammar(logProductions[-1],
+                       [(l, t, p) for l, (_, t, p) in zip(logProductions, self.productions)],
+                       continuationType=self.continuationType,
+                       symmetryRules=self._symmetryRules)
 
 class LikelihoodSummary(object):
     '''Summarizes the terms that will be used in a likelihood calculation'''
@@ -822,11 +964,12 @@ class Uses(object):
     '''Tracks uses of different grammar productions'''
 
     def __init__(self, possibleVariables=0., actualVariables=0.,
-                 possibleUses={}, actualUses={}):
+                 possibleUses=None, actualUses=None):
         self.actualVariables = actualVariables
         self.possibleVariables = possibleVariables
-        self.possibleUses = possibleUses
-        self.actualUses = actualUses
+        # Fresh dictionaries, because += updates them in place
+        self.possibleUses = {} if possibleUses is None else possibleUses
+        self.actualUses = {} if actualUses is None else actualUses
 
     def __str__(self):
         return "Uses(actualVariables = %f, possibleVariables = %f, actualUses = %s, possibleUses = %s)" %\
@@ -1005,9 +1148,7 @@ class ContextualGrammar:
                                           [request.arguments[0]] + environment,
                                           request.arguments[1],
                                           expression.body)
-        if parent is None: g = self.noParent
-        elif parent.isIndex: g = self.variableParent
-        else: g = self.library[parent][parentIndex]            
+        g = self.grammarOfParent(parent, parentIndex)
         candidates = g.buildCandidates(request, context, environment,
                                        normalize=False, returnTable=True)
 
@@ -1065,9 +1206,7 @@ class ContextualGrammar:
                                          request.arguments[1],
                                          maximumDepth)
             return context, Abstraction(body)
-        if parent is None: g = self.noParent
-        elif parent.isIndex: g = self.variableParent
-        else: g = self.library[parent][parentIndex]
+        g = self.grammarOfParent(parent, parentIndex)
         candidates = g.buildCandidates(request, context, environment,
                                        normalize=True, returnProbabilities=True,
                                        mustBeLeaf=(maximumDepth <= 1))
@@ -1173,9 +1312,7 @@ class ContextualGrammar:
                                                      maximumDepth=maximumDepth):
                 yield l, newContext, Abstraction(b)
         else:
-            if parent is None: g = self.noParent
-            elif parent.isIndex: g = self.variableParent
-            else: g = self.library[parent][parentIndex]
+            g = self.grammarOfParent(parent, parentIndex)
 
             candidates = g.buildCandidates(request, context, environment,
                                            normalize=True)
@@ -1194,6 +1331,22 @@ class ContextualGrammar:
                                               maximumDepth=maximumDepth - 1):
                     yield aL + l, aK, application
 
+    def grammarOfParent(self, parent, parentIndex):
+        if parent is None: return self.noParent
+        elif parent.isIndex: return self.variableParent
+        else: return self.library[parent][parentIndex]
+
+    def stackEnumeration(self, context, environment, request, upperBound,
+                         maximumDepth=20,
+                         lowerBound=0.,
+                         pruneSubprogram=None,
+                         shard=None):
+        '''Same programs, in the same order, as enumeration; see stackEnumeration'''
+        return stackEnumeration(self.grammarOfParent,
+                                context, environment, request, upperBound,
+                                maximumDepth=maximumDepth, lowerBound=lowerBound,
+                                pruneSubprogram=pruneSubprogram, shard=shard)
+
     def enumerateApplication(self, context, environment,
                              function, argumentRequests,
                              # Upper bound on the description length of all of
@@ -1225,7 +1378,7 @@ class ContextualGrammar:
                                                           upperBound=upperBound,
                                                           lowerBound=0.,
                                                           maximumDepth=maximumDepth):
-                if violatesSymmetry(originalFunction, arg, argumentIndex):
+                if self.noParent.symmetryRules.violates(originalFunction, arg, argumentIndex):
                     continue
 
                 newFunction = Application(function, arg)
@@ -1242,6 +1395,497 @@ class ContextualGrammar:
         
 
 
+# Instructions making up the continuation of a partial program in stackEnumeration
+HOLE, ABSTRACT, APPLY, FILLED = 0, 1, 2, 3
+
+# A sharded stackEnumeration splits its stack once it holds this many partial
+# programs per shard; more means better balanced shards, but more work done by every shard
+SHARDSPLIT = 16
+
+
+class ContextRow(object):
+    """The log weights of one row of a ContextualGrammarMatrix, looked up by production.
+    Stands in for a Grammar when scoring a LikelihoodSummary."""
+    def __init__(self, weights, column):
+        self.weights = weights
+        self.column = column
+        self.expression2likelihood = self
+
+    def __getitem__(self, p): return self.weights[self.column[p]]
+
+    def get(self, p, default=None):
+        c = self.column.get(p)
+        return default if c is None else self.weights[c]
+
+
+class ContextualGrammarMatrix(ContextualGrammar):
+    """A ContextualGrammar kept as one matrix of log weights: a row per context, and a
+    column per production of grammar, then one for the variable. slots maps each
+    primitive to the rows of its arguments; the last two rows are for no parent and
+    for a variable parent. This is the layout of ContextualGrammarNetwork.
+    weights is a list of lists of floats or a tensor. The Grammar of a context is only
+    built when something asks for it, and likelihood summaries only keep the
+    contexts that they use."""
+
+    def __init__(self, grammar, weights, slots):
+        self.grammar = grammar
+        self.weights = weights
+        self.slots = slots
+
+        self.productions = [(None, t, p) for _, t, p in grammar.productions]
+        self.primitives = [p for _, _2, p in self.productions]
+        self.continuationType = grammar.continuationType
+
+        self.column = {p: c for c, p in enumerate(self.primitives)}
+        self.column[Index(0)] = len(self.primitives)
+        self.rowGrammars = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["rowGrammars"] = {}
+        return state
+
+    @staticmethod
+    def parentSlots(grammar):
+        """The slots for the primitives of grammar, and the number of rows"""
+        slots = {}
+        rows = 0
+        for p in grammar.primitives:
+            arity = len(p.infer().functionArguments())
+            slots[p] = list(range(rows, rows + arity))
+            rows += arity
+        return slots, rows + 2
+
+    @staticmethod
+    def fromGrammar(g):
+        slots, rows = ContextualGrammarMatrix.parentSlots(g)
+        row = [l for l, _, _ in g.productions] + [g.logVariable]
+        return ContextualGrammarMatrix(g, [row] * rows, slots)
+
+    def rowOfParent(self, parent, parentIndex):
+        if parent is None: return len(self.weights) - 1
+        if parent.isIndex: return len(self.weights) - 2
+        return self.slots[parent][parentIndex]
+
+    def row(self, r): return ContextRow(self.weights[r], self.column)
+
+    def rowGrammar(self, r):
+        g = self.rowGrammars.get(r)
+        if g is None:
+            weights = self.weights[r]
+            # Tensors become one element tensors, as in GrammarNetwork
+            weights = list(weights.view(-1, 1)) if hasattr(weights, "view") else list(weights)
+            g = self.rowGrammars[r] = self.grammar.withLogProductions(weights)
+        return g
+
+    def grammarOfParent(self, parent, parentIndex):
+        return self.rowGrammar(self.rowOfParent(parent, parentIndex))
+
+    @property
+    def noParent(self): return self.rowGrammar(len(self.weights) - 1)
+
+    @property
+    def variableParent(self): return self.rowGrammar(len(self.weights) - 2)
+
+    @property
+    def library(self):
+        return {p: [self.rowGrammar(r) for r in rs] for p, rs in self.slots.items()}
+
+    def untorch(self):
+        weights = self.weights.tolist() if hasattr(self.weights, "tolist") else self.weights
+        return ContextualGrammarMatrix(self.grammar, weights, self.slots)
+
+    def randomWeights(self, r):
+        return ContextualGrammarMatrix(self.grammar,
+                                       [[r(w) for w in row] for row in self.untorch().weights],
+                                       self.slots)
+
+    def json(self):
+        weights = self.untorch().weights
+
+        def rowJson(row):
+            j = {"logVariable": row[-1],
+                 "productions": [{"expression": str(p), "logProbability": l}
+                                 for l, p in zip(row, self.primitives)]}
+            if self.continuationType is not None:
+                j["continuationType"] = self.continuationType.json()
+            return j
+
+        return {"noParent": rowJson(weights[-1]),
+                "variableParent": rowJson(weights[-2]),
+                "productions": [{"program": str(e),
+                                 "arguments": [rowJson(weights[r]) for r in rs]}
+                                for e, rs in self.slots.items()]}
+
+    class LS: # likelihood summary
+        def __init__(self, owner):
+            self.owner = owner
+            # row -> LikelihoodSummary
+            self.rows = {}
+
+        def __getstate__(self): return {"rows": self.rows}
+
+        def __setstate__(self, state):
+            self.owner = None
+            self.rows = state["rows"]
+
+        def record(self, parent, parentIndex, actual, possibles, constant):
+            r = self.owner.rowOfParent(parent, parentIndex)
+            if r not in self.rows: self.rows[r] = LikelihoodSummary()
+            self.rows[r].record(actual, possibles, constant=constant)
+
+        def join(self, other):
+            for r, s in other.rows.items():
+                if r not in self.rows: self.rows[r] = LikelihoodSummary()
+                self.rows[r].join(s)
+
+        def logLikelihood(self, owner):
+            return sum(s.logLikelihood(owner.row(r)) for r, s in self.rows.items())
+        def numerator(self, owner):
+            return sum(s.numerator(owner.row(r)) for r, s in self.rows.items())
+        def denominator(self, owner):
+            return sum(s.denominator(owner.row(r)) for r, s in self.rows.items())
+
+
+def stackEnumeration(grammarOfParent, context, environment, request, upperBound,
+                     maximumDepth=20,
+                     lowerBound=0.,
+                     pruneSubprogram=None,
+                     shard=None):
+    '''Enumerates all programs whose MDL satisfies: lowerBound <= MDL < upperBound
+    Equivalent to the recursive Grammar.enumeration/enumerateApplication,
+    but driven by one explicit stack instead of a generator per AST node.
+    grammarOfParent(parent, argumentIndex) gives the grammar used to fill a hole.
+    Each stack entry is a partial program: (log likelihood so far, context,
+    instructions still to run, values built so far), where instructions and
+    values are cons lists so that sibling branches share their tails.
+      (HOLE, environment, request, maximumDepth, parent, argumentIndex)
+      (ABSTRACT,): wraps the top value in a lambda
+      (APPLY, forbidden): applies the second value to the top value, unless the
+        head of the top value is in forbidden (see SymmetryRules)
+      (FILLED, grammar, environment, request, log likelihood when the hole was opened)
+    If given, pruneSubprogram(grammar, environment, request, subprogram, description length)
+    is called whenever a hole has been completely filled, and the partial
+    program is dropped if it returns True.
+    shard = (index, count) enumerates only one of count disjoint parts of the
+    programs: every shard expands partial programs breadth first, in the same
+    order, until there are SHARDSPLIT*count of them, and then keeps every
+    count'th one. Sharded enumeration does not follow the usual order.'''
+    abstract = (ABSTRACT,)
+    stack = [(0., context,
+              ((HOLE, environment, request, maximumDepth, None, None), None),
+              None)]
+    if shard is None or shard[1] == 1:
+        splitAt, owner = None, True
+    else:
+        shardIndex, shardCount = shard
+        # Programs finished before the split belong to the first shard
+        splitAt, owner = SHARDSPLIT * shardCount, shardIndex == 0
+    while stack:
+        if splitAt is not None and len(stack) >= splitAt:
+            stack = stack[shardIndex::shardCount]
+            splitAt, owner = None, True
+            continue
+        ll, context, instructions, values = stack.pop(0 if splitAt is not None else -1)
+
+        # Run instructions until we reach a hole or finish the program
+        hole = None
+        pruned = False
+        while instructions is not None:
+            instruction, instructions = instructions
+            if instruction[0] == HOLE:
+                hole = instruction
+                break
+            elif instruction[0] == ABSTRACT:
+                body, values = values
+                values = (Abstraction(body), values)
+            elif instruction[0] == APPLY:
+                _, forbidden = instruction
+                argument, (f, values) = values
+                if forbidden:
+                    head = argument
+                    while head.isApplication:
+                        head = head.f
+                    if head in forbidden:
+                        pruned = True
+                        break
+                values = (Application(f, argument), values)
+            else:
+                _, grammar, holeEnvironment, holeRequest, openedAt = instruction
+                if pruneSubprogram(grammar, holeEnvironment, holeRequest, values[0],
+                                   openedAt - ll):
+                    pruned = True
+                    break
+        if pruned:
+            continue
+        if hole is None:
+            if owner and lowerBound <= -ll:
+                yield ll, context, values[0]
+            continue
+
+        _, environment, request, depth, parent, parentIndex = hole
+        if depth == 1:
+            continue
+        grammar = grammarOfParent(parent, parentIndex)
+        request = request.apply(context)
+        if pruneSubprogram is not None:
+            instructions = ((FILLED, grammar, environment, request, ll), instructions)
+        while request.isArrow():
+            environment = [request.arguments[0]] + environment
+            request = request.arguments[1]
+            instructions = (abstract, instructions)
+        if depth - 1 == 1:
+            continue
+
+        budget = upperBound + ll
+        try:
+            candidates = grammar.buildCandidates(
+                request, context, environment, normalize=True, upperBound=budget)
+        except NoCandidates:
+            continue
+
+        # Pushed in reverse so that candidates come off the stack in order
+        for l, t, p, newContext in reversed(candidates):
+            newInstructions = instructions
+            xs = t.functionArguments()
+            for j in range(len(xs) - 1, -1, -1):
+                newInstructions = ((HOLE, environment, xs[j], depth - 1, p, j),
+                                   ((APPLY, grammar.symmetryRules.forbiddenArguments(p, j)),
+                                    newInstructions))
+            stack.append((ll + l, newContext, newInstructions, (p, values)))
+
+
+class SymmetryRules(object):
+    """Which programs may not be the head of which arguments.
+    A rule (parent, argumentIndex, child) forbids enumerating
+    (parent ... (child ...) ...), with the child application in argument
+    argumentIndex of parent, because another program computes the same thing
+    at no greater cost; eg (car (cons x y)) is x.
+    Parents and children are primitives or invented primitives."""
+
+    def __init__(self, rules):
+        self.rules = frozenset(rules)
+        self._compile()
+
+    def _compile(self):
+        self.table = defaultdict(set)
+        for parent, argumentIndex, child in self.rules:
+            self.table[(parent, argumentIndex)].add(child)
+        self.table = {k: frozenset(v) for k, v in self.table.items()}
+
+    def __getstate__(self): return {"rules": self.rules}
+
+    def __setstate__(self, state):
+        self.rules = state["rules"]
+        self._compile()
+
+    def __len__(self): return len(self.rules)
+
+    def __iter__(self): return iter(self.rules)
+
+    def __eq__(self, o): return isinstance(o, SymmetryRules) and self.rules == o.rules
+
+    def __ne__(self, o): return not (self == o)
+
+    def __hash__(self): return hash(self.rules)
+
+    def __or__(self, o): return SymmetryRules(self.rules | o.rules)
+
+    def __str__(self):
+        return "\n".join("%s\targument %d\tnot %s" % (parent, argumentIndex, child)
+                         for parent, argumentIndex, child in
+                         sorted(self.rules, key=lambda r: (str(r[0]), r[1], str(r[2]))))
+
+    def forbiddenArguments(self, parent, argumentIndex):
+        """Programs that may not be the head of argument argumentIndex of parent"""
+        return self.table.get((parent, argumentIndex), frozenset())
+
+    def violates(self, f, x, argumentIndex):
+        if not (f.isPrimitive or f.isInvented):
+            return False
+        forbidden = self.table.get((f, argumentIndex))
+        if forbidden is None:
+            return False
+        while x.isApplication:
+            x = x.f
+        return x in forbidden
+
+    HANDCODED = {}
+
+    @staticmethod
+    def handCoded(primitives):
+        """The rules of violatesSymmetry, restricted to the given primitives"""
+        key = frozenset(primitives)
+        if key not in SymmetryRules.HANDCODED:
+            SymmetryRules.HANDCODED[key] = SymmetryRules(
+                (f, j, x)
+                for f in key if f.isPrimitive
+                for j in range(len(f.infer().functionArguments()))
+                for x in key
+                if violatesSymmetry(f, x, j))
+        return SymmetryRules.HANDCODED[key]
+
+    @staticmethod
+    def learn(grammar, tasks=[], groundType=tint, budget=10., valuesPerType=20,
+              programsPerType=1000, trials=50, evaluationTimeout=0.01, seed=0):
+        """Finds symmetries of the primitives of grammar by running every
+        (parent ... (child ...) ...) composition on sampled arguments.
+        Values of each type are sampled from the examples of tasks and from
+        the closed programs the grammar enumerates below budget; type
+        variables are instantiated to groundType.
+        A composition is forbidden when, on every sample,
+          - it returns one of its own arguments, eg (+ 0 x) or (car (cons x y));
+          - it crashes, eg (car empty);
+          - it returns the same value, which a smaller closed program computes, eg (empty? (cons x y));
+          - it equals its left-nested form, for an associative parent, eg (+ x (+ y z)),
+        and parent does not behave that way with arbitrary values in place of the child.
+        These are empirical, not proven: more and better samples mean fewer false rules."""
+        rng = random.Random(seed)
+        crashed = object()
+        g = Grammar(grammar.logVariable, grammar.productions,
+                    continuationType=grammar.continuationType,
+                    symmetryRules=SymmetryRules([]))
+
+        def run(k):
+            try:
+                return runWithTimeout(k, evaluationTimeout)
+            except Exception:
+                return crashed
+
+        def same(a, b):
+            try:
+                return a is not crashed and b is not crashed and bool(a == b)
+            except Exception:
+                return False
+
+        # type -> [value], and for each hashable value the size of the smallest program computing it
+        values = defaultdict(list)
+        smallest = defaultdict(dict)
+        def remember(t, v):
+            if len(values[t]) < 2*valuesPerType and not any(same(v, w) for w in values[t]):
+                values[t].append(v)
+        for task in tasks:
+            for xs, y in task.examples:
+                for t, v in zip(task.request.functionArguments() + [task.request.returns()],
+                                list(xs) + [y]):
+                    remember(t, v)
+        enumerated = set()
+        def sample(t):
+            if t not in enumerated:
+                enumerated.add(t)
+                try:
+                    for n, (_, _, p) in enumerate(g.enumeration(Context.EMPTY, [], t, budget,
+                                                                maximumDepth=4)):
+                        if n >= programsPerType:
+                            break
+                        v = run(lambda: p.evaluate([]))
+                        if v is crashed or v is None:
+                            continue
+                        key = tuplify(v)
+                        if hashable(key):
+                            if key in smallest[t]:
+                                continue
+                            smallest[t][key] = p.size()
+                        remember(t, v)
+                except NoCandidates:
+                    pass
+                # Short programs only build short lists, so also make up some longer ones
+                if isinstance(t, TypeConstructor) and t.name == "list" and sample(t.arguments[0]):
+                    for _ in range(valuesPerType):
+                        remember(t, [rng.choice(values[t.arguments[0]])
+                                     for _ in range(rng.randint(1, 6))])
+            return values[t]
+
+        def ground(t):
+            if not t.isPolymorphic:
+                return t
+            if isinstance(t, TypeVariable):
+                return groundType
+            return TypeConstructor(t.name, [ground(a) for a in t.arguments])
+
+        def apply(f, xs):
+            for x in xs:
+                f = f(x)
+            return f
+
+        def always(p, ys):
+            return all(p(y) for y in ys)
+
+        rules = []
+        primitives = [p for p in grammar.primitives if p.isPrimitive or p.isInvented]
+        for parent in primitives:
+            parentValue = parent.evaluate([])
+            for argumentIndex in range(len(parent.infer().functionArguments())):
+                for child in primitives:
+                    k, parentType = parent.infer().instantiate(Context.EMPTY)
+                    k, childType = child.infer().instantiate(k)
+                    try:
+                        k = k.unify(parentType.functionArguments()[argumentIndex],
+                                    childType.returns())
+                    except UnificationFailure:
+                        continue
+                    parentType = ground(parentType.apply(k))
+                    childType = ground(childType.apply(k))
+                    returnType = parentType.returns()
+                    slotType = parentType.functionArguments()[argumentIndex]
+                    if returnType.isArrow():
+                        continue
+                    outerTypes = [t for j, t in enumerate(parentType.functionArguments())
+                                  if j != argumentIndex]
+                    innerTypes = childType.functionArguments()
+                    inputTypes = outerTypes + innerTypes
+                    if not all(sample(t) for t in inputTypes + [slotType]):
+                        continue
+
+                    childValue = child.evaluate([])
+                    if childValue is None:
+                        # placeholders, like the text domain's STRING, only get a value from a task
+                        continue
+                    inputs = [[rng.choice(values[t]) for t in inputTypes]
+                              for _ in range(trials)]
+                    def withSlot(outer, x):
+                        return apply(parentValue, outer[:argumentIndex] + [x] + outer[argumentIndex:])
+                    # Only blame the parent for what happens to values the child could compute
+                    childOutputs = [run(lambda: apply(childValue, xs[len(outerTypes):]))
+                                    for xs in inputs]
+                    inputs = [xs for xs, x in zip(inputs, childOutputs) if x is not crashed]
+                    if not inputs:
+                        continue
+                    outputs = [run(lambda: withSlot(xs[:len(outerTypes)], x))
+                               for xs, x in zip(inputs, childOutputs) if x is not crashed]
+                    # parent with arbitrary values where the child would be
+                    baseline = [run(lambda: withSlot(xs[:len(outerTypes)], rng.choice(values[slotType])))
+                                for xs in inputs]
+
+                    if always(lambda y: y is crashed, outputs):
+                        forbidden = sum(y is crashed for y in baseline) < len(baseline) / 2
+                    elif any(inputTypes[j] == returnType and
+                             always(lambda yx: same(yx[0], yx[1][j]), zip(outputs, inputs))
+                             for j in range(len(inputTypes))):
+                        forbidden = not any(outerTypes[j] == returnType and
+                                            always(lambda yx: same(yx[0], yx[1][j]), zip(baseline, inputs))
+                                            for j in range(len(outerTypes)))
+                    elif always(lambda y: same(y, outputs[0]), outputs):
+                        sample(returnType)
+                        key = tuplify(outputs[0])
+                        forbidden = hashable(key) and \
+                            smallest[returnType].get(key, POSITIVEINFINITY) < 2 + len(inputTypes) and \
+                            not always(lambda y: same(y, outputs[0]), baseline)
+                    elif parent == child and argumentIndex == 1 and \
+                         len(inputTypes) == 3 and all(t == returnType for t in inputTypes):
+                        # (parent x (parent y z)) against (parent (parent x y) z)
+                        leftNested = [run(lambda: apply(parentValue, [apply(parentValue, xs[:2]), xs[2]]))
+                                      for xs in inputs]
+                        forbidden = always(lambda ab: same(*ab), zip(outputs, leftNested))
+                    else:
+                        forbidden = False
+                    if forbidden:
+                        rules.append((parent, argumentIndex, child))
+
+        rules = SymmetryRules(rules)
+        eprint("Learned %d symmetry rules" % len(rules))
+        return rules
+
 def violatesSymmetry(f, x, argumentIndex):
     if not f.isPrimitive:
         return False
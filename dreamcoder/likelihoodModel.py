@@ -16,6 +16,20 @@ class AllOrNothingLikelihoodModel:
         logLikelihood = task.logLikelihood(program, self.timeout)
         return valid(logLikelihood), logLikelihood
 
+    def scoreBatch(self, program, tasks):
+        """score for each of the tasks, running program on the examples of
+        all the batchable tasks at once"""
+        batched = [t for t in tasks if t.batchable]
+        successes = iter(Task.checkBatch(program, batched, self.timeout) if batched else [])
+        scores = []
+        for t in tasks:
+            if t.batchable:
+                success = next(successes)
+                scores.append((success, 0. if success else NEGATIVEINFINITY))
+            else:
+                scores.append(self.score(program, t))
+        return scores
+
 
 class EuclideanLikelihoodModel:
     """Likelihood is based on Euclidean distance between features"""
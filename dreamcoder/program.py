@@ -18,6 +18,58 @@ class RunFailure(Exception):
     pass
 
 
+class EvaluationTimeout(Exception):
+    pass
+
+
+class EvaluationFailure(object):
+    """Stands in for the value of an example whose evaluation raised an exception"""
+    def __repr__(self): return "FAILED"
+
+
+FAILED = EvaluationFailure()
+
+# Batched implementations of primitives, see vectorized
+VECTORIZED = {}
+
+
+def vectorized(implementation, arity):
+    """Decorator declaring a batched implementation of a primitive, given the
+    primitive's curried implementation and how many arguments the batched one takes.
+    The batched implementation takes one column per argument, holding that argument
+    in every example, and returns the column of results. If it raises, the examples
+    are run one by one with the curried implementation instead."""
+    def register(f):
+        VECTORIZED[implementation] = (arity, f)
+        return f
+    return register
+
+
+# Columns shorter than this are not worth converting to numpy arrays
+NUMPYCOLUMN = 64
+
+
+def integerColumn(column, bound=2**62):
+    """column as a numpy array of int64, or None if it is too short to be
+    worth it or some entry is not an int of magnitude below bound"""
+    if len(column) < NUMPYCOLUMN or \
+       not all(type(x) is int and -bound < x < bound for x in column):
+        return None
+    import numpy as np
+    return np.array(column, dtype=np.int64)
+
+
+def applyOrFail(f, arguments):
+    try:
+        for x in arguments:
+            f = f(x)
+        return f
+    except EvaluationTimeout:
+        raise
+    except Exception:
+        return FAILED
+
+
 class Program(object):
     def __repr__(self): return str(self)
 
@@ -87,6 +139,37 @@ class Program(object):
             f = f(x)
         return f
 
+    def evaluateBatch(self, inputs):
+        """Runs the program on every tuple of arguments in inputs with one traversal of the program.
+        Returns one output per tuple, FAILED where running the program raised an exception."""
+        n = len(inputs)
+        arity = len(inputs[0]) if n > 0 else 0
+        body = self
+        bound = 0
+        while body.isAbstraction and bound < arity:
+            body = body.body
+            bound += 1
+        environment = [[xs[i] for xs in inputs] for i in reversed(range(bound))]
+        outputs = body.evaluateColumns(environment, n)
+        if bound < arity:
+            outputs = [FAILED if y is FAILED else applyOrFail(y, xs[bound:])
+                       for y, xs in zip(outputs, inputs)]
+        return outputs
+
+    def evaluateColumns(self, environment, n):
+        """Evaluates the program in n environments at once.
+        environment: one column per variable, holding the variable's value in each of the n environments.
+        Returns the column of n values."""
+        values = []
+        for j in range(n):
+            try:
+                values.append(self.evaluate([column[j] for column in environment]))
+            except EvaluationTimeout:
+                raise
+            except Exception:
+                values.append(FAILED)
+        return values
+
     def applicationParses(self): yield self, []
 
     def applicationParse(self): return self, []
@@ -331,6 +414,73 @@ class Application(Program):
         else:
             return self.f.evaluate(environment)(self.x.evaluate(environment))
 
+    @property
+    def batchedCall(self):
+        """(primitive, batched implementation, arguments) if this applies a
+        primitive with a batched implementation to all of its arguments"""
+        try:
+            return self._batchedCall
+        except AttributeError:
+            pass
+        f, xs = self.applicationParse()
+        self._batchedCall = None
+        if f.isPrimitive and hashable(f.value) and f.value in VECTORIZED:
+            arity, batched = VECTORIZED[f.value]
+            if arity == len(xs):
+                self._batchedCall = (f, batched, xs)
+        return self._batchedCall
+
+    def evaluateColumns(self, environment, n):
+        if self.isConditional:
+            branch = self.branch.evaluateColumns(environment, n)
+            values = [FAILED] * n
+            for taken, e in [(True, self.trueBranch), (False, self.falseBranch)]:
+                rows = [j for j, b in enumerate(branch) if b is not FAILED and bool(b) == taken]
+                if rows:
+                    for j, v in zip(rows, e.evaluateColumns([[column[j] for j in rows]
+                                                             for column in environment],
+                                                            len(rows))):
+                        values[j] = v
+            return values
+
+        call = self.batchedCall
+        if call is not None:
+            f, batched, xs = call
+            arguments = [x.evaluateColumns(environment, n) for x in xs]
+            if any(FAILED in a for a in arguments):
+                rows = [j for j in range(n) if all(a[j] is not FAILED for a in arguments)]
+                arguments = [[a[j] for j in rows] for a in arguments]
+            else:
+                rows = range(n)
+            try:
+                results = batched(*arguments)
+            except EvaluationTimeout:
+                raise
+            except Exception:
+                results = [applyOrFail(f.value, [a[k] for a in arguments])
+                           for k in range(len(rows))]
+            if len(rows) == n:
+                return results
+            values = [FAILED] * n
+            for j, v in zip(rows, results):
+                values[j] = v
+            return values
+
+        functions = self.f.evaluateColumns(environment, n)
+        arguments = self.x.evaluateColumns(environment, n)
+        values = []
+        for g, x in zip(functions, arguments):
+            if g is FAILED or x is FAILED:
+                values.append(FAILED)
+                continue
+            try:
+                values.append(g(x))
+            except EvaluationTimeout:
+                raise
+            except Exception:
+                values.append(FAILED)
+        return values
+
     def inferType(self, context, environment, freeVariables):
         (context, ft) = self.f.inferType(context, environment, freeVariables)
         (context, xt) = self.x.inferType(context, environment, freeVariables)
@@ -420,6 +570,11 @@ class Index(Program):
     def evaluate(self, environment):
         return environment[self.i]
 
+    def evaluateColumns(self, environment, n):
+        if self.i < len(environment):
+            return environment[self.i]
+        return [FAILED] * n
+
     def inferType(self, context, environment, freeVariables):
         if self.bound(len(environment)):
             return (context, environment[self.i].apply(context))
@@ -540,6 +695,11 @@ class Abstraction(Program):
     def evaluate(self, environment):
         return lambda x: self.body.evaluate([x] + environment)
 
+    def evaluateColumns(self, environment, n):
+        if not environment:
+            return [self.evaluate([])] * n
+        return [self.evaluate(list(row)) for row in zip(*environment)]
+
     def betaReduce(self):
         b = self.body.betaReduce()
         if b is None: return None
@@ -618,6 +778,8 @@ class Primitive(Program):
 
     def evaluate(self, environment): return self.value
 
+    def evaluateColumns(self, environment, n): return [self.value] * n
+
     def betaReduce(self): return None
 
     def isBetaLong(self): return True
@@ -706,6 +868,8 @@ class Invented(Program):
 
     def evaluate(self, e): return self.body.evaluate([])
 
+    def evaluateColumns(self, environment, n): return self.body.evaluateColumns([], n)
+
     def betaReduce(self): return self.body
 
     def isBetaLong(self): return True
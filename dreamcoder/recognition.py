@@ -1,9 +1,13 @@
 from dreamcoder.enumeration import *
 from dreamcoder.grammar import *
+from dreamcoder.dreamStore import SAMPLED
 # luke
 
 
+import copy
+import dill
 import gc
+import io
 
 try:
     import torch
@@ -20,6 +24,16 @@ except:
     eprint("WARNING: Could not import np. This is only okay when doing pypy compression.")
     
 import json
+from collections import OrderedDict
+
+# How many tasks RecognitionModel.grammarsOfTasks runs through the network at once
+INFERENCEBATCHSIZE = 256
+
+# How many dreams HelmholtzProducer's workers may get ahead of the trainer
+HELMHOLTZPREFETCH = 1000
+
+# How many tasks RecurrentFeatureExtractor remembers the tokenized examples of
+EXAMPLECACHESIZE = 2**14
 
 
 def variable(x, volatile=False, cuda=False):
@@ -66,6 +80,125 @@ class Entropy(nn.Module):
         b = -1.0 * b.sum()
         return b
 
+class RecognitionOutput(object):
+    """What a RecognitionModel computes for one task, as numpy arrays and an untorched grammar"""
+    def __init__(self, hidden, logProductions, entropy, auxiliary, grammar):
+        self.hidden = hidden
+        self.logProductions = logProductions
+        self.entropy = entropy
+        self.auxiliary = auxiliary
+        self.grammar = grammar
+
+class CompiledSummary(object):
+    """A likelihood summary, as index and count tensors; see LikelihoodSummaryCompiler"""
+    def __init__(self, token, useIndices, useCounts, normalizerRows, normalizerIDs, normalizerCounts, constant):
+        self.token = token
+        self.useIndices = useIndices
+        self.useCounts = useCounts
+        self.normalizerRows = normalizerRows
+        self.normalizerIDs = normalizerIDs
+        self.normalizerCounts = normalizerCounts
+        self.constant = constant
+
+
+class LikelihoodSummaryCompiler(object):
+    """Turns likelihood summaries into tensors, once, so that the likelihood of a
+    batch of summaries is a few gathers and scatters.
+    A grammar network outputs, for each input, rows x G log production weights:
+    one row per (parent, argument index) context for contextual networks
+    (library, as in ContextualGrammarNetwork), a single row otherwise.
+    A summary becomes
+      uses: flat indices into the rows x G weights, and their counts;
+      normalizers: a row, the ID of a set of alternatives, and a count, where
+        the IDs index the table of every set of alternatives seen so far;
+      constant.
+    The result is kept on the summary, tagged with this compiler's token."""
+
+    def __init__(self, grammar, library=None, rows=1):
+        self.token = os.urandom(16)
+        self.library = library
+        self.rows = rows
+        self.G = len(grammar) + 1
+        self.column = {p: c for c, p in enumerate(grammar.primitives)}
+        self.column[Index(0)] = self.G - 1
+        # set of alternatives -> its ID
+        self.normalizerTable = {}
+        # normalizer ID x G, 0 for the alternatives and -inf elsewhere
+        self.mask = torch.zeros(0, self.G)
+
+    def contexts(self, summary):
+        if self.library is None:
+            return [(0, summary)]
+        if hasattr(summary, 'rows'):
+            # ContextualGrammarMatrix.LS, which has the layout of the networks
+            return list(summary.rows.items())
+        return [(self.rows - 1, summary.noParent), (self.rows - 2, summary.variableParent)] + \
+            [(g, s)
+             for e, ss in summary.library.items()
+             for g, s in zip(self.library[e], ss)]
+
+    def normalizerID(self, alternatives):
+        i = self.normalizerTable.get(alternatives)
+        if i is None:
+            i = self.normalizerTable[alternatives] = len(self.normalizerTable)
+            row = torch.full((1, self.G), NEGATIVEINFINITY)
+            row[0, [self.column[p] for p in alternatives if p in self.column]] = 0.
+            self.mask = torch.cat([self.mask, row])
+        return i
+
+    def compile(self, summary):
+        compiled = getattr(summary, "compiled", None)
+        if compiled is not None and compiled.token == self.token:
+            return compiled
+        useIndices, useCounts = [], []
+        normalizerRows, normalizerIDs, normalizerCounts = [], [], []
+        constant = 0.
+        for row, s in self.contexts(summary):
+            constant += s.constant
+            for p, count in s.uses.items():
+                if p in self.column:
+                    useIndices.append(row * self.G + self.column[p])
+                    useCounts.append(count)
+            for alternatives, count in s.normalizers.items():
+                normalizerRows.append(row)
+                normalizerIDs.append(self.normalizerID(alternatives))
+                normalizerCounts.append(count)
+        summary.compiled = CompiledSummary(self.token,
+                                           torch.tensor(useIndices, dtype=torch.long),
+                                           torch.tensor(useCounts, dtype=torch.float),
+                                           torch.tensor(normalizerRows, dtype=torch.long),
+                                           torch.tensor(normalizerIDs, dtype=torch.long),
+                                           torch.tensor(normalizerCounts, dtype=torch.float),
+                                           constant)
+        return summary.compiled
+
+    def logLikelihoods(self, logProductions, summaries):
+        """logProductions: B x rows x G (or B x G) log production weights;
+        returns the B-dimensional vector of the log likelihoods of the summaries"""
+        B = len(summaries)
+        device = logProductions.device
+        logProductions = logProductions.reshape(B, self.rows, self.G)
+        compiled = [self.compile(s) for s in summaries]
+        batch = torch.arange(B, device=device)
+
+        useIndices = torch.cat([c.useIndices for c in compiled]).to(device)
+        useCounts = torch.cat([c.useCounts for c in compiled]).to(device)
+        useOwners = batch.repeat_interleave(torch.tensor([len(c.useIndices) for c in compiled], device=device))
+        numerator = torch.zeros(B, device=device).index_add(
+            0, useOwners, logProductions.reshape(B, -1)[useOwners, useIndices] * useCounts)
+        numerator = numerator + torch.tensor([c.constant for c in compiled], device=device).float()
+
+        normalizerRows = torch.cat([c.normalizerRows for c in compiled]).to(device)
+        normalizerIDs = torch.cat([c.normalizerIDs for c in compiled]).to(device)
+        normalizerCounts = torch.cat([c.normalizerCounts for c in compiled]).to(device)
+        normalizerOwners = batch.repeat_interleave(torch.tensor([len(c.normalizerRows) for c in compiled],
+                                                                device=device))
+        z = torch.logsumexp(logProductions[normalizerOwners, normalizerRows] +
+                            self.mask.to(device)[normalizerIDs], 1)
+        denominator = torch.zeros(B, device=device).index_add(0, normalizerOwners, z * normalizerCounts)
+        return numerator - denominator
+
+
 class GrammarNetwork(nn.Module):
     """Neural network that outputs a grammar"""
     def __init__(self, inputDimensionality, grammar):
@@ -82,52 +215,25 @@ class GrammarNetwork(nn.Module):
                         for k, (_, t, program) in enumerate(self.grammar.productions)],
                        continuationType=self.grammar.continuationType)
 
+    @property
+    def summaryCompiler(self):
+        if getattr(self, "_summaryCompiler", None) is None:
+            self._summaryCompiler = LikelihoodSummaryCompiler(self.grammar)
+        return self._summaryCompiler
+
     def batchedLogLikelihoods(self, xs, summaries):
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
+        assert len(summaries) == xs.size(0)
+        return self.summaryCompiler.logLikelihoods(self.logProductions(xs), summaries)
 
-        B = xs.size(0)
-        assert len(summaries) == B
-        logProductions = self.logProductions(xs)
+    def logProductionTable(self, xs):
+        """B x G log production weights for a batch of inputs"""
+        return self.logProductions(xs)
 
-        # uses[b][p] is # uses of primitive p by summary b
-        uses = np.zeros((B,len(self.grammar) + 1))
-        for b,summary in enumerate(summaries):
-            for p, production in enumerate(self.grammar.primitives):
-                uses[b,p] = summary.uses.get(production, 0.)
-            uses[b,len(self.grammar)] = summary.uses.get(Index(0), 0)
-
-        numerator = (logProductions * maybe_cuda(torch.from_numpy(uses).float(),use_cuda)).sum(1)
-        numerator += maybe_cuda(torch.tensor([summary.constant for summary in summaries ]).float(), use_cuda)
-
-        alternativeSet = {normalizer
-                          for s in summaries
-                          for normalizer in s.normalizers }
-        alternativeSet = list(alternativeSet)
-
-        mask = np.zeros((len(alternativeSet), len(self.grammar) + 1))
-        for tau in range(len(alternativeSet)):
-            for p, production in enumerate(self.grammar.primitives):
-                mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-            mask[tau,len(self.grammar)] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-        mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-        # mask: Rx|G|
-        # logProductions: Bx|G|
-        # Want: mask + logProductions : BxRx|G| = z
-        z = mask.repeat(B,1,1) + logProductions.repeat(len(alternativeSet),1,1).transpose(1,0)
-        # z: BxR
-        z = torch.logsumexp(z, 2) # pytorch 1.0 dependency
-
-        # Calculate how many times each normalizer was used
-        N = np.zeros((B, len(alternativeSet)))
-        for b, summary in enumerate(summaries):
-            for tau, alternatives in enumerate(alternativeSet):
-                N[b, tau] = summary.normalizers.get(alternatives,0.)
-
-        denominator = (maybe_cuda(torch.tensor(N).float(),use_cuda) * z).sum(1)
-        return numerator - denominator
+    def grammarOfTable(self, table):
+        """The (untorched) Grammar of one row of logProductionTable, as a list of floats"""
+        return self.grammar.withLogProductions(table)
 
         
 
@@ -142,34 +248,16 @@ class ContextualGrammarNetwork_LowRank(nn.Module):
 
         self.R = R # embedding size
 
-        # library now just contains a list of indicies which go with each primitive
+        # library maps each primitive to the rows of its arguments, and there are two more rows:
+        # for when there is no parent and for when the parent is a variable
         self.grammar = grammar
-        self.library = {}
-        self.n_grammars = 0
-        for prim in grammar.primitives:
-            numberOfArguments = len(prim.infer().functionArguments())
-            idx_list = list(range(self.n_grammars, self.n_grammars+numberOfArguments))
-            self.library[prim] = idx_list
-            self.n_grammars += numberOfArguments
-        
-        # We had an extra grammar for when there is no parent and for when the parent is a variable
-        self.n_grammars += 2
+        self.library, self.n_grammars = ContextualGrammarMatrix.parentSlots(grammar)
         self.transitionMatrix = LowRank(inputDimensionality, self.n_grammars, len(grammar) + 1, R)
         
-    def grammarFromVector(self, logProductions):
-        return Grammar(logProductions[-1].view(1),
-                       [(logProductions[k].view(1), t, program)
-                        for k, (_, t, program) in enumerate(self.grammar.productions)],
-                       continuationType=self.grammar.continuationType)
-
     def forward(self, x):
         assert len(x.size()) == 1, "contextual grammar doesn't currently support batching"
 
-        transitionMatrix = self.transitionMatrix(x)
-        
-        return ContextualGrammar(self.grammarFromVector(transitionMatrix[-1]), self.grammarFromVector(transitionMatrix[-2]),
-                {prim: [self.grammarFromVector(transitionMatrix[j]) for j in js]
-                 for prim, js in self.library.items()} )
+        return ContextualGrammarMatrix(self.grammar, self.transitionMatrix(x), self.library)
         
     def vectorizedLogLikelihoods(self, x, summaries):
         B = len(summaries)
@@ -253,101 +341,25 @@ class ContextualGrammarNetwork_LowRank(nn.Module):
         assert False, "This function is still in progress."
         
 
+    @property
+    def summaryCompiler(self):
+        if getattr(self, "_summaryCompiler", None) is None:
+            self._summaryCompiler = LikelihoodSummaryCompiler(self.grammar, self.library, self.n_grammars)
+        return self._summaryCompiler
+
     def batchedLogLikelihoods(self, xs, summaries):
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
-        
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
+        assert len(summaries) == xs.shape[0]
+        return self.summaryCompiler.logLikelihoods(self.transitionMatrix(xs), summaries)
 
-        # logProductions: Bx n_grammars x G
-        logProductions = self.transitionMatrix(xs)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
+    def logProductionTable(self, xs):
+        """B x n_grammars x G log production weights for a batch of inputs"""
+        return self.transitionMatrix(xs)
 
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-        
-        if True:
-
-            # Calculate the god-awful denominator
-            alternativeSet = set()
-            for summary in summaries:
-                for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-                for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-                for ss in summary.library.values():
-                    for s in ss:
-                        for normalizer in s.normalizers: alternativeSet.add(normalizer)
-            alternativeSet = list(alternativeSet)
-
-            mask = np.zeros((len(alternativeSet), G))
-            for tau in range(len(alternativeSet)):
-                for p, production in enumerate(self.grammar.primitives):
-                    mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-                mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-            mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-            z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-                logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-            z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-            N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-            for b, summary in enumerate(summaries):
-                for e, ss in summary.library.items():
-                    for g,s in zip(self.library[e], ss):
-                        assert g < self.n_grammars - 2
-                        for r, alternatives in enumerate(alternativeSet):                
-                            N[b,g,r] = s.normalizers.get(alternatives, 0.)
-                # noParent: this is the last network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-                # variableParent: this is the penultimate network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-            N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-            denominator = (N*z).sum(1).sum(1)
-        else:
-            gs = [ self(xs[b]) for b in range(B) ]
-            denominator = torch.cat([ summary.denominator(g) for summary,g in zip(summaries, gs) ])
-            
-            
-
-        
-        
-        ll = numerator - denominator 
-
-        if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
-            _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
-            assert torch.all((ll - _l).abs() < 0.0001)
-        return ll
+    def grammarOfTable(self, table):
+        """The (untorched) ContextualGrammarMatrix of one entry of logProductionTable, as lists of floats"""
+        return ContextualGrammarMatrix(self.grammar, table, self.library)
     
 class ContextualGrammarNetwork_Mask(nn.Module):
     def __init__(self, inputDimensionality, grammar):
@@ -359,18 +371,10 @@ class ContextualGrammarNetwork_Mask(nn.Module):
 
         self.grammar = grammar
 
-        # library now just contains a list of indicies which go with each primitive
+        # library maps each primitive to the rows of its arguments, and there are two more rows:
+        # for when there is no parent and for when the parent is a variable
         self.grammar = grammar
-        self.library = {}
-        self.n_grammars = 0
-        for prim in grammar.primitives:
-            numberOfArguments = len(prim.infer().functionArguments())
-            idx_list = list(range(self.n_grammars, self.n_grammars+numberOfArguments))
-            self.library[prim] = idx_list
-            self.n_grammars += numberOfArguments
-        
-        # We had an extra grammar for when there is no parent and for when the parent is a variable
-        self.n_grammars += 2
+        self.library, self.n_grammars = ContextualGrammarMatrix.parentSlots(grammar)
         self._transitionMatrix = nn.Parameter(nn.init.xavier_uniform(torch.Tensor(self.n_grammars, len(grammar) + 1)))
         self._logProductions = nn.Linear(inputDimensionality, len(grammar)+1)
 
@@ -383,116 +387,30 @@ class ContextualGrammarNetwork_Mask(nn.Module):
         else:
             assert False, "unknown shape for transition matrix input"
         
-    def grammarFromVector(self, logProductions):
-        return Grammar(logProductions[-1].view(1),
-                       [(logProductions[k].view(1), t, program)
-                        for k, (_, t, program) in enumerate(self.grammar.productions)],
-                       continuationType=self.grammar.continuationType)
-
     def forward(self, x):
         assert len(x.size()) == 1, "contextual grammar doesn't currently support batching"
 
-        transitionMatrix = self.transitionMatrix(x)
-        
-        return ContextualGrammar(self.grammarFromVector(transitionMatrix[-1]), self.grammarFromVector(transitionMatrix[-2]),
-                {prim: [self.grammarFromVector(transitionMatrix[j]) for j in js]
-                 for prim, js in self.library.items()} )
+        return ContextualGrammarMatrix(self.grammar, self.transitionMatrix(x), self.library)
         
+    @property
+    def summaryCompiler(self):
+        if getattr(self, "_summaryCompiler", None) is None:
+            self._summaryCompiler = LikelihoodSummaryCompiler(self.grammar, self.library, self.n_grammars)
+        return self._summaryCompiler
+
     def batchedLogLikelihoods(self, xs, summaries):
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
-        
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
-
-        # logProductions: Bx n_grammars x G
-        logProductions = self.transitionMatrix(xs)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-        
-        if True:
-
-            # Calculate the god-awful denominator
-            alternativeSet = set()
-            for summary in summaries:
-                for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-                for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-                for ss in summary.library.values():
-                    for s in ss:
-                        for normalizer in s.normalizers: alternativeSet.add(normalizer)
-            alternativeSet = list(alternativeSet)
-
-            mask = np.zeros((len(alternativeSet), G))
-            for tau in range(len(alternativeSet)):
-                for p, production in enumerate(self.grammar.primitives):
-                    mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-                mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-            mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-            z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-                logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-            z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-            N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-            for b, summary in enumerate(summaries):
-                for e, ss in summary.library.items():
-                    for g,s in zip(self.library[e], ss):
-                        assert g < self.n_grammars - 2
-                        for r, alternatives in enumerate(alternativeSet):                
-                            N[b,g,r] = s.normalizers.get(alternatives, 0.)
-                # noParent: this is the last network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-                # variableParent: this is the penultimate network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-            N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-            denominator = (N*z).sum(1).sum(1)
-        else:
-            gs = [ self(xs[b]) for b in range(B) ]
-            denominator = torch.cat([ summary.denominator(g) for summary,g in zip(summaries, gs) ])
-            
-            
+        assert len(summaries) == xs.shape[0]
+        return self.summaryCompiler.logLikelihoods(self.transitionMatrix(xs), summaries)
 
-        
-        
-        ll = numerator - denominator
+    def logProductionTable(self, xs):
+        """B x n_grammars x G log production weights for a batch of inputs"""
+        return self.transitionMatrix(xs)
 
-        if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
-            _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
-            assert torch.all((ll - _l).abs() < 0.0001)
-        return ll
+    def grammarOfTable(self, table):
+        """The (untorched) ContextualGrammarMatrix of one entry of logProductionTable, as lists of floats"""
+        return ContextualGrammarMatrix(self.grammar, table, self.library)
         
                 
 
@@ -501,124 +419,37 @@ class ContextualGrammarNetwork(nn.Module):
     def __init__(self, inputDimensionality, grammar):
         super(ContextualGrammarNetwork, self).__init__()
         
-        # library now just contains a list of indicies which go with each primitive
+        # library maps each primitive to the rows of its arguments, and there are two more rows:
+        # for when there is no parent and for when the parent is a variable
         self.grammar = grammar
-        self.library = {}
-        self.n_grammars = 0
-        for prim in grammar.primitives:
-            numberOfArguments = len(prim.infer().functionArguments())
-            idx_list = list(range(self.n_grammars, self.n_grammars+numberOfArguments))
-            self.library[prim] = idx_list
-            self.n_grammars += numberOfArguments
-        
-        # We had an extra grammar for when there is no parent and for when the parent is a variable
-        self.n_grammars += 2
+        self.library, self.n_grammars = ContextualGrammarMatrix.parentSlots(grammar)
         self.network = nn.Linear(inputDimensionality, (self.n_grammars)*(len(grammar) + 1))
 
 
-    def grammarFromVector(self, logProductions):
-        return Grammar(logProductions[-1].view(1),
-                       [(logProductions[k].view(1), t, program)
-                        for k, (_, t, program) in enumerate(self.grammar.productions)],
-                       continuationType=self.grammar.continuationType)
-
     def forward(self, x):
         assert len(x.size()) == 1, "contextual grammar doesn't currently support batching"
 
-        allVars = self.network(x).view(self.n_grammars, -1)
-        return ContextualGrammar(self.grammarFromVector(allVars[-1]), self.grammarFromVector(allVars[-2]),
-                {prim: [self.grammarFromVector(allVars[j]) for j in js]
-                 for prim, js in self.library.items()} )
+        return ContextualGrammarMatrix(self.grammar, self.network(x).view(self.n_grammars, -1), self.library)
+
+    @property
+    def summaryCompiler(self):
+        if getattr(self, "_summaryCompiler", None) is None:
+            self._summaryCompiler = LikelihoodSummaryCompiler(self.grammar, self.library, self.n_grammars)
+        return self._summaryCompiler
 
     def batchedLogLikelihoods(self, xs, summaries):
-        use_cuda = xs.device.type == 'cuda'
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
+        assert len(summaries) == xs.shape[0]
+        return self.summaryCompiler.logLikelihoods(self.network(xs), summaries)
 
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
-
-        # logProductions: Bx n_grammars x G
-        logProductions = self.network(xs).view(B, self.n_grammars, G)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-
-        # Calculate the god-awful denominator
-        alternativeSet = set()
-        for summary in summaries:
-            for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-            for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-            for ss in summary.library.values():
-                for s in ss:
-                    for normalizer in s.normalizers: alternativeSet.add(normalizer)
-        alternativeSet = list(alternativeSet)
-
-        mask = np.zeros((len(alternativeSet), G))
-        for tau in range(len(alternativeSet)):
-            for p, production in enumerate(self.grammar.primitives):
-                mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-            mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-        mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-        z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-            logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-        z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-        N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-        for b, summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for r, alternatives in enumerate(alternativeSet):                
-                        N[b,g,r] = s.normalizers.get(alternatives, 0.)
-            # noParent: this is the last network output
-            for r, alternatives in enumerate(alternativeSet):
-                N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-            # variableParent: this is the penultimate network output
-            for r, alternatives in enumerate(alternativeSet):
-                N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-        N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-        
-
-        
-        denominator = (N*z).sum(1).sum(1)
-        ll = numerator - denominator
-
-        if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
-            _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
-            assert torch.all((ll - _l).abs() < 0.0001)
+    def logProductionTable(self, xs):
+        """B x n_grammars x G log production weights for a batch of inputs"""
+        return self.network(xs).view(xs.size(0), self.n_grammars, -1)
 
-        return ll
+    def grammarOfTable(self, table):
+        """The (untorched) ContextualGrammarMatrix of one entry of logProductionTable, as lists of floats"""
+        return ContextualGrammarMatrix(self.grammar, table, self.library)
         
 
 class RecognitionModel(nn.Module):
@@ -672,7 +503,7 @@ class RecognitionModel(nn.Module):
         else:
             self.grammarBuilder = GrammarNetwork(self.outputDimensionality, grammar)
         
-        self.grammar = ContextualGrammar.fromGrammar(grammar) if contextual else grammar
+        self.grammar = ContextualGrammarMatrix.fromGrammar(grammar) if contextual else grammar
         self.generativeModel = grammar
         
         self._auxiliaryPrediction = nn.Linear(self.featureExtractor.outputDimensionality, 
@@ -684,14 +515,48 @@ class RecognitionModel(nn.Module):
         if previousRecognitionModel:
             self._MLP.load_state_dict(previousRecognitionModel._MLP.state_dict())
             self.featureExtractor.load_state_dict(previousRecognitionModel.featureExtractor.state_dict())
+
+        # Bumped whenever the parameters change; see taskOutputs
+        self.parameterVersion = 0
+        # (parameterVersion, task name) -> RecognitionOutput
+        self.outputCache = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["outputCache"] = {}
+        return state
+
+    def forgetOutputs(self):
+        """Call when the parameters change, so that taskOutputs recomputes everything"""
+        self.parameterVersion = getattr(self, "parameterVersion", 0) + 1
+        self.outputCache = {}
+
+    def watchOptimizer(self, optimizer):
+        """Makes every step of optimizer call forgetOutputs"""
+        step = optimizer.step
+        def stepAndForget(*arguments, **keywords):
+            result = step(*arguments, **keywords)
+            self.forgetOutputs()
+            return result
+        optimizer.step = stepAndForget
+        return optimizer
             
     def auxiliaryLoss(self, frontier, features):
+        return self._auxiliaryLoss(self._auxiliaryPrediction(features),
+                                   self.auxiliaryTargets(frontier))
+
+    def auxiliaryTargets(self, frontier):
         # Compute a vector of uses
         ls = frontier.bestPosterior.program
         def uses(summary):
             if hasattr(summary, 'uses'): 
                 return torch.tensor([ float(int(p in summary.uses))
                                       for p in self.generativeModel.primitives ])
+            if hasattr(summary, 'rows'):
+                u = torch.zeros(len(self.generativeModel.primitives))
+                for s in summary.rows.values():
+                    u += uses(s)
+                return u
             assert hasattr(summary, 'noParent')
             u = uses(summary.noParent) + uses(summary.variableParent)
             for ss in summary.library.values():
@@ -701,8 +566,7 @@ class RecognitionModel(nn.Module):
         u = uses(ls)
         u[u > 1.] = 1.
         if self.use_cuda: u = u.cuda()
-        al = self._auxiliaryLoss(self._auxiliaryPrediction(features), u)
-        return al
+        return u
             
     def taskEmbeddings(self, tasks):
         return {task: self.featureExtractor.featuresOfTask(task).data.cpu().numpy()
@@ -725,6 +589,45 @@ class RecognitionModel(nn.Module):
         if features is None: return None
         return self(features)
 
+    def grammarsOfTasks(self, tasks):
+        """{task: grammarOfTask(task).untorch()}, leaving out the tasks without
+        features, but running the network on many tasks at once"""
+        return {t: o.grammar for t, o in self.taskOutputs(tasks).items()}
+
+    def taskOutputs(self, tasks):
+        """{task: RecognitionOutput}, leaving out the tasks without features.
+        Outputs are remembered by task name until the parameters change, so the
+        network runs once per task however many metrics are collected."""
+        if getattr(self, "outputCache", None) is None: self.forgetOutputs()
+        outputs = {}
+        missing = []
+        for t in tasks:
+            o = self.outputCache.get((self.parameterVersion, t.name))
+            if o is None: missing.append(t)
+            else: outputs[t] = o
+        for start in range(0, len(missing), INFERENCEBATCHSIZE):
+            batch = missing[start:start + INFERENCEBATCHSIZE]
+            with torch.no_grad():
+                features = featuresOfTasks(self.featureExtractor, batch)
+                batch = [t for t, x in zip(batch, features) if x is not None]
+                if not batch: continue
+                features = torch.stack([x for x in features if x is not None])
+                hidden = self._MLP(features)
+                table = self.grammarBuilder.logProductionTable(hidden)
+                logProductions = table.reshape(len(batch), -1)
+                entropies = -(F.softmax(logProductions, dim=1) *
+                              F.log_softmax(logProductions, dim=1)).sum(1)
+                auxiliary = self._auxiliaryPrediction(features)
+                hidden, logProductions, entropies, auxiliary = \
+                    [x.cpu().numpy() for x in [hidden, logProductions, entropies, auxiliary]]
+                table = table.cpu().tolist()
+            for j, t in enumerate(batch):
+                o = RecognitionOutput(hidden[j], logProductions[j], entropies[j], auxiliary[j],
+                                      self.grammarBuilder.grammarOfTable(table[j]))
+                self.outputCache[(self.parameterVersion, t.name)] = o
+                outputs[t] = o
+        return outputs
+
     def grammarLogProductionsOfTask(self, task):
         """Returns the grammar logits from non-contextual models."""
 
@@ -780,29 +683,23 @@ class RecognitionModel(nn.Module):
             return e(grammarLogProductionsOfTask)
 
     def taskAuxiliaryLossLayer(self, tasks):
-        return {task: self._auxiliaryPrediction(self.featureExtractor.featuresOfTask(task)).view(-1).data.cpu().numpy()
-                for task in tasks}
+        return {task: o.auxiliary for task, o in self.taskOutputs(tasks).items()}
                 
     def taskGrammarFeatureLogProductions(self, tasks):
-        return {task: self.grammarFeatureLogProductionsOfTask(task).data.cpu().numpy()
-                for task in tasks}
+        return {task: np.array(o.grammar.featureVector()) for task, o in self.taskOutputs(tasks).items()}
 
     def taskGrammarLogProductions(self, tasks):
-        return {task: self.grammarLogProductionsOfTask(task).data.cpu().numpy()
-                for task in tasks}
+        return {task: o.logProductions for task, o in self.taskOutputs(tasks).items()}
 
     def taskGrammarStartProductions(self, tasks):
-        return {task: np.array([l for l,_1,_2 in g.productions ])
-                for task in tasks
-                for g in [self.grammarOfTask(task).untorch().noParent] }
+        return {task: np.array([l for l,_1,_2 in o.grammar.noParent.productions ])
+                for task, o in self.taskOutputs(tasks).items()}
 
     def taskHiddenStates(self, tasks):
-        return {task: self._MLP(self.featureExtractor.featuresOfTask(task)).view(-1).data.cpu().numpy()
-                for task in tasks}
+        return {task: o.hidden for task, o in self.taskOutputs(tasks).items()}
 
     def taskGrammarEntropies(self, tasks):
-        return {task: self.grammarEntropyOfTask(task).data.cpu().numpy()
-                for task in tasks}
+        return {task: o.entropy for task, o in self.taskOutputs(tasks).items()}
 
     def frontierKL(self, frontier, auxiliary=False, vectorized=True):
         features = self.featureExtractor.featuresOfTask(frontier.task)
@@ -847,6 +744,49 @@ class RecognitionModel(nn.Module):
         ml = -lls.max() #Beware that inputs to max change output type
         return ml, al
 
+    def minibatchLoss(self, frontiers, biasOptimal, auxiliary=False):
+        """frontierKL or frontierBiasOptimal for many frontiers at once, in one
+        forward pass through the MLP and the grammar network.
+        Frontiers whose features cannot be extracted are dropped. Returns the
+        mean of the valid losses (None if there are none), the auxiliary loss,
+        the frontiers that were kept and a vector of their losses."""
+        if hasattr(self.featureExtractor, 'featuresOfTasks'):
+            features = list(self.featureExtractor.featuresOfTasks([f.task for f in frontiers]))
+        else:
+            features = [self.featureExtractor.featuresOfTask(f.task) for f in frontiers]
+        frontiers = [f for f, x in zip(frontiers, features) if x is not None]
+        features = [x for x in features if x is not None]
+        if not frontiers:
+            return None, None, [], None
+        features = torch.stack(features)
+
+        targets = torch.stack([self.auxiliaryTargets(f) for f in frontiers])
+        al = self._auxiliaryLoss(self._auxiliaryPrediction(features if auxiliary else features.detach()),
+                                 targets)
+
+        hidden = self._MLP(features)
+        if biasOptimal:
+            # One row per entry of every frontier, then the best entry of each frontier
+            owners = [b for b, f in enumerate(frontiers) for _ in f]
+            positions = [k for f in frontiers for k in range(len(f))]
+            owners = torch.tensor(owners, device=hidden.device)
+            lls = self.grammarBuilder.batchedLogLikelihoods(hidden[owners],
+                                                            [e.program for f in frontiers for e in f])
+            lls = lls + torch.tensor([e.logLikelihood for f in frontiers for e in f],
+                                     device=hidden.device).float()
+            table = lls.new_full((len(frontiers), max(len(f) for f in frontiers)), NEGATIVEINFINITY)
+            table = table.index_put((owners, torch.tensor(positions, device=hidden.device)), lls)
+            losses = -table.max(1)[0]
+        else:
+            # Monte Carlo estimate: draw a sample from each frontier
+            losses = -self.grammarBuilder.batchedLogLikelihoods(hidden,
+                                                                [f.sample().program for f in frontiers])
+
+        valid = torch.isfinite(losses)
+        if not valid.any():
+            return None, al, frontiers, losses
+        return losses[valid].mean(), al, frontiers, losses
+
     def replaceProgramsWithLikelihoodSummaries(self, frontier):
         return Frontier(
             [FrontierEntry(
@@ -858,12 +798,31 @@ class RecognitionModel(nn.Module):
     def train(self, frontiers, _=None, steps=None, lr=0.001, topK=5, CPUs=1,
               timeout=None, evaluationTimeout=0.001,
               helmholtzFrontiers=[], helmholtzRatio=0., helmholtzBatch=500,
-              biasOptimal=None, defaultRequest=None, auxLoss=False, vectorized=True):
+              biasOptimal=None, defaultRequest=None, auxLoss=False, vectorized=True,
+              batchSize=1, dreamStore=None, dataParallel=1, distributed=None):
         """
         helmholtzRatio: What fraction of the training data should be forward samples from the generative model?
         helmholtzFrontiers: Frontiers from programs enumerated from generative model (optional)
         If helmholtzFrontiers is not provided then we will sample programs during training
+        batchSize: How many frontiers go into each gradient step (see minibatchLoss)
+        dreamStore: DreamStore that sampled dreams are kept in and reused from (optional)
+        dataParallel: How many processes train the model together (see trainDataParallel)
+        distributed: (rank, number of processes, seed) of this process; set by trainDataParallel
         """
+        if dataParallel > 1 and distributed is None:
+            import multiprocessing
+            if multiprocessing.current_process().daemon:
+                eprint("(ID=%d): Cannot fork data parallel workers from a daemonic process, training in one process" % self.id)
+            else:
+                return self.trainDataParallel(dataParallel, frontiers, steps=steps, lr=lr, topK=topK, CPUs=CPUs,
+                                              timeout=timeout, evaluationTimeout=evaluationTimeout,
+                                              helmholtzFrontiers=helmholtzFrontiers, helmholtzRatio=helmholtzRatio,
+                                              helmholtzBatch=helmholtzBatch, biasOptimal=biasOptimal,
+                                              defaultRequest=defaultRequest, auxLoss=auxLoss, vectorized=vectorized,
+                                              batchSize=batchSize, dreamStore=dreamStore)
+        rank, processes, seed = distributed or (0, 1, None)
+        assert batchSize == 1 or vectorized, "Minibatch training needs vectorized=True"
+        assert distributed is None or vectorized, "Data parallel training needs vectorized=True"
         assert (steps is not None) or (timeout is not None), \
             "Cannot train recognition model without either a bound on the number of gradient steps or bound on the training time"
         if steps is None: steps = 9999999
@@ -918,15 +877,13 @@ class RecognitionModel(nn.Module):
                               for f in helmholtzFrontiers]
         random.shuffle(helmholtzFrontiers)
         
+        producer = HelmholtzProducer(self, requests, CPUs=CPUs, batch=helmholtzBatch, store=dreamStore) \
+                   if randomHelmholtz else None
+
         helmholtzIndex = [0]
         def getHelmholtz():
             if randomHelmholtz:
-                if helmholtzIndex[0] >= len(helmholtzFrontiers):
-                    updateHelmholtzTasks()
-                    helmholtzIndex[0] = 0
-                    return getHelmholtz()
-                helmholtzIndex[0] += 1
-                return helmholtzFrontiers[helmholtzIndex[0] - 1].makeFrontier()
+                return producer.get()
 
             f = helmholtzFrontiers[helmholtzIndex[0]]
             if f.task is None:
@@ -950,17 +907,6 @@ class RecognitionModel(nn.Module):
             if updateCPUs > 1: eprint("Updating Helmholtz tasks with",updateCPUs,"CPUs",
                                       "while using",getThisMemoryUsage(),"memory")
             
-            if randomHelmholtz:
-                newFrontiers = self.sampleManyHelmholtz(requests, helmholtzBatch, CPUs)
-                newEntries = []
-                for f in newFrontiers:
-                    e = HelmholtzEntry(f,self)
-                    e.task = f.task
-                    newEntries.append(e)
-                helmholtzFrontiers.clear()
-                helmholtzFrontiers.extend(newEntries)
-                return 
-
             # Save some memory by freeing up the tasks as we go through them
             if self.featureExtractor.recomputeTasks:
                 for hi in range(max(0, helmholtzIndex[0] - helmholtzBatch,
@@ -1015,14 +961,15 @@ class RecognitionModel(nn.Module):
         # Should only affect performance and shouldn't affect anything else
         helmholtzSamples = []
 
-        optimizer = torch.optim.Adam(self.parameters(), lr=lr, eps=1e-3, amsgrad=True)
+        optimizer = self.watchOptimizer(torch.optim.Adam(self.parameters(), lr=lr, eps=1e-3, amsgrad=True))
         start = time.time()
         losses, descriptionLengths, realLosses, dreamLosses, realMDL, dreamMDL = [], [], [], [], [], []
         classificationLosses = []
         totalGradientSteps = 0
+        totalFrontiers = 0
         epochs = 9999999
         for i in range(1, epochs + 1):
-            if timeout and time.time() - start > timeout:
+            if timeout and anyProcess(time.time() - start > timeout, distributed):
                 break
 
             if totalGradientSteps > steps:
@@ -1030,9 +977,64 @@ class RecognitionModel(nn.Module):
 
             if helmholtzRatio < 1.:
                 permutedFrontiers = list(frontiers)
-                random.shuffle(permutedFrontiers)
+                if distributed:
+                    # Every process shuffles the same way, then takes its own equal share
+                    random.Random(seed + i).shuffle(permutedFrontiers)
+                    permutedFrontiers += permutedFrontiers[:(-len(permutedFrontiers)) % processes]
+                    permutedFrontiers = permutedFrontiers[rank::processes]
+                else:
+                    random.shuffle(permutedFrontiers)
             else:
-                permutedFrontiers = [None]
+                permutedFrontiers = [None] * batchSize
+
+            if batchSize > 1 or distributed:
+                for b in range(0, len(permutedFrontiers), batchSize):
+                    # Randomly decide, for each slot, whether to sample from the generative model
+                    batch = [(True, getHelmholtz()) if random.random() < helmholtzRatio else (False, f)
+                             for f in permutedFrontiers[b:b + batchSize]]
+                    self.zero_grad()
+                    loss, classificationLoss, used, frontierLosses = \
+                        self.minibatchLoss([f for _, f in batch], biasOptimal, auxiliary=auxLoss)
+                    usedIDs = {id(f) for f in used}
+                    if any(not dreaming and id(f) not in usedIDs for dreaming, f in batch):
+                        eprint("ERROR: Could not extract features during experience replay.")
+                        eprint("Tasks are:", [f.task for dreaming, f in batch
+                                              if not dreaming and id(f) not in usedIDs])
+                        eprint("Aborting - we need to be able to extract features of every actual task.")
+                        assert False
+                    if loss is None:
+                        if used: eprint("Invalid minibatch loss!")
+                        # The other processes may still have gradients to share
+                        if distributed and self.allReduceGradients(False):
+                            optimizer.step()
+                            totalGradientSteps += 1
+                            if totalGradientSteps > steps:
+                                break
+                        continue
+                    if len(frontierLosses) > frontierLosses.isfinite().sum():
+                        eprint("Invalid loss for %d frontiers of the minibatch!" %
+                               (len(frontierLosses) - int(frontierLosses.isfinite().sum())))
+                    (loss + classificationLoss).backward()
+                    if distributed: self.allReduceGradients(True)
+                    optimizer.step()
+                    totalGradientSteps += 1
+                    totalFrontiers += int(frontierLosses.isfinite().sum())
+                    classificationLosses.append(classificationLoss.data.item())
+                    dreamIDs = {id(f) for dreaming, f in batch if dreaming}
+                    for f, l in zip(used, frontierLosses.tolist()):
+                        if not math.isfinite(l): continue
+                        losses.append(l)
+                        descriptionLengths.append(min(-e.logPrior for e in f))
+                        if id(f) in dreamIDs:
+                            dreamLosses.append(l)
+                            dreamMDL.append(descriptionLengths[-1])
+                        else:
+                            realLosses.append(l)
+                            realMDL.append(descriptionLengths[-1])
+                    if totalGradientSteps > steps:
+                        break
+                # Everything was consumed in minibatches
+                permutedFrontiers = []
 
             finishedSteps = False
             for frontier in permutedFrontiers:
@@ -1058,6 +1060,7 @@ class RecognitionModel(nn.Module):
                     classificationLosses.append(classificationLoss.data.item())
                     optimizer.step()
                     totalGradientSteps += 1
+                    totalFrontiers += 1
                     losses.append(loss.data.item())
                     descriptionLengths.append(min(-e.logPrior for e in frontier))
                     if dreaming:
@@ -1069,24 +1072,92 @@ class RecognitionModel(nn.Module):
                     if totalGradientSteps > steps:
                         break # Stop iterating, then print epoch and loss, then break to finish.
                         
-            if (i == 1 or i % 10 == 0) and losses:
+            if (i == 1 or i % 10 == 0) and losses and rank == 0:
                 eprint("(ID=%d): " % self.id, "Epoch", i, "Loss", mean(losses))
                 if realLosses and dreamLosses:
                     eprint("(ID=%d): " % self.id, "\t\t(real loss): ", mean(realLosses), "\t(dream loss):", mean(dreamLosses))
                 eprint("(ID=%d): " % self.id, "\tvs MDL (w/o neural net)", mean(descriptionLengths))
                 if realMDL and dreamMDL:
                     eprint("\t\t(real MDL): ", mean(realMDL), "\t(dream MDL):", mean(dreamMDL))
-                eprint("(ID=%d): " % self.id, "\t%d cumulative gradient steps. %f steps/sec"%(totalGradientSteps,
-                                                                       totalGradientSteps/(time.time() - start)))
+                eprint("(ID=%d): " % self.id, "\t%d cumulative gradient steps. %f steps/sec, %f frontiers/sec"%(
+                    totalGradientSteps,
+                    totalGradientSteps/(time.time() - start),
+                    totalFrontiers/(time.time() - start)))
                 eprint("(ID=%d): " % self.id, "\t%d-way auxiliary classification loss"%len(self.grammar.primitives),sum(classificationLosses)/len(classificationLosses))
+                if producer is not None and producer.requested:
+                    dreams = producer.statistics()
+                    eprint("(ID=%d): " % self.id, "\t%f dreams/sec from %d workers, starved for %d%% of dreams" % (
+                        dreams["dreamsPerSecond"], dreams["workers"], int(100 * dreams["starvation"])))
                 losses, descriptionLengths, realLosses, dreamLosses, realMDL, dreamMDL = [], [], [], [], [], []
                 classificationLosses = []
                 gc.collect()
         
-        eprint("(ID=%d): " % self.id, " Trained recognition model in",time.time() - start,"seconds")
+        if producer is not None: producer.close()
+        eprint("(ID=%d): " % self.id, " Trained recognition model in",time.time() - start,"seconds",
+               "(%d gradient steps on %d frontiers, minibatches of %d)" % (totalGradientSteps, totalFrontiers, batchSize))
         self.trained=True
         return self
 
+    def trainDataParallel(self, processes, frontiers, **keywords):
+        """train, but in processes processes that each compute the gradient of their
+        own minibatches; the gradients are averaged with torch.distributed (gloo,
+        over localhost) before every step, so every process takes the same steps.
+        This process is the first of them, and ends up with the trained model;
+        its thread count and random states are put back afterwards.
+        Each process samples its own dreams, with CPUs // processes CPUs."""
+        import multiprocessing
+        import socket
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        seed = random.random()
+        CPUs = max(1, keywords.pop("CPUs", 1) // processes)
+        threads = max(1, torch.get_num_threads() // processes)
+        eprint("(ID=%d): Training in %d data parallel processes" % (self.id, processes))
+
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=dataParallelWorker,
+                                   args=(self, frontiers, keywords, rank, processes, port, seed, CPUs, threads))
+                   for rank in range(1, processes)]
+        for worker in workers:
+            worker.start()
+        previousThreads = torch.get_num_threads()
+        randomState = random.getstate()
+        torchState = torch.get_rng_state()
+        cudaStates = torch.cuda.get_rng_state_all() if torch.cuda.is_initialized() else None
+        try:
+            dataParallelWorker(self, frontiers, keywords, 0, processes, port, seed, CPUs, threads)
+        finally:
+            torch.set_num_threads(previousThreads)
+            random.setstate(randomState)
+            torch.set_rng_state(torchState)
+            if cudaStates is not None: torch.cuda.set_rng_state_all(cudaStates)
+            for worker in workers:
+                worker.join()
+        assert all(worker.exitcode == 0 for worker in workers), "A data parallel worker failed"
+        return self
+
+    def allReduceGradients(self, contributes):
+        """Averages the gradients over the processes that contributes; returns how many did.
+        The other processes must have zero (or no) gradients."""
+        import torch.distributed as dist
+        parameters = [p for p in self.parameters() if p.requires_grad]
+        flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).view(-1)
+                          for p in parameters] +
+                         [torch.tensor([float(contributes)], device=parameters[0].device)])
+        dist.all_reduce(flat)
+        contributors = int(flat[-1].item())
+        if contributors == 0: return 0
+        flat = flat[:-1] / contributors
+        offset = 0
+        for p in parameters:
+            g = flat[offset:offset + p.numel()].view_as(p)
+            if p.grad is None: p.grad = g.clone()
+            else: p.grad.copy_(g)
+            offset += p.numel()
+        return contributors
+
     def sampleHelmholtz(self, requests, statusUpdate=None, seed=None):
         if seed is not None:
             random.seed(seed)
@@ -1147,19 +1218,265 @@ class RecognitionModel(nn.Module):
                            CPUs=1,
                            frontierSize=None,
                            maximumFrontier=None,
-                           evaluationTimeout=None):
+                           evaluationTimeout=None,
+                           observationalEquivalence=False):
         with timing("Evaluated recognition model"):
-            grammars = {task: self.grammarOfTask(task)
-                        for task in tasks}
-            #untorch seperately to make sure you filter out None grammars
-            grammars = {task: grammar.untorch() for task, grammar in grammars.items() if grammar is not None}
+            grammars = self.grammarsOfTasks(list(tasks))
 
         return multicoreEnumeration(grammars, tasks,
                                     testing=testing,
                                     solver=solver,
                                     enumerationTimeout=enumerationTimeout,
                                     CPUs=CPUs, maximumFrontier=maximumFrontier,
-                                    evaluationTimeout=evaluationTimeout)
+                                    evaluationTimeout=evaluationTimeout,
+                                    observationalEquivalence=observationalEquivalence)
+
+
+    def exportInference(self, path):
+        """Saves an InferenceModel of this model to path, and returns it"""
+        model = InferenceModel(self)
+        with open(path, "wb") as handle:
+            dill.dump(model, handle)
+        eprint("(ID=%d): Exported inference model to %s" % (self.id, path))
+        return model
+
+
+def featuresOfTasks(featureExtractor, tasks):
+    """featureExtractor.featuresOfTask of each task, in one call when the extractor can batch"""
+    if hasattr(featureExtractor, 'featuresOfTasks'):
+        return list(featureExtractor.featuresOfTasks(tasks))
+    return [featureExtractor.featuresOfTask(t) for t in tasks]
+
+
+class InferenceNetwork(nn.Module):
+    """The layers of a RecognitionModel after its feature extractor: B x features -> logProductionTable"""
+    def __init__(self, model):
+        super(InferenceNetwork, self).__init__()
+        self._MLP = model._MLP
+        self.grammarBuilder = model.grammarBuilder
+
+    def forward(self, features):
+        return self.grammarBuilder.logProductionTable(self._MLP(features))
+
+
+class InferenceModel(object):
+    """What enumeration needs of a trained RecognitionModel: its feature extractor,
+    without gradients, and the rest of the network traced into a frozen TorchScript
+    graph. The feature extractor stays Python, because featurizing tokenizes
+    examples and looks at tasks. Pickles on its own, so evaluation jobs can load it
+    instead of the ECResult, and has the grammarsOfTasks and enumerateFrontiers of
+    RecognitionModel."""
+    def __init__(self, model):
+        # Not model.eval(), which would call RecognitionModel.train
+        model = copy.deepcopy(model).cpu()
+        self.id = model.id
+        self.grammar = model.grammarBuilder.grammar
+        # The parent slots of a contextual model, None otherwise
+        self.slots = getattr(model.grammarBuilder, "library", None)
+
+        self.featureExtractor = model.featureExtractor
+        if hasattr(self.featureExtractor, "eval"):
+            self.featureExtractor.eval()
+        if hasattr(self.featureExtractor, "parameters"):
+            for parameter in self.featureExtractor.parameters():
+                parameter.requires_grad_(False)
+
+        network = InferenceNetwork(model).eval()
+        with torch.no_grad():
+            network = torch.jit.trace(network, torch.zeros(2, model.featureExtractor.outputDimensionality))
+        if hasattr(torch.jit, "freeze"):
+            network = torch.jit.freeze(network)
+        if hasattr(torch.jit, "optimize_for_inference"):
+            network = torch.jit.optimize_for_inference(network)
+        self.network = network
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        buffer = io.BytesIO()
+        torch.jit.save(self.network, buffer)
+        state["network"] = buffer.getvalue()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.network = torch.jit.load(io.BytesIO(state["network"]))
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as handle:
+            return dill.load(handle)
+
+    def grammarOfTable(self, table):
+        if self.slots is None: return self.grammar.withLogProductions(table)
+        return ContextualGrammarMatrix(self.grammar, table, self.slots)
+
+    def grammarsOfTasks(self, tasks):
+        """{task: untorched grammar}, leaving out the tasks without features"""
+        grammars = {}
+        for start in range(0, len(tasks), INFERENCEBATCHSIZE):
+            batch = tasks[start:start + INFERENCEBATCHSIZE]
+            with torch.no_grad():
+                features = featuresOfTasks(self.featureExtractor, batch)
+                batch = [t for t, x in zip(batch, features) if x is not None]
+                if not batch: continue
+                table = self.network(torch.stack([x.cpu() for x in features if x is not None])).tolist()
+            for t, row in zip(batch, table):
+                grammars[t] = self.grammarOfTable(row)
+        return grammars
+
+    enumerateFrontiers = RecognitionModel.enumerateFrontiers
+
+
+def anyProcess(condition, distributed):
+    """Whether condition holds in any of the processes training together"""
+    if not distributed: return condition
+    import torch.distributed as dist
+    flag = torch.tensor([float(condition)])
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return flag.item() > 0
+
+
+def dataParallelWorker(model, frontiers, keywords, rank, processes, port, seed, CPUs, threads):
+    import torch.distributed as dist
+    random.seed(seed + rank)
+    torch.manual_seed(int(seed * 2**31) + rank)
+    torch.set_num_threads(threads)
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:%d" % port,
+                            rank=rank, world_size=processes)
+    try:
+        model.train(frontiers, CPUs=CPUs, distributed=(rank, processes, seed), **keywords)
+    finally:
+        dist.destroy_process_group()
+
+
+def rememberDream(store, model, f, summarized):
+    """Adds the dream to the store, if any; returns its summarized frontier"""
+    if store is not None:
+        store.bucket(model.generativeModel, f.task.request, SAMPLED).add(
+            f, summaries=(model.grammar.__class__.__name__, [e.program for e in summarized]))
+    return summarized
+
+
+def helmholtzWorker(model, requests, queue, seed, store=None):
+    random.seed(seed)
+    while True:
+        f = model.sampleHelmholtz(requests)
+        if f is not None:
+            # Stored here, so that the trainer only has to dequeue
+            summarized = rememberDream(store, model, f, model.replaceProgramsWithLikelihoodSummaries(f))
+            # Blocks while the queue is full
+            queue.put(summarized)
+
+
+class HelmholtzProducer(object):
+    """Dreams for RecognitionModel.train: frontiers of programs sampled from the
+    generative model, with tasks from the feature extractor and the programs
+    replaced by likelihood summaries.
+    With CPUs > 1, CPUs - 1 forked workers sample dreams ahead of the trainer,
+    at most prefetch of them. Worker k seeds itself with seed + k, so the members
+    of an ensemble, which draw different seeds, dream different things. When no
+    dream is ready, get hands back one of the last batch dreams instead of waiting.
+    Processes that cannot have children (the parallelMap workers that train
+    ensembles) and CPUs = 1 sample batch dreams at a time, as sampleManyHelmholtz.
+    With a DreamStore, new dreams are added to it (by the workers, if there are
+    any), and the dreams already there are used before sampling in the
+    foreground, or while waiting on the workers."""
+
+    def __init__(self, model, requests, CPUs=1, batch=500, prefetch=HELMHOLTZPREFETCH, seed=None,
+                 store=None):
+        import multiprocessing
+        self.model = model
+        self.requests = requests
+        self.batch = batch
+        self.prefetch = prefetch
+        self.seed = random.random() if seed is None else seed
+        self.store = store
+        self.workers = 0 if multiprocessing.current_process().daemon else CPUs - 1
+        self.processes = []
+        self.queue = None
+        self.pending = []
+        self.recent = []
+        self.produced = 0
+        self.starved = 0
+        self.requested = 0
+        self.startTime = None
+
+    def start(self):
+        import multiprocessing
+        self.startTime = time.time()
+        if self.store is not None:
+            self.pending = self.storedDreams()
+            random.shuffle(self.pending)
+            eprint("Loaded %d dreams from the dream store" % len(self.pending))
+        if self.workers < 1: return
+        # Stand in for the dreams that the workers have not made yet
+        self.recent, self.pending = self.pending, []
+        context = multiprocessing.get_context("fork")
+        self.queue = context.Queue(self.prefetch)
+        for k in range(self.workers):
+            process = context.Process(target=helmholtzWorker,
+                                      args=(self.model, self.requests, self.queue, self.seed + k,
+                                            self.store))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.queue is not None:
+            self.queue.close()
+            self.queue = None
+
+    def get(self):
+        import queue
+        if self.startTime is None: self.start()
+        self.requested += 1
+        if not self.processes:
+            while not self.pending:
+                self.pending = [rememberDream(self.store, self.model, f,
+                                              self.model.replaceProgramsWithLikelihoodSummaries(f))
+                                for f in self.model.sampleManyHelmholtz(self.requests, self.batch, 1)]
+                self.produced += len(self.pending)
+            return self.pending.pop()
+
+        try:
+            f = self.queue.get_nowait()
+        except queue.Empty:
+            self.starved += 1
+            if self.recent:
+                return random.choice(self.recent)
+            while True:
+                try:
+                    f = self.queue.get(timeout=1.)
+                    break
+                except queue.Empty:
+                    assert any(process.is_alive() for process in self.processes), \
+                        "Every Helmholtz worker died"
+        self.produced += 1
+        if len(self.recent) < self.batch: self.recent.append(f)
+        else: self.recent[random.randrange(len(self.recent))] = f
+        return f
+
+    def storedDreams(self):
+        kind = self.model.grammar.__class__.__name__
+        dreams = []
+        for request in set(self.requests):
+            for f in self.store.bucket(self.model.generativeModel, request, SAMPLED).frontiers(kind):
+                if any(isinstance(e.program, Program) for e in f):
+                    f = self.model.replaceProgramsWithLikelihoodSummaries(f)
+                dreams.append(f)
+        return dreams
+
+    def statistics(self):
+        elapsed = time.time() - self.startTime if self.startTime is not None else 0.
+        return {"dreams": self.produced,
+                "dreamsPerSecond": self.produced / elapsed if elapsed > 0 else 0.,
+                "starvation": self.starved / self.requested if self.requested else 0.,
+                "workers": len(self.processes)}
 
 
 class RecurrentFeatureExtractor(nn.Module):
@@ -1242,8 +1559,24 @@ class RecurrentFeatureExtractor(nn.Module):
         # This is an optimization hack
         self.MAXINPUTS = 100
 
+        # id(task) -> (task, padded token indices of its examples, their lengths)
+        self.exampleCache = OrderedDict()
+        self.exampleCacheLexicon = self.symbolToIndex
+
         if cuda: self.cuda()
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["exampleCache"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        super(RecurrentFeatureExtractor, self).__setstate__(state)
+        # Checkpoints from before there was a cache
+        if "exampleCache" not in self.__dict__:
+            self.exampleCache = OrderedDict()
+        self.exampleCacheLexicon = self.symbolToIndex
+
     @property
     def outputDimensionality(self): return self.H
 
@@ -1317,14 +1650,104 @@ class RecurrentFeatureExtractor(nn.Module):
         e = e.mean(dim=0)
         return e
 
+    def clearExampleCache(self):
+        self.exampleCache.clear()
+        self.exampleCacheLexicon = self.symbolToIndex
+
+    def exampleIndices(self, t):
+        """The examples of t as a matrix of token indices, one row per example,
+        longest first and padded with ENDING, together with the lengths of the rows.
+        None if t cannot be tokenized. Cached per task; replacing symbolToIndex
+        (i.e. changing the lexicon) empties the cache."""
+        if self.exampleCacheLexicon is not self.symbolToIndex:
+            self.clearExampleCache()
+        entry = self.exampleCache.get(id(t))
+        if entry is not None and entry[0] is t:
+            self.exampleCache.move_to_end(id(t))
+            return entry[1]
+
+        tokenized = self.tokenize(t.examples)
+        indices = None
+        if tokenized:
+            es = []
+            for xs, y in tokenized:
+                e = [self.startingIndex]
+                for x in xs:
+                    e.extend(self.symbolToIndex[s] for s in x)
+                    e.append(self.endOfInputIndex)
+                e.append(self.startOfOutputIndex)
+                e.extend(self.symbolToIndex[s] for s in y)
+                e.append(self.endingIndex)
+                es.append(e)
+            es.sort(key=len, reverse=True)
+            sizes = [len(e) for e in es]
+            indices = (torch.tensor([e + [self.endingIndex] * (sizes[0] - len(e)) for e in es]),
+                       sizes)
+
+        # Keeping the task alive keeps id(t) from being reused while it is in the cache
+        self.exampleCache[id(t)] = (t, indices)
+        if len(self.exampleCache) > EXAMPLECACHESIZE:
+            self.exampleCache.popitem(last=False)
+        return indices
+
     def featuresOfTask(self, t):
         if hasattr(self, 'useFeatures'):
             f = self(t.features)
         else:
             # Featurize the examples directly.
-            f = self(t.examples)
+            f = self.featuresOfTasks([t])[0]
         return f
 
+    def featuresOfTasks(self, ts):
+        """featuresOfTask of every task, running the GRU once over the examples
+        of all of them. None for the tasks that cannot be tokenized."""
+        if hasattr(self, 'useFeatures'):
+            return [self.featuresOfTask(t) for t in ts]
+
+        rows, sizes, owners, featurized = [], [], [], []
+        for t in ts:
+            indices = self.exampleIndices(t)
+            if indices is None:
+                featurized.append(False)
+                continue
+            x, xSizes = indices
+            if hasattr(self, 'MAXINPUTS') and len(xSizes) > self.MAXINPUTS:
+                # Sorting the sample keeps the rows longest first
+                keep = sorted(random.sample(range(len(xSizes)), self.MAXINPUTS))
+                xSizes = [xSizes[k] for k in keep]
+                x = x[keep, :xSizes[0]]
+            owners.extend([len(rows)] * len(xSizes))
+            rows.append(x)
+            sizes.extend(xSizes)
+            featurized.append(True)
+        if not rows:
+            return [None] * len(ts)
+
+        if len(rows) == 1:
+            # Already sorted
+            x, order = rows[0], range(len(sizes))
+        else:
+            m = max(x.size(1) for x in rows)
+            x = torch.cat([F.pad(x, (0, m - x.size(1)), value=self.endingIndex) for x in rows])
+            # pack_padded_sequence wants every example sorted longest first
+            order = sorted(range(len(sizes)), key=lambda k: sizes[k], reverse=True)
+            x = x[order]
+        if self.use_cuda: x = x.cuda()
+        x = self.encoder(x).permute(1, 0, 2)
+        x = pack_padded_sequence(x, [sizes[k] for k in order])
+        _, hidden = self.model(x)
+        e = hidden[0, :, :] + hidden[1, :, :]
+
+        # Average the activations of the examples of each task, as in forward
+        if len(rows) == 1:
+            e = [e.mean(dim=0)]
+        else:
+            owners = torch.tensor([owners[k] for k in order], device=e.device)
+            counts = torch.zeros(len(rows), device=e.device).index_add_(0, owners, torch.ones(len(order), device=e.device))
+            e = torch.zeros(len(rows), e.size(1), device=e.device).index_add(0, owners, e) / counts.unsqueeze(1)
+        e = iter(e)
+        return [next(e) if f else None for f in featurized]
+
     def taskOfProgram(self, p, tp):
         # half of the time we randomly mix together inputs
         # this gives better generalization on held out tasks
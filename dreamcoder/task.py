@@ -1,21 +1,19 @@
 from dreamcoder.program import *
 from dreamcoder.differentiation import *
+from dreamcoder.evaluationCache import MISSING, EvaluationCache, evaluationKey, inputKey, programKey
 
 import signal
 
 
-class EvaluationTimeout(Exception):
-    pass
-
-
-EVALUATIONTABLE = {}
+# Slices of the examples that Task.checkBatch runs one after the other
+CHECKBATCHROUNDS = [(0, 1), (1, None)]
 
 
 class Task(object):
     def __init__(self, name, request, examples, features=None, cache=False):
         '''request: the type of this task
         examples: list of tuples of (input, output). input should be a tuple, with one entry for each argument
-        cache: should program evaluations be cached?
+        cache: should program evaluations be cached? (see EvaluationCache)
         features: list of floats.'''
         self.cache = cache
         self.features = features
@@ -78,16 +76,20 @@ class Task(object):
                 eprint("Exception during evaluation:", e)
                 return False
 
-            for x, y in self.examples:
-                if self.cache and (x, e) in EVALUATIONTABLE:
-                    p = EVALUATIONTABLE[(x, e)]
-                else:
+            if self.cache:
+                cache = EvaluationCache.get()
+                program = programKey(e)
+                keys = self.inputKeys
+            for n, (x, y) in enumerate(self.examples):
+                key = evaluationKey(program, keys[n]) if self.cache and keys[n] is not None else None
+                p = MISSING if key is None else cache.lookup(key)
+                if p is MISSING:
                     try:
                         p = self.predict(f, x)
                     except BaseException:
                         p = None
-                    if self.cache:
-                        EVALUATIONTABLE[(x, e)] = p
+                    if key is not None:
+                        cache.store(key, p)
                 if p != y:
                     if timeout is not None:
                         signal.signal(signal.SIGVTALRM, lambda *_: None)
@@ -106,6 +108,77 @@ class Task(object):
                 signal.signal(signal.SIGVTALRM, lambda *_: None)
                 signal.setitimer(signal.ITIMER_VIRTUAL, 0)
 
+    @property
+    def inputKeys(self):
+        """Digests of the inputs of each example, for the evaluation cache"""
+        keys = getattr(self, "_inputKeys", None)
+        if keys is None or keys[0] is not self.examples or len(keys[1]) != len(self.examples):
+            salt = type(self).predict.__qualname__.encode("utf-8")
+            keys = self._inputKeys = (self.examples, [inputKey(xs, salt) for xs, _ in self.examples])
+        return keys[1]
+
+    @property
+    def batchable(self):
+        """Can checkBatch stand in for check? True for plain input/output tasks"""
+        return type(self).check is Task.check and \
+            type(self).predict is Task.predict and \
+            type(self).logLikelihood is Task.logLikelihood
+
+    @staticmethod
+    def checkBatch(e, tasks, timeout=None):
+        """Like check, but for many tasks at once: e is run on the examples of
+        every task in one batch (see Program.evaluateBatch). The tasks share
+        timeout seconds each; if that runs out, the tasks still being checked
+        fail. Returns one boolean per task."""
+        successes = [True] * len(tasks)
+        remaining = range(len(tasks))
+        if any(t.cache for t in tasks):
+            cache = EvaluationCache.get()
+            program = programKey(e)
+        if timeout is not None:
+            def timeoutCallBack(_1, _2): raise EvaluationTimeout()
+            signal.signal(signal.SIGVTALRM, timeoutCallBack)
+            signal.setitimer(signal.ITIMER_VIRTUAL, timeout * len(tasks))
+        try:
+            # Most programs are wrong on the first example, so that is
+            # checked first; the rest only for the tasks that are left
+            for first, last in CHECKBATCHROUNDS:
+                remaining = [n for n, t in enumerate(tasks)
+                             if successes[n] and len(t.examples) > first]
+                if not remaining:
+                    break
+                # (task, inputs, output, cache key) for every example of this round
+                rows = []
+                for n in remaining:
+                    t = tasks[n]
+                    keys = t.inputKeys[first:last] if t.cache else [None] * len(t.examples[first:last])
+                    rows.extend((n, xs, y, None if k is None else evaluationKey(program, k))
+                                for (xs, y), k in zip(t.examples[first:last], keys))
+                outputs = [MISSING if key is None else cache.lookup(key) for _, _, _, key in rows]
+                misses = [j for j, p in enumerate(outputs) if p is MISSING]
+                if misses:
+                    for j, p in zip(misses, e.evaluateBatch([rows[j][1] for j in misses])):
+                        p = None if p is FAILED else p
+                        outputs[j] = p
+                        if rows[j][3] is not None:
+                            cache.store(rows[j][3], p)
+                for (n, _, y, _), p in zip(rows, outputs):
+                    if successes[n] and p != y:
+                        successes[n] = False
+        except EvaluationTimeout:
+            eprint("Timed out while evaluating", e)
+            for n in remaining:
+                successes[n] = False
+        except Exception as exception:
+            eprint("Exception during evaluation:", exception)
+            return [False] * len(tasks)
+        finally:
+            if timeout is not None:
+                signal.signal(signal.SIGVTALRM, lambda *_: None)
+                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+
+        return successes
+
     def logLikelihood(self, e, timeout=None):
         if self.check(e, timeout):
             return 0.0
@@ -156,10 +156,10 @@ class TypeVariable(Type):
     def functionArguments(self): return []
 
     def apply(self, context):
-        for v, t in context.substitution:
-            if v == self.v:
-                return t.apply(context)
-        return self
+        t = context.substitution.lookup(self.v)
+        if t is None:
+            return self
+        return t.apply(context)
 
     def applyMutable(self, context):
         s = context.substitution[self.v]
@@ -200,13 +200,90 @@ class TypeVariable(Type):
         return TypeVariable(-1 - self.v)
 
 
+class Substitution(object):
+    """Persistent map from type variable indices to types.
+    A path-copying trie over the bits of the variable index: extending copies
+    one node per level and shares everything else with the original, so
+    branching enumerations can hold onto older substitutions for free.
+    Lookup and extension are both O(log n) in the largest bound variable."""
+    BITS = 4
+    WIDTH = 1 << BITS
+    MASK = WIDTH - 1
+
+    def __init__(self, root=None, shift=0):
+        self.root = root
+        self.shift = shift
+
+    def lookup(self, v):
+        if v < 0 or v >> (self.shift + Substitution.BITS):
+            return None
+        node = self.root
+        shift = self.shift
+        while node is not None and shift > 0:
+            node = node[(v >> shift) & Substitution.MASK]
+            shift -= Substitution.BITS
+        if node is None:
+            return None
+        return node[v & Substitution.MASK]
+
+    def extend(self, v, t):
+        assert v >= 0
+        root = self.root
+        shift = self.shift
+        # Grow the trie until v fits
+        while v >> (shift + Substitution.BITS):
+            if root is not None:
+                root = (root,) + (None,) * Substitution.MASK
+            shift += Substitution.BITS
+        return Substitution(Substitution._extend(root, shift, v, t), shift)
+
+    @staticmethod
+    def _extend(node, shift, v, t):
+        j = (v >> shift) & Substitution.MASK
+        node = [None] * Substitution.WIDTH if node is None else list(node)
+        node[j] = t if shift == 0 else Substitution._extend(node[j], shift - Substitution.BITS, v, t)
+        return tuple(node)
+
+    def items(self):
+        """Yields (variable, type) in increasing order of the variable"""
+        def walk(node, shift, prefix):
+            if node is None:
+                return
+            for j, child in enumerate(node):
+                if child is None:
+                    continue
+                if shift == 0:
+                    yield prefix | j, child
+                else:
+                    yield from walk(child, shift - Substitution.BITS,
+                                    prefix | (j << shift))
+        yield from walk(self.root, self.shift, 0)
+
+    def __iter__(self): return self.items()
+
+    @staticmethod
+    def fromList(bindings):
+        s = Substitution.EMPTY
+        for v, t in reversed(bindings):
+            s = s.extend(v, t)
+        return s
+
+
+Substitution.EMPTY = Substitution()
+
+
 class Context(object):
-    def __init__(self, nextVariable=0, substitution=[]):
+    def __init__(self, nextVariable=0, substitution=None):
         self.nextVariable = nextVariable
+        if substitution is None:
+            substitution = Substitution.EMPTY
+        elif not isinstance(substitution, Substitution):
+            # Legacy representation: list of (variable, type), newest first
+            substitution = Substitution.fromList(substitution)
         self.substitution = substitution
 
     def extend(self, j, t):
-        return Context(self.nextVariable, [(j, t)] + self.substitution)
+        return Context(self.nextVariable, self.substitution.extend(j, t))
 
     def makeVariable(self):
         return (Context(self.nextVariable + 1, self.substitution),
@@ -238,7 +315,7 @@ class Context(object):
 
     def __str__(self):
         return "Context(next = %d, {%s})" % (self.nextVariable, ", ".join(
-            "t%d ||> %s" % (k, v.apply(self)) for k, v in self.substitution))
+            "t%d ||> %s" % (k, v.apply(self)) for k, v in self.substitution.items()))
 
     def __repr__(self): return str(self)
 
@@ -281,7 +358,7 @@ class MutableContext(object):
             self.unify(x, y)
 
 
-Context.EMPTY = Context(0, [])
+Context.EMPTY = Context(0, Substitution.EMPTY)
 
 
 def canonicalTypes(ts):
@@ -1,5 +1,13 @@
 from dreamcoder.grammar import *
 
+from array import array
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # Python < 3.8
+    SharedMemory = None
+
 epsilon = 0.001
 
 
@@ -40,7 +48,14 @@ class Union(Program):
     def __repr__(self): return str(self)
     def __iter__(self): return iter(self.elements)
 
+# Kinds of version space nodes
+LEAF, ABSTRACTION, APPLICATION, UNION = 0, 1, 2, 3
+
 class VersionTable():
+    """Hash-consed version spaces, stored column-wise: node j has kind tags[j] and
+    the children left[j] and right[j]. The left child of a leaf indexes self.leaves;
+    the members of a union are members[left[j]:left[j] + right[j]], in increasing order.
+    Nodes are interned through an open addressing table of node indices."""
     def __init__(self, typed=True, identity=True, factored=False):
         self.factored = factored
         self.identity = identity
@@ -49,27 +64,50 @@ class VersionTable():
         if self.debug:
             print("WARNING: running version spaces in debug mode. Will be substantially slower.")
         
-        self.expressions = []
-        self.recursiveTable = []
+        self.tags = array('b')
+        self.left = array('i')
+        self.right = array('i')
+        self.members = array('i')
+        self.leaves = []
+        self.leaf2index = {}
+        # Open addressing table of node indices, -1 being free; at most half full
+        self.slots = array('i', [-1])*1024
+
+        # Table containing the recursive inversion of each node, -1 until computed
+        self.recursiveTable = array('i')
         self.substitutionTable = {}
-        self.expression2index = {}
-        self.maximumShift = []
         # Table containing (minimum cost, set of minimum cost programs)
         self.inhabitantTable = []
         # Table containing (minimum cost, set of minimum cost programs NOT starting w/ abstraction)
         self.functionInhabitantTable = []
         self.superCache = {}
+        # Beams of bestInventions(incremental=True), of beamSize over beamCandidates
+        self.beamTable = []
+        self.beamSize = None
+        self.beamCandidates = set()
 
         self.overlapTable = {}
         
         self.universe = self.incorporate(Primitive("U",t0,None))
         self.empty = self.incorporate(Union([], canBeEmpty=True))
 
-    def __len__(self): return len(self.expressions)
+    def __len__(self): return len(self.tags)
 
     def clearOverlapTable(self):
         self.overlapTable = {}
 
+    def children(self, j):
+        """The members of union j"""
+        return self.members[self.left[j]:self.left[j] + self.right[j]]
+
+    def expression(self, j):
+        """Node j as a Program whose children are node indices"""
+        tag = self.tags[j]
+        if tag == LEAF: return self.leaves[self.left[j]]
+        if tag == ABSTRACTION: return Abstraction(self.left[j])
+        if tag == APPLICATION: return Application(self.left[j], self.right[j])
+        return Union(self.children(j), canBeEmpty=True)
+
     def visualize(self, j):
         from graphviz import Digraph
         g = Digraph()
@@ -83,7 +121,7 @@ class VersionTable():
             elif i == self.empty:
                 g.node(str(i), 'nil')
             else:
-                l = self.expressions[i]
+                l = self.expression(i)
                 if l.isIndex or l.isPrimitive or l.isInvented:
                     g.node(str(i), str(l))
                 elif l.isAbstraction:
@@ -108,7 +146,7 @@ class VersionTable():
         g.render(view=True)
 
     def branchingFactor(self,j):
-        l = self.expressions[j]
+        l = self.expression(j)
         if l.isApplication: return max(self.branchingFactor(l.f),
                                        self.branchingFactor(l.x))
         if l.isUnion: return max([len(l.elements)] + [self.branchingFactor(e) for e in l ])
@@ -117,7 +155,7 @@ class VersionTable():
             
         
     def intention(self,j, isFunction=False):
-        l = self.expressions[j]
+        l = self.expression(j)
         if l.isIndex or l.isPrimitive or l.isInvented: return l
         if l.isAbstraction: return Abstraction(self.intention(l.body))
         if l.isApplication: return Application(self.intention(l.f),
@@ -132,7 +170,7 @@ class VersionTable():
         def r(n):
             if n in visited: return
             visited.add(n)
-            l = self.expressions[n]
+            l = self.expression(n)
             yield l
             if l.isApplication:
                 yield from r(l.f)
@@ -148,48 +186,90 @@ class VersionTable():
     def incorporate(self,p):
         #assert isinstance(p,Union)# or p.wellTyped()
         if p.isIndex or p.isPrimitive or p.isInvented:
-            pass
-        elif p.isAbstraction:
-            p = Abstraction(self.incorporate(p.body))
-        elif p.isApplication:
-            p = Application(self.incorporate(p.f),
-                            self.incorporate(p.x))
-        elif p.isUnion:
-            if len(p.elements) > 0:
-                p = Union([self.incorporate(e) for e in p ])
-        else: assert False
+            return self.leaf(p)
+        if p.isAbstraction:
+            return self._intern(ABSTRACTION, self.incorporate(p.body), 0)
+        if p.isApplication:
+            return self._intern(APPLICATION, self.incorporate(p.f), self.incorporate(p.x))
+        if p.isUnion:
+            return self._internUnion(tuple(sorted({self.incorporate(e) for e in p })))
+        assert False
 
-        j = self._incorporate(p)
+    def leaf(self, p):
+        if p not in self.leaf2index:
+            self.leaf2index[p] = len(self.leaves)
+            self.leaves.append(p)
+        return self._intern(LEAF, self.leaf2index[p], 0)
+
+    def _intern(self, tag, left, right):
+        slots = self.slots
+        mask = len(slots) - 1
+        h = hash((tag, left, right)) & mask
+        while True:
+            j = slots[h]
+            if j < 0: break
+            if self.left[j] == left and self.right[j] == right and self.tags[j] == tag: return j
+            h = (h + 1) & mask
+
+        j = len(self.tags)
+        self.tags.append(tag)
+        self.left.append(left)
+        self.right.append(right)
+        self._occupy(h, j)
         return j
 
-    def _incorporate(self,p):
-        if p in self.expression2index: return self.expression2index[p]
-
-        j = len(self.expressions)
+    def _internUnion(self, members):
+        """members: sorted tuple of distinct nodes"""
+        slots = self.slots
+        mask = len(slots) - 1
+        h = hash(members) & mask
+        while True:
+            j = slots[h]
+            if j < 0: break
+            if self.tags[j] == UNION and self.right[j] == len(members) and \
+               tuple(self.children(j)) == members: return j
+            h = (h + 1) & mask
+
+        j = len(self.tags)
+        self.tags.append(UNION)
+        self.left.append(len(self.members))
+        self.right.append(len(members))
+        self.members.extend(members)
+        self._occupy(h, j)
+        return j
         
-        self.expressions.append(p)
-        self.expression2index[p] = j
-        self.recursiveTable.append(None)
+    def _occupy(self, h, j):
+        self.slots[h] = j
+        self.recursiveTable.append(-1)
         self.inhabitantTable.append(None)
         self.functionInhabitantTable.append(None)
+        if 2*len(self.tags) > len(self.slots): self._rehash(2*len(self.slots))
         
-        return j
+    def _rehash(self, size):
+        slots = array('i', [-1])*size
+        mask = size - 1
+        for j in range(len(self.tags)):
+            if self.tags[j] == UNION: h = hash(tuple(self.children(j)))
+            else: h = hash((self.tags[j], self.left[j], self.right[j]))
+            h &= mask
+            while slots[h] >= 0: h = (h + 1) & mask
+            slots[h] = j
+        self.slots = slots
 
     def extract(self,j):
-        l = self.expressions[j]
-        if l.isAbstraction:
-            for b in self.extract(l.body):
+        tag = self.tags[j]
+        if tag == ABSTRACTION:
+            for b in self.extract(self.left[j]):
                 yield Abstraction(b)
-        elif l.isApplication:
-            for f in self.extract(l.f):
-                for x in self.extract(l.x):
+        elif tag == APPLICATION:
+            for f in self.extract(self.left[j]):
+                for x in self.extract(self.right[j]):
                     yield Application(f,x)
-        elif l.isIndex or l.isPrimitive or l.isInvented:
-            yield l
-        elif l.isUnion:
-            for e in l:
+        elif tag == LEAF:
+            yield self.leaves[self.left[j]]
+        else:
+            for e in self.children(j):
                 yield from self.extract(e)
-        else: assert False
 
     def reachable(self, heads):
         visited = set()
@@ -197,27 +277,27 @@ class VersionTable():
             if j in visited: return
             visited.add(j)
 
-            l = self.expressions[j]
-            if l.isUnion:
-                for e in l:
+            tag = self.tags[j]
+            if tag == UNION:
+                for e in self.children(j):
                     visit(e)
-            elif l.isAbstraction: visit(l.body)
-            elif l.isApplication:
-                visit(l.f)
-                visit(l.x)
+            elif tag == ABSTRACTION: visit(self.left[j])
+            elif tag == APPLICATION:
+                visit(self.left[j])
+                visit(self.right[j])
 
         for h in heads:
             visit(h)
         return visited
 
     def size(self,j):
-        l = self.expressions[j]
-        if l.isApplication:
-            return self.size(l.f) + self.size(l.x)
-        elif l.isAbstraction:
-            return self.size(l.body)
-        elif l.isUnion:
-            return sum(self.size(e) for e in l )
+        tag = self.tags[j]
+        if tag == APPLICATION:
+            return self.size(self.left[j]) + self.size(self.right[j])
+        elif tag == ABSTRACTION:
+            return self.size(self.left[j])
+        elif tag == UNION:
+            return sum(self.size(e) for e in self.children(j) )
         else:
             return 1
             
@@ -225,27 +305,25 @@ class VersionTable():
     def union(self,elements):
         if self.universe in elements: return self.universe
         
-        _e = []
+        _e = set()
         for e in elements:
-            if self.expressions[e].isUnion:
-                for j in self.expressions[e]:
-                    _e.append(j)
-            elif e != self.empty:
-                _e.append(e)
-
-        elements = frozenset(_e)
-        if len(elements) == 0: return self.empty
-        if len(elements) == 1: return next(iter(elements))
-        return self._incorporate(Union(elements))
+            if self.tags[e] == UNION:
+                _e.update(self.children(e))
+            else:
+                _e.add(e)
+
+        if len(_e) == 0: return self.empty
+        if len(_e) == 1: return next(iter(_e))
+        return self._internUnion(tuple(sorted(_e)))
     def apply(self,f,x):
         if f == self.empty: return f
         if x == self.empty: return x
-        return self._incorporate(Application(f,x))
+        return self._intern(APPLICATION, f, x)
     def abstract(self,b):
         if b == self.empty: return self.empty
-        return self._incorporate(Abstraction(b))
+        return self._intern(ABSTRACTION, b, 0)
     def index(self,i):
-        return self._incorporate(Index(i))
+        return self.leaf(Index(i))
 
     def intersection(self,a,b):
         if a == self.empty or b == self.empty: return self.empty
@@ -253,24 +331,24 @@ class VersionTable():
         if b == self.universe: return a
         if a == b: return a
 
-        x = self.expressions[a]
-        y = self.expressions[b]
+        x = self.tags[a]
+        y = self.tags[b]
 
-        if x.isAbstraction and y.isAbstraction:
-            return self.abstract(self.intersection(x.body,y.body))
-        if x.isApplication and y.isApplication:
-            return self.apply(self.intersection(x.f,y.f),
-                              self.intersection(x.x,y.x))
-        if x.isUnion:
-            if y.isUnion:
+        if x == ABSTRACTION and y == ABSTRACTION:
+            return self.abstract(self.intersection(self.left[a],self.left[b]))
+        if x == APPLICATION and y == APPLICATION:
+            return self.apply(self.intersection(self.left[a],self.left[b]),
+                              self.intersection(self.right[a],self.right[b]))
+        if x == UNION:
+            if y == UNION:
                 return self.union([ self.intersection(x_,y_)
-                                    for x_ in x
-                                    for y_ in y ])
+                                    for x_ in self.children(a)
+                                    for y_ in self.children(b) ])
             return self.union([ self.intersection(x_, b)
-                                for x_ in x ])
-        if y.isUnion:
+                                for x_ in self.children(a) ])
+        if y == UNION:
             return self.union([ self.intersection(a, y_)
-                                for y_ in y ])
+                                for y_ in self.children(b) ])
         return self.empty
 
     def haveOverlap(self,a,b):
@@ -284,24 +362,20 @@ class VersionTable():
                 return self.overlapTable[a][b]
         else: self.overlapTable[a] = {}
 
-        x = self.expressions[a]
-        y = self.expressions[b]
-
-        if x.isAbstraction and y.isAbstraction:
-            overlap = self.haveOverlap(x.body,y.body)
-        elif x.isApplication and y.isApplication:
-            overlap = self.haveOverlap(x.f,y.f) and \
-                self.haveOverlap(x.x,y.x)
-        elif x.isUnion:
-            if y.isUnion:
-                overlap = any( self.haveOverlap(x_,y_)
-                            for x_ in x
-                            for y_ in y )
+        x = self.tags[a]
+        y = self.tags[b]
+
+        if x == ABSTRACTION and y == ABSTRACTION:
+            overlap = self.haveOverlap(self.left[a],self.left[b])
+        elif x == APPLICATION and y == APPLICATION:
+            overlap = self.haveOverlap(self.left[a],self.left[b]) and \
+                self.haveOverlap(self.right[a],self.right[b])
+        elif x == UNION:
             overlap = any( self.haveOverlap(x_, b)
-                        for x_ in x )
-        elif y.isUnion:
+                        for x_ in self.children(a) )
+        elif y == UNION:
             overlap = any( self.haveOverlap(a, y_)
-                        for y_ in y )
+                        for y_ in self.children(b) )
         else:
             overlap = False
         self.overlapTable[a][b] = overlap
@@ -311,27 +385,26 @@ class VersionTable():
         """Returns (minimal size, set of singleton version spaces)"""
         assert isinstance(j,int)
         if self.inhabitantTable[j] is not None: return self.inhabitantTable[j]
-        e = self.expressions[j]
-        if e.isAbstraction:
-            cost, members = self.minimalInhabitants(e.body)
+        tag = self.tags[j]
+        if tag == ABSTRACTION:
+            cost, members = self.minimalInhabitants(self.left[j])
             cost = cost + epsilon
             members = {self.abstract(m) for m in members}
-        elif e.isApplication:
-            fc, fm = self.minimalFunctionInhabitants(e.f)
-            xc, xm = self.minimalInhabitants(e.x)
+        elif tag == APPLICATION:
+            fc, fm = self.minimalFunctionInhabitants(self.left[j])
+            xc, xm = self.minimalInhabitants(self.right[j])
             cost = fc + xc + epsilon
             members = {self.apply(f_,x_)
                        for f_ in fm for x_ in xm }
-        elif e.isUnion:
+        elif tag == UNION:
             children = [self.minimalInhabitants(z)
-                        for z in e ]
+                        for z in self.children(j) ]
             cost = min(c for c,_ in children)
             members = {zp
                        for c,z in children
                        if c == cost
                        for zp in z }
         else:
-            assert e.isIndex or e.isInvented or e.isPrimitive
             cost = 1
             members = {j}
 
@@ -347,26 +420,25 @@ class VersionTable():
         """Returns (minimal size, set of singleton version spaces)"""
         assert isinstance(j,int)
         if self.functionInhabitantTable[j] is not None: return self.functionInhabitantTable[j]
-        e = self.expressions[j]
-        if e.isAbstraction:
+        tag = self.tags[j]
+        if tag == ABSTRACTION:
             cost = POSITIVEINFINITY
             members = set()
-        elif e.isApplication:
-            fc, fm = self.minimalFunctionInhabitants(e.f)
-            xc, xm = self.minimalInhabitants(e.x)
+        elif tag == APPLICATION:
+            fc, fm = self.minimalFunctionInhabitants(self.left[j])
+            xc, xm = self.minimalInhabitants(self.right[j])
             cost = fc + xc + epsilon
             members = {self.apply(f_,x_)
                        for f_ in fm for x_ in xm }
-        elif e.isUnion:
+        elif tag == UNION:
             children = [self.minimalFunctionInhabitants(z)
-                        for z in e ]
+                        for z in self.children(j) ]
             cost = min(c for c,_ in children)
             members = {zp
                        for c,z in children
                        if c == cost
                        for zp in z }
         else:
-            assert e.isIndex or e.isInvented or e.isPrimitive
             cost = 1
             members = {j}
 
@@ -379,15 +451,16 @@ class VersionTable():
 
     def shiftFree(self,j,n,c=0):
         if n == 0: return j
-        l = self.expressions[j]
-        if l.isUnion:
+        tag = self.tags[j]
+        if tag == UNION:
             return self.union([ self.shiftFree(e,n,c)
-                                for e in l ])
-        if l.isApplication:
-            return self.apply(self.shiftFree(l.f,n,c),
-                              self.shiftFree(l.x,n,c))
-        if l.isAbstraction:
-            return self.abstract(self.shiftFree(l.body,n,c+1))
+                                for e in self.children(j) ])
+        if tag == APPLICATION:
+            return self.apply(self.shiftFree(self.left[j],n,c),
+                              self.shiftFree(self.right[j],n,c))
+        if tag == ABSTRACTION:
+            return self.abstract(self.shiftFree(self.left[j],n,c+1))
+        l = self.leaves[self.left[j]]
         if l.isIndex:
             if l.i < c: return j
             if l.i >= n + c: return self.index(l.i - n)
@@ -425,19 +498,21 @@ class VersionTable():
             else:
                 m = {s: self.index(n)}
 
-        l = self.expressions[j]
-        if l.isPrimitive or l.isInvented:
-            m[(self.universe,t0) if self.typed else self.universe] = j
-        elif l.isIndex:
-            m[(self.universe,t0) if self.typed else self.universe] = \
+        tag = self.tags[j]
+        if tag == LEAF:
+            l = self.leaves[self.left[j]]
+            if l.isIndex:
+                m[(self.universe,t0) if self.typed else self.universe] = \
                     j if l.i < n else self.index(l.i + 1)
-        elif l.isAbstraction:
-            for v,b in self._substitutions(l.body, n + 1).items():
+            else:
+                m[(self.universe,t0) if self.typed else self.universe] = j
+        elif tag == ABSTRACTION:
+            for v,b in self._substitutions(self.left[j], n + 1).items():
                 m[v] = self.abstract(b)
-        elif l.isApplication and not self.factored:
+        elif tag == APPLICATION and not self.factored:
             newMapping = {}
-            fm = self._substitutions(l.f,n)
-            xm = self._substitutions(l.x,n)
+            fm = self._substitutions(self.left[j],n)
+            xm = self._substitutions(self.right[j],n)
             for v1,f in fm.items():
                 if self.typed: v1,nType1 = v1
                 for v2,x in xm.items():
@@ -468,10 +543,10 @@ class VersionTable():
             newMapping.update(m)
             m = newMapping
             # print(f"substitutions: |{len(fm)}|x|{len(xm)}| = {len(m)}\t{len(m) <= len(fm)+len(xm)}")
-        elif l.isApplication and self.factored:
+        elif tag == APPLICATION and self.factored:
             newMapping = {}
-            fm = self._substitutions(l.f,n)
-            xm = self._substitutions(l.x,n)
+            fm = self._substitutions(self.left[j],n)
+            xm = self._substitutions(self.right[j],n)
             for v1,f in fm.items():
                 if self.typed: v1,nType1 = v1
                 for v2,x in xm.items():
@@ -488,9 +563,9 @@ class VersionTable():
                 xs = self.union(list(xs))
                 m[v] = self.apply(fs,xs)
             # print(f"substitutions: |{len(fm)}|x|{len(xm)}| = {len(m)}\t{len(m) <= len(fm)+len(xm)}")
-        elif l.isUnion:
+        elif tag == UNION:
             newMapping = {}
-            for e in l:
+            for e in self.children(j):
                 for v,b in self._substitutions(e,n).items():
                     if v in newMapping:
                         newMapping[v].append(b)
@@ -533,11 +608,11 @@ class VersionTable():
 
 
     def recursiveInversion(self,j):
-        if self.recursiveTable[j] is not None: return self.recursiveTable[j]
+        if self.recursiveTable[j] >= 0: return self.recursiveTable[j]
         
-        l = self.expressions[j]
-        if l.isUnion:
-            return self.union([self.recursiveInversion(e) for e in l ])
+        tag = self.tags[j]
+        if tag == UNION:
+            return self.union([self.recursiveInversion(e) for e in self.children(j) ])
         
         t = [self.apply(self.abstract(b),v)
              for v,b in self.substitutions(j)
@@ -563,11 +638,12 @@ class VersionTable():
             assert self.infer(ru) == self.infer(j)
 
 
-        if l.isApplication:
-            t.append(self.apply(self.recursiveInversion(l.f),l.x))
-            t.append(self.apply(l.f,self.recursiveInversion(l.x)))
-        elif l.isAbstraction:
-            t.append(self.abstract(self.recursiveInversion(l.body)))
+        if tag == APPLICATION:
+            f, x = self.left[j], self.right[j]
+            t.append(self.apply(self.recursiveInversion(f),x))
+            t.append(self.apply(f,self.recursiveInversion(x)))
+        elif tag == ABSTRACTION:
+            t.append(self.abstract(self.recursiveInversion(self.left[j])))
 
         ru = self.union(t)        
         self.recursiveTable[j] = ru
@@ -594,40 +670,101 @@ class VersionTable():
         spaces = self.rewriteReachable({j}, n)
         def superSpace(i):
             assert i in spaces
-            e = self.expressions[i]
+            tag = self.tags[i]
             components = [i] + spaces[i]
-            if e.isIndex or e.isPrimitive or e.isInvented:
+            if tag == LEAF:
                 pass
-            elif e.isAbstraction:
-                components.append(self.abstract(superSpace(e.body)))
-            elif e.isApplication:
-                components.append(self.apply(superSpace(e.f), superSpace(e.x)))
-            elif e.isUnion: assert False
+            elif tag == ABSTRACTION:
+                components.append(self.abstract(superSpace(self.left[i])))
+            elif tag == APPLICATION:
+                components.append(self.apply(superSpace(self.left[i]), superSpace(self.right[i])))
             else: assert False
             
             return self.union(components)
         self.superCache[j] = superSpace(j)
         return self.superCache[j]
-            
+
+    def superVersionSpaces(self, programs, n, CPUs=1):
+        """Super version spaces of programs. With several CPUs the programs are dealt
+        out to processes, which each build a table of their own that is then
+        interned into this one."""
+        missing = list({p: None for p in programs
+                        if self.incorporate(p) not in self.superCache})
+        if CPUs > 1 and len(missing) > 1:
+            # Deal the biggest programs out first, so that the shards are balanced
+            missing.sort(key=lambda p: -p.size())
+            shards = [missing[k::CPUs] for k in range(min(CPUs, len(missing)))]
+            def build(shard):
+                v = self.emptyCopy()
+                for p in shard:
+                    v.superVersionSpace(v.incorporate(p), n)
+                return v.shard(len(self.leaves))
+            for shard in parallelMap(CPUs, build, shards,
+                                     memorySensitive=True,
+                                     chunksize=1,
+                                     maxtasksperchild=1):
+                self.absorb(shard)
+        return [self.superVersionSpace(self.incorporate(p), n) for p in programs]
+
+    def emptyCopy(self):
+        """A table with the settings and the leaves of this one, but no other nodes"""
+        v = VersionTable(typed=self.typed, identity=self.identity, factored=self.factored)
+        for l in self.leaves: v.leaf(l)
+        return v
+
+    def shard(self, knownLeaves):
+        """The nodes and super version spaces of this table, to be absorbed by the
+        table it is an emptyCopy of, which has its first knownLeaves leaves.
+        Primitives need not pickle, so only the leaves made since are included."""
+        return (self.tags, self.left, self.right, self.members,
+                knownLeaves, self.leaves[knownLeaves:], self.superCache)
+
+    def absorb(self, shard):
+        """Interns the nodes of the shard of an emptyCopy of this table;
+        returns the index in this table of each of its nodes"""
+        tags, left, right, members, knownLeaves, leaves, superCache = shard
+        mapping = array('i', [0])*len(tags)
+        # Children always precede their parents
+        for j in range(len(tags)):
+            tag = tags[j]
+            if tag == LEAF:
+                l = left[j]
+                k = self.leaf(self.leaves[l] if l < knownLeaves else leaves[l - knownLeaves])
+            elif tag == ABSTRACTION:
+                k = self._intern(ABSTRACTION, mapping[left[j]], 0)
+            elif tag == APPLICATION:
+                k = self._intern(APPLICATION, mapping[left[j]], mapping[right[j]])
+            else:
+                k = self._internUnion(tuple(sorted(mapping[e]
+                                                   for e in members[left[j]:left[j] + right[j]])))
+            mapping[j] = k
+        for j, s in superCache.items():
+            self.superCache[mapping[j]] = mapping[s]
+        return mapping
+
+    def share(self):
+        """A SharedVersionTable of the nodes of this table and its super version spaces"""
+        return SharedVersionTable(self)
+
     def loadEquivalences(self, g, spaces):
-        versionClasses = [None]*len(self.expressions)
+        versionClasses = [None]*len(self)
         def extract(j):
             if versionClasses[j] is not None:
                 return versionClasses[j]
             
-            l = self.expressions[j]
-            if l.isAbstraction:
+            tag = self.tags[j]
+            if tag == ABSTRACTION:
                 ks = g.setOfClasses(g.abstractClass(b)
-                                    for b in extract(l.body))
-            elif l.isApplication:
-                fs = extract(l.f)
-                xs = extract(l.x)
+                                    for b in extract(self.left[j]))
+            elif tag == APPLICATION:
+                fs = extract(self.left[j])
+                xs = extract(self.right[j])
                 ks = g.setOfClasses(g.applyClass(f,x)
                                     for x in xs for f in fs )
-            elif l.isUnion:
-                ks = g.setOfClasses(e for u in l for e in extract(u))
+            elif tag == UNION:
+                ks = g.setOfClasses(e for u in self.children(j) for e in extract(u))
             else:
-                ks = g.setOfClasses({g.incorporate(l)})
+                ks = g.setOfClasses({g.incorporate(self.leaves[self.left[j]])})
             versionClasses[j] = ks
             return ks
             
@@ -658,9 +795,10 @@ class VersionTable():
                     else:
                         typedClassesOfVertex[v][e] = e
 
-    def bestInventions(self, versions, bs=25):
+    def bestInventions(self, versions, bs=25, incremental=False):
         """versions: [[version index]]"""
         """bs: beam size"""
+        """incremental: keep the beams for the next call, which only recomputes those that changed"""
         """returns: list of (indices to) candidates"""
         import gc
         
@@ -740,7 +878,14 @@ class VersionTable():
                 return {'relativeCost': self.relativeCost, 'defaultCost': self.defaultCost,
                         'relativeFunctionCost': self.relativeFunctionCost, 'defaultFunctionCost': self.defaultFunctionCost}
 
-        beamTable = [None]*len(self.expressions)
+        if incremental:
+            if bs != self.beamSize: self.beamTable = []
+            else: self.forgetBeams(candidates ^ self.beamCandidates)
+            self.beamSize, self.beamCandidates = bs, candidates
+            self.beamTable.extend([None]*(len(self) - len(self.beamTable)))
+            beamTable = self.beamTable
+        else:
+            beamTable = [None]*len(self)
 
         def costs(j):
             if beamTable[j] is not None:
@@ -748,21 +893,21 @@ class VersionTable():
 
             beamTable[j] = B(j)
             
-            e = self.expressions[j]
-            if e.isIndex or e.isPrimitive or e.isInvented:
+            tag = self.tags[j]
+            if tag == LEAF:
                 pass
-            elif e.isAbstraction:
-                b = costs(e.body)
+            elif tag == ABSTRACTION:
+                b = costs(self.left[j])
                 for i,c in b.relativeCost.items():
                     beamTable[j].relax(i, c + epsilon)
-            elif e.isApplication:
-                f = costs(e.f)
-                x = costs(e.x)
+            elif tag == APPLICATION:
+                f = costs(self.left[j])
+                x = costs(self.right[j])
                 for i in f.functionDomain | x.domain:
                     beamTable[j].relax(i, f.getFunctionCost(i) + x.getCost(i) + epsilon)
                     beamTable[j].relaxFunction(i, f.getFunctionCost(i) + x.getCost(i) + epsilon)
-            elif e.isUnion:
-                for z in e:
+            elif tag == UNION:
+                for z in self.children(j):
                     cz = costs(z)
                     for i,c in cz.relativeCost.items(): beamTable[j].relax(i, c)
                     for i,c in cz.relativeFunctionCost.items(): beamTable[j].relaxFunction(i, c)
@@ -772,12 +917,15 @@ class VersionTable():
             return beamTable[j]
 
         with timing("beamed version spaces"):
-            beams = parallelMap(numberOfCPUs(),
-                                lambda hs: [ costs(h).unobject() for h in hs ],
-                                versions,
-                                memorySensitive=True,
-                                chunksize=1,
-                                maxtasksperchild=1)
+            if incremental:
+                beams = [[ costs(h).unobject() for h in hs ] for hs in versions ]
+            else:
+                beams = parallelMap(numberOfCPUs(),
+                                    lambda hs: [ costs(h).unobject() for h in hs ],
+                                    versions,
+                                    memorySensitive=True,
+                                    chunksize=1,
+                                    maxtasksperchild=1)
 
         # This can get pretty memory intensive - clean up the garbage
         beamTable = None
@@ -795,6 +943,25 @@ class VersionTable():
         candidates = sorted(candidates, key=score)
         return candidates
 
+    def forgetBeams(self, changed):
+        """Forgets the beams that depend on the candidates in changed. The beam of a node
+        only depends on the candidates among the inhabitants of the nodes below it, so
+        these are the nodes inhabited by one of them and every node above those."""
+        if not changed: return
+        stale = set()
+        # Children always precede their parents
+        for j, b in enumerate(self.beamTable):
+            if b is None: continue
+            tag = self.tags[j]
+            if tag == ABSTRACTION: below = (self.left[j],)
+            elif tag == APPLICATION: below = (self.left[j], self.right[j])
+            elif tag == UNION: below = self.children(j)
+            else: below = ()
+            if any(k in stale for k in below) or \
+               not changed.isdisjoint(self.inhabitantTable[j][1]):
+                stale.add(j)
+                self.beamTable[j] = None
+
     def rewriteWithInvention(self, i, js):
         """Rewrites list of indices in beta long form using invention"""
         self.clearOverlapTable()
@@ -811,27 +978,28 @@ class VersionTable():
         table = {}
         def rewrite(j):
             if j in table: return table[j]
-            e = self.expressions[j]
+            tag = self.tags[j]
             if self.haveOverlap(i, j): r = RW(fc=1,ac=1,
                                               f=_i,a=_i)
-            elif e.isPrimitive or e.isInvented or e.isIndex:
+            elif tag == LEAF:
+                e = self.leaves[self.left[j]]
                 r = RW(fc=1,ac=1,
                        f=e,a=e)
-            elif e.isApplication:
-                f = rewrite(e.f)
-                x = rewrite(e.x)
+            elif tag == APPLICATION:
+                f = rewrite(self.left[j])
+                x = rewrite(self.right[j])
                 cost = f.fc + x.ac + epsilon
                 ep = Application(f.f, x.a) if cost < POSITIVEINFINITY else None
                 r = RW(fc=cost, ac=cost,
                        f=ep, a=ep)
-            elif e.isAbstraction:
-                b = rewrite(e.body)
+            elif tag == ABSTRACTION:
+                b = rewrite(self.left[j])
                 cost = b.ac + epsilon
                 ep = Abstraction(b.a) if cost < POSITIVEINFINITY else None
                 r = RW(f=None, fc=POSITIVEINFINITY,
                        a=ep, ac=cost)
-            elif e.isUnion:
-                children = [rewrite(z) for z in e ]
+            elif tag == UNION:
+                children = [rewrite(z) for z in self.children(j) ]
                 f,fc = min(( (child.f, child.fc) for child in children ),
                            key=cindex(1))
                 a,ac = min(( (child.a, child.ac) for child in children ),
@@ -887,6 +1055,78 @@ class VersionTable():
         frontiers = [g.rescoreFrontier(f) for f in frontiers]
         return g, frontiers
 
+class SharedVersionTable():
+    """The nodes of a VersionTable in shared memory, for processes that only read
+    them, e.g. to score candidate inventions. Each process attaches to it once and
+    gets a read-only VersionTable; forked processes map the same memory, and
+    unpickled copies find it by name."""
+    columns = ["tags", "left", "right", "members", "slots"]
+    attributes = ["typed", "identity", "factored", "debug", "leaves", "leaf2index",
+                  "universe", "empty", "superCache"]
+
+    def __init__(self, table):
+        self.table = None
+        self.memory = None
+        self.owner = True
+        if SharedMemory is None:
+            # Forked processes read the table itself
+            self.table = table
+            return
+
+        self.layout = []
+        offset = 0
+        for c in self.columns:
+            a = getattr(table, c)
+            self.layout.append((c, a.typecode, offset, len(a)))
+            # Keep every column 8 byte aligned
+            offset += (len(a)*a.itemsize + 7)//8*8
+        self.memory = SharedMemory(create=True, size=max(offset, 8))
+        self.name = self.memory.name
+        for c, _, o, n in self.layout:
+            a = getattr(table, c)
+            self.memory.buf[o:o + n*a.itemsize] = a.tobytes()
+        self.state = {k: getattr(table, k) for k in self.attributes}
+
+    def __getstate__(self):
+        assert self.memory is not None
+        return {"name": self.name, "layout": self.layout, "state": self.state}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.table = None
+        self.memory = None
+        self.owner = False
+
+    def attach(self):
+        if self.table is not None: return self.table
+        if self.memory is None: self.memory = SharedMemory(name=self.name)
+
+        v = VersionTable.__new__(VersionTable)
+        v.__dict__.update(self.state)
+        for c, typecode, o, n in self.layout:
+            itemsize = array(typecode).itemsize
+            setattr(v, c, self.memory.buf[o:o + n*itemsize].cast(typecode).toreadonly())
+        # Nothing is memoized: the table cannot grow
+        v.recursiveTable = None
+        v.substitutionTable = {}
+        v.inhabitantTable = None
+        v.functionInhabitantTable = None
+        v.overlapTable = {}
+        self.table = v
+        return v
+
+    def close(self):
+        """Detaches; the process that shared the table also frees the memory"""
+        if self.memory is None: return
+        if self.table is not None:
+            for c in self.columns:
+                getattr(self.table, c).release()
+        self.table = None
+        self.memory.close()
+        if self.owner: self.memory.unlink()
+        self.memory = None
+
+
 class CloseInventionVisitor():
     """normalize free variables - e.g., if $1 & $3 occur free then rename them to $0, $1
     then wrap in enough lambdas so that there are no free variables and finally wrap in invention"""
@@ -957,8 +1197,13 @@ def induceGrammar_Beta(g0, frontiers, _=None,
                        topK=2,
                        topI=50,
                        structurePenalty=1.,
-                       CPUs=1):
-    """grammar induction using only version spaces"""
+                       CPUs=1,
+                       incremental=False):
+    """grammar induction using only version spaces
+    incremental: keep the version table and its memo tables from one round to the next,
+    so that each round only builds the version spaces of the programs that the new
+    invention rewrote, and only recomputes the beams that depend on changed candidates.
+    Faster, but holds on to more memory."""
     from dreamcoder.fragmentUtilities import primitiveSize
     import gc
     
@@ -982,8 +1227,7 @@ def induceGrammar_Beta(g0, frontiers, _=None,
         sp = structurePenalty * sum(primitiveSize(p) for p in g.primitives)
         return ll - sp - aic*len(g.productions)
             
-    v = None
-    def scoreCandidate(candidate, currentFrontiers, currentGrammar):
+    def scoreCandidate(v, candidate, currentFrontiers, currentGrammar):
         try:
             newGrammar, newFrontiers = v.addInventionToGrammar(candidate, currentGrammar, currentFrontiers,
                                                                pseudoCounts=pseudoCounts)
@@ -1011,32 +1255,43 @@ def induceGrammar_Beta(g0, frontiers, _=None,
     oldScore = objective(g0, restrictedFrontiers)
     eprint("Starting grammar induction score",oldScore)
     
+    v = None
     while True:
-        v = VersionTable(typed=False, identity=False)
+        if v is None or not incremental:
+            v = VersionTable(typed=False, identity=False)
         with timing("constructed %d-step version spaces"%arity):
-            versions = [[v.superVersionSpace(v.incorporate(e.program), arity) for e in f]
+            programs = [e.program for f in restrictedFrontiers for e in f ]
+            spaces = dict(zip(programs, v.superVersionSpaces(programs, arity, CPUs=CPUs)))
+            versions = [[spaces[e.program] for e in f]
                         for f in restrictedFrontiers ]
-            eprint("Enumerated %d distinct version spaces"%len(v.expressions))
+            eprint("Enumerated %d distinct version spaces"%len(v))
         
         # Bigger beam because I feel like it
-        candidates = v.bestInventions(versions, bs=3*topI)[:topI]
+        candidates = v.bestInventions(versions, bs=3*topI, incremental=incremental)[:topI]
         eprint("Only considering the top %d candidates"%len(candidates))
 
-        # Clean caches that are no longer needed
-        v.recursiveTable = [None]*len(v)
-        v.inhabitantTable = [None]*len(v)
-        v.functionInhabitantTable = [None]*len(v)
-        v.substitutionTable = {}
-        gc.collect()
+        if not incremental:
+            # Clean caches that are no longer needed
+            v.recursiveTable = array('i', [-1])*len(v)
+            v.inhabitantTable = [None]*len(v)
+            v.functionInhabitantTable = [None]*len(v)
+            v.substitutionTable = {}
+            gc.collect()
         
-        with timing("scored the candidate inventions"):
-            scoredCandidates = parallelMap(CPUs,
-                                           lambda candidate: \
-                                           (candidate, scoreCandidate(candidate, restrictedFrontiers, g0)),
-                                            candidates,
-                                           memorySensitive=True,
-                                           chunksize=1,
-                                           maxtasksperchild=1)
+        # Workers read the table from shared memory, so that they do not copy it
+        # and can each score many candidates
+        shared = v.share()
+        try:
+            with timing("scored the candidate inventions"):
+                scoredCandidates = parallelMap(CPUs,
+                                               lambda candidate: \
+                                               (candidate, scoreCandidate(shared.attach(), candidate,
+                                                                          restrictedFrontiers, g0)),
+                                               candidates,
+                                               memorySensitive=True,
+                                               chunksize=1)
+        finally:
+            shared.close()
         if len(scoredCandidates) > 0:
             bestNew, bestScore = max(scoredCandidates, key=lambda sc: sc[1])
         if len(scoredCandidates) == 0 or bestScore < oldScore:
@@ -1056,9 +1311,8 @@ def induceGrammar_Beta(g0, frontiers, _=None,
         # terms of the new primitive. So we have to recalculate
         # version spaces for everything.
         with timing("constructed versions bases for entire frontiers"):
-            for f in frontiers:
-                for e in f:
-                    v.superVersionSpace(v.incorporate(e.program), arity)
+            v.superVersionSpaces([e.program for f in frontiers for e in f ],
+                                 arity, CPUs=CPUs)
         newGrammar, newFrontiers = v.addInventionToGrammar(bestNew, g0, frontiers,
                                                            pseudoCounts=pseudoCounts)
         eprint("Improved score to", bestScore, "(dS =", bestScore-oldScore, ") w/ invention",newGrammar.primitives[0],":",newGrammar.primitives[0].infer())
@@ -0,0 +1,344 @@
+"""Compact binary encoding of grammars, programs, task examples and frontiers.
+
+A message is the header MAGIC + one version byte, followed by a stream of
+operations. Every operation is one byte of opcode followed by its operands:
+  STRING, TYPE and NODE define a string, type or program node, giving it the
+    next index in its table;
+  GRAMMAR, FRONTIER, EXAMPLES and PROGRAM are the records that decoding yields,
+    and refer to strings, types and programs by index.
+A program node is only defined once per message, so programs travel as a DAG
+with shared subterms, and decoded programs share those subterms too.
+Unsigned integers are LEB128 varints, signed integers are zigzag varints and
+floats are little-endian doubles.
+decodeStream decodes from a file object as the bytes arrive.
+
+So far only frontiers travel in this format, from enumeration workers back to
+multicoreEnumeration. Grammars and task examples can be encoded too, but the
+OCaml and Rust solvers still read them as JSON: they have no decoder yet."""
+
+import io
+import pickle
+import struct
+
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Abstraction, Application, Index, Invented, Primitive
+from dreamcoder.type import TypeConstructor, TypeVariable
+
+
+MAGIC = b"DCW"
+WIREVERSION = 3
+
+# Operations
+STRING, TYPE, NODE, GRAMMAR, FRONTIER, EXAMPLES, PROGRAM = range(7)
+# Kinds of program node
+PRIMITIVE, INDEX, APPLICATION, ABSTRACTION, INVENTED = range(5)
+# Kinds of type
+CONSTRUCTOR, VARIABLE = range(2)
+# Kinds of value in task examples
+NONE, FALSE, TRUE, INTEGER, FLOAT, TEXT, LIST, TUPLE, PICKLED = range(9)
+
+DOUBLE = struct.Struct("<d")
+
+
+class WireFormatError(Exception):
+    pass
+
+
+class WireEncoder(object):
+    """Accumulates operations into a message; call getvalue for its bytes"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.buffer.write(MAGIC + bytes([WIREVERSION]))
+        self.strings = {}
+        self.types = {}
+        self.nodes = {}
+
+    def getvalue(self): return self.buffer.getvalue()
+
+    def unsigned(self, n):
+        write = self.buffer.write
+        while n >= 0x80:
+            write(bytes([(n & 0x7f) | 0x80]))
+            n >>= 7
+        write(bytes([n]))
+
+    def signed(self, n):
+        self.unsigned(n << 1 if n >= 0 else ((-n) << 1) - 1)
+
+    def double(self, x):
+        self.buffer.write(DOUBLE.pack(x))
+
+    def string(self, s):
+        """Index of s in the string table, defining it if needed"""
+        i = self.strings.get(s)
+        if i is None:
+            data = s.encode("utf-8")
+            self.buffer.write(bytes([STRING]))
+            self.unsigned(len(data))
+            self.buffer.write(data)
+            i = self.strings[s] = len(self.strings)
+        return i
+
+    def type(self, t):
+        """Index of t in the type table, defining it if needed"""
+        i = self.types.get(t)
+        if i is None:
+            if isinstance(t, TypeVariable):
+                self.buffer.write(bytes([TYPE, VARIABLE]))
+                self.unsigned(t.v)
+            else:
+                name = self.string(t.name)
+                arguments = [self.type(a) for a in t.arguments]
+                self.buffer.write(bytes([TYPE, CONSTRUCTOR]))
+                self.unsigned(name)
+                self.unsigned(len(arguments))
+                for a in arguments:
+                    self.unsigned(a)
+            i = self.types[t] = len(self.types)
+        return i
+
+    def program(self, p):
+        """Index of p in the node table, defining it and its subterms if needed"""
+        i = self.nodes.get(p)
+        if i is not None:
+            return i
+        if p.isApplication:
+            f, x = self.program(p.f), self.program(p.x)
+            self.buffer.write(bytes([NODE, APPLICATION]))
+            self.unsigned(f)
+            self.unsigned(x)
+        elif p.isAbstraction:
+            body = self.program(p.body)
+            self.buffer.write(bytes([NODE, ABSTRACTION]))
+            self.unsigned(body)
+        elif p.isIndex:
+            self.buffer.write(bytes([NODE, INDEX]))
+            self.unsigned(p.i)
+        elif p.isInvented:
+            body = self.program(p.body)
+            self.buffer.write(bytes([NODE, INVENTED]))
+            self.unsigned(body)
+        elif p.isPrimitive:
+            name = self.string(p.name)
+            self.buffer.write(bytes([NODE, PRIMITIVE]))
+            self.unsigned(name)
+        else:
+            raise WireFormatError("Cannot encode program %s" % p)
+        i = self.nodes[p] = len(self.nodes)
+        return i
+
+    def value(self, v):
+        write = self.buffer.write
+        if v is None:
+            write(bytes([NONE]))
+        elif v is True:
+            write(bytes([TRUE]))
+        elif v is False:
+            write(bytes([FALSE]))
+        elif type(v) is int:
+            write(bytes([INTEGER]))
+            self.signed(v)
+        elif type(v) is float:
+            write(bytes([FLOAT]))
+            self.double(v)
+        elif type(v) is str:
+            data = v.encode("utf-8")
+            write(bytes([TEXT]))
+            self.unsigned(len(data))
+            write(data)
+        elif type(v) is list or type(v) is tuple:
+            write(bytes([LIST if type(v) is list else TUPLE]))
+            self.unsigned(len(v))
+            for x in v:
+                self.value(x)
+        else:
+            data = pickle.dumps(v)
+            write(bytes([PICKLED]))
+            self.unsigned(len(data))
+            write(data)
+
+    def encodeProgram(self, p):
+        i = self.program(p)
+        self.buffer.write(bytes([PROGRAM]))
+        self.unsigned(i)
+
+    def encodeGrammar(self, g):
+        productions = [(l, self.type(t), self.program(p)) for l, t, p in g.productions]
+        continuationType = None if g.continuationType is None else self.type(g.continuationType)
+        self.buffer.write(bytes([GRAMMAR]))
+        self.double(g.logVariable)
+        if continuationType is None:
+            self.unsigned(0)
+        else:
+            self.unsigned(continuationType + 1)
+        self.unsigned(len(productions))
+        for l, t, p in productions:
+            self.double(l)
+            self.unsigned(t)
+            self.unsigned(p)
+
+    def encodeFrontier(self, f):
+        name = self.string(f.task.name)
+        programs = [self.program(e.program) for e in f]
+        self.buffer.write(bytes([FRONTIER]))
+        self.unsigned(name)
+        self.unsigned(len(programs))
+        for p, e in zip(programs, f):
+            self.unsigned(p)
+            self.double(e.logPrior)
+            self.double(e.logLikelihood)
+            self.double(e.logPosterior)
+
+    def encodeExamples(self, task):
+        name = self.string(task.name)
+        request = self.type(task.request)
+        self.buffer.write(bytes([EXAMPLES]))
+        self.unsigned(name)
+        self.unsigned(request)
+        self.unsigned(len(task.examples))
+        for xs, y in task.examples:
+            self.value(tuple(xs))
+            self.value(y)
+
+
+class WireDecoder(object):
+    """Decodes the operations of one message from a file object"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        header = self.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise WireFormatError("Not a wire format message")
+        if header[-1] != WIREVERSION:
+            raise WireFormatError("Wire format version %d, expected %d" % (header[-1], WIREVERSION))
+        self.strings = []
+        self.types = []
+        self.nodes = []
+
+    def read(self, n):
+        data = self.stream.read(n)
+        if len(data) < n:
+            raise WireFormatError("Truncated wire format message")
+        return data
+
+    def unsigned(self):
+        n = 0
+        shift = 0
+        while True:
+            b = self.read(1)[0]
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def signed(self):
+        n = self.unsigned()
+        return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+    def double(self): return DOUBLE.unpack(self.read(8))[0]
+
+    def value(self):
+        kind = self.read(1)[0]
+        if kind == NONE: return None
+        if kind == TRUE: return True
+        if kind == FALSE: return False
+        if kind == INTEGER: return self.signed()
+        if kind == FLOAT: return self.double()
+        if kind == TEXT: return self.read(self.unsigned()).decode("utf-8")
+        if kind == LIST: return [self.value() for _ in range(self.unsigned())]
+        if kind == TUPLE: return tuple(self.value() for _ in range(self.unsigned()))
+        if kind == PICKLED: return pickle.loads(self.read(self.unsigned()))
+        raise WireFormatError("Unknown value kind %d" % kind)
+
+    def records(self):
+        """Yields the records of the message, as they are decoded:
+        ("grammar", Grammar), ("frontier", task name, [FrontierEntry]),
+        ("examples", task name, request, examples) and ("program", Program)"""
+        while True:
+            op = self.stream.read(1)
+            if not op:
+                return
+            op = op[0]
+            if op == STRING:
+                self.strings.append(self.read(self.unsigned()).decode("utf-8"))
+            elif op == TYPE:
+                kind = self.read(1)[0]
+                if kind == VARIABLE:
+                    self.types.append(TypeVariable(self.unsigned()))
+                else:
+                    name = self.strings[self.unsigned()]
+                    self.types.append(TypeConstructor(name, [self.types[self.unsigned()]
+                                                             for _ in range(self.unsigned())]))
+            elif op == NODE:
+                kind = self.read(1)[0]
+                if kind == APPLICATION:
+                    f = self.nodes[self.unsigned()]
+                    self.nodes.append(Application(f, self.nodes[self.unsigned()]))
+                elif kind == ABSTRACTION:
+                    self.nodes.append(Abstraction(self.nodes[self.unsigned()]))
+                elif kind == INDEX:
+                    self.nodes.append(Index(self.unsigned()))
+                elif kind == INVENTED:
+                    self.nodes.append(Invented(self.nodes[self.unsigned()]))
+                elif kind == PRIMITIVE:
+                    name = self.strings[self.unsigned()]
+                    if name not in Primitive.GLOBALS:
+                        raise WireFormatError("Unknown primitive %s" % name)
+                    self.nodes.append(Primitive.GLOBALS[name])
+                else:
+                    raise WireFormatError("Unknown program node kind %d" % kind)
+            elif op == GRAMMAR:
+                logVariable = self.double()
+                continuationType = self.unsigned()
+                continuationType = None if continuationType == 0 else self.types[continuationType - 1]
+                productions = []
+                for _ in range(self.unsigned()):
+                    l = self.double()
+                    t = self.types[self.unsigned()]
+                    productions.append((l, t, self.nodes[self.unsigned()]))
+                yield "grammar", Grammar(logVariable, productions, continuationType=continuationType)
+            elif op == FRONTIER:
+                name = self.strings[self.unsigned()]
+                entries = []
+                for _ in range(self.unsigned()):
+                    p = self.nodes[self.unsigned()]
+                    logPrior, logLikelihood, logPosterior = self.double(), self.double(), self.double()
+                    entries.append(FrontierEntry(p, logPrior=logPrior, logLikelihood=logLikelihood,
+                                                 logPosterior=logPosterior))
+                yield "frontier", name, entries
+            elif op == EXAMPLES:
+                name = self.strings[self.unsigned()]
+                request = self.types[self.unsigned()]
+                examples = [(self.value(), self.value()) for _ in range(self.unsigned())]
+                yield "examples", name, request, examples
+            elif op == PROGRAM:
+                yield "program", self.nodes[self.unsigned()]
+            else:
+                raise WireFormatError("Unknown operation %d" % op)
+
+
+def decodeStream(stream):
+    """Yields the records of the message being read from stream; see WireDecoder.records"""
+    return WireDecoder(stream).records()
+
+
+def decode(data):
+    return list(decodeStream(io.BytesIO(data)))
+
+
+def encodeFrontiers(frontiers):
+    e = WireEncoder()
+    for f in frontiers:
+        e.encodeFrontier(f)
+    return e.getvalue()
+
+
+def decodeFrontiers(data, tasks):
+    """tasks: the task of each frontier, in the order they were encoded.
+    Task names need not be unique, as frontiers are matched to tasks by position."""
+    records = [entries for _, _, entries in decodeStream(io.BytesIO(data))]
+    if len(records) != len(tasks):
+        raise WireFormatError("Expected %d frontiers, got %d" % (len(tasks), len(records)))
+    return [Frontier(entries, task=t) for t, entries in zip(tasks, records)]
@@ -15,13 +15,15 @@ open Grammar
 open Task
 open FastType
 
-let load_problems channel =
+let deserialize_dsl g =
+  try deserialize_grammar g |> make_dummy_contextual
+  with _ -> deserialize_contextual_grammar g
+
+let load_problems_json ?grammar j =
   let open Yojson.Basic.Util in
-  let j = Yojson.Basic.from_channel channel in
-  let g = j |> member "DSL" in
-  let g =
-    try deserialize_grammar g |> make_dummy_contextual
-    with _ -> deserialize_contextual_grammar g
+  let g = match grammar with
+    | Some(g) -> g
+    | None -> j |> member "DSL" |> deserialize_dsl
   in
 
   let timeout = try
@@ -116,6 +118,8 @@ let load_problems channel =
    maxParameters,
    nc,timeout,verbose)
 
+let load_problems channel = load_problems_json (Yojson.Basic.from_channel channel)
+
 let export_frontiers number_enumerated tf solutions : string =
   let open Yojson.Basic.Util in
   let open Yojson.Basic in
@@ -130,19 +134,100 @@ let export_frontiers number_enumerated tf solutions : string =
   in pretty_to_string serialization
 ;;
 
-
-let _ =
-
+let solve ?grammar j =
   let (tf,g,
        lowerBound,upperBound,budgetIncrement,
        mfp,
      nc,timeout, verbose) =
-    load_problems Pervasives.stdin in
+    load_problems_json ?grammar j in
   let solutions, number_enumerated =
     enumerate_for_tasks ~maxFreeParameters:mfp ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
     ~verbose:verbose ~nc:nc ~timeout:timeout g tf
   in
-  export_frontiers number_enumerated tf solutions |> print_string ;;
+  export_frontiers number_enumerated tf solutions
+;;
+
+(* Server mode (solver --server): answers one request after another on stdin/stdout,
+   so that Python can keep a pool of solvers instead of starting one per job.
+   Requests and responses are framed as a 4 byte big-endian length followed by that much JSON.
+   A request may name its grammar by "grammarID", and each task may name its examples
+   by "examplesID"; the DSL or the examples can then be left out if an earlier request
+   sent them with the same ID. If one of them has since been forgotten, the response
+   is {"error": "unknown"} and the request should be sent again in full. *)
+let cached_grammars = Hashtbl.Poly.create();;
+let cached_grammar_order = Queue.create();;
+let maximum_cached_grammars = 32;;
+let cached_examples = Hashtbl.Poly.create();;
+let cached_examples_order = Queue.create();;
+let maximum_cached_examples = 4096;;
+
+let remember table order maximum key data =
+  if not (Hashtbl.mem table key) then begin
+    Queue.enqueue order key;
+    if Queue.length order > maximum then
+      Hashtbl.remove table (Queue.dequeue_exn order)
+  end;
+  Hashtbl.set table ~key:key ~data:data
+;;
+
+let request_grammar j =
+  let open Yojson.Basic.Util in
+  match j |> member "grammarID" with
+  | `Null -> Some(j |> member "DSL" |> deserialize_dsl)
+  | id ->
+    let id = id |> to_string in
+    match j |> member "DSL" with
+    | `Null -> Hashtbl.find cached_grammars id
+    | dsl ->
+      let g = deserialize_dsl dsl in
+      remember cached_grammars cached_grammar_order maximum_cached_grammars id g;
+      Some(g)
+;;
+
+(* The request with the examples of every task filled in *)
+let request_examples j =
+  let open Yojson.Basic.Util in
+  let tasks = j |> member "tasks" |> to_list |> List.map ~f:(fun t ->
+      match t |> member "examplesID" with
+      | `Null -> Some(t)
+      | id ->
+        let id = id |> to_string in
+        match t |> member "examples" with
+        | `Null ->
+          Hashtbl.find cached_examples id |> Option.map ~f:(fun e ->
+              `Assoc(("examples", e) :: to_assoc t))
+        | e ->
+          remember cached_examples cached_examples_order maximum_cached_examples id e;
+          Some(t))
+  in
+  if List.for_all tasks ~f:Option.is_some then
+    Some(`Assoc(("tasks", `List(List.filter_map tasks ~f:(fun t -> t))) ::
+                (to_assoc j |> List.filter ~f:(fun (k, _) -> not (String.equal k "tasks")))))
+  else None
+;;
+
+let serve () =
+  let rec loop () =
+    match (try Some(Pervasives.input_binary_int Pervasives.stdin) with End_of_file -> None) with
+    | None -> ()
+    | Some(n) ->
+      let j = Pervasives.really_input_string Pervasives.stdin n |> Yojson.Basic.from_string in
+      let response = match request_grammar j, request_examples j with
+        | Some(g), Some(j) -> solve ~grammar:g j
+        | _ -> Yojson.Basic.to_string (`Assoc([("error", `String("unknown"))]))
+      in
+      Pervasives.output_binary_int Pervasives.stdout (String.length response);
+      Pervasives.output_string Pervasives.stdout response;
+      (* flush before the next request: forked enumeration workers must not inherit buffered output *)
+      Pervasives.flush Pervasives.stdout;
+      loop ()
+  in
+  loop ()
+;;
+
+let _ =
+  if Array.exists Sys.argv ~f:(fun a -> String.equal a "--server") then serve () else
+    Yojson.Basic.from_channel Pervasives.stdin |> solve |> print_string ;;
 
 (* let tune_differentiation () = *)
 (*   let (tf,g, *)
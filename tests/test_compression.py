@@ -1,4 +1,13 @@
 import unittest
+from unittest import mock
+
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import k0, k1, addition
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+from dreamcoder.vs import induceGrammar_Beta
 
 
 class TestCompression(unittest.TestCase):
@@ -9,6 +18,19 @@ class TestCompression(unittest.TestCase):
         except Exception:
             self.fail('Unable to import from compression module')
 
+    @mock.patch('dreamcoder.compression.callCompiled')
+    def test_version_space_compressors(self, callCompiled):
+        from dreamcoder.compression import induceGrammar
+        g = Grammar.uniform([k0, k1, addition])
+        frontiers = [Frontier([FrontierEntry(Program.parse("(lambda (+ $0 1))"), logPrior=0., logLikelihood=0.)],
+                              task=Task("add1", arrow(tint, tint), []))]
+        callCompiled.side_effect = lambda f, g, frontiers, **k: (g, frontiers)
+        for backend, incremental in [("pypy_vs", False), ("pypy_vs_incremental", True)]:
+            induceGrammar(g, frontiers, backend=backend, iteration=0, topk_use_only_likelihood=False)
+            f, _, _ = callCompiled.call_args[0]
+            self.assertIs(f, induceGrammar_Beta)
+            self.assertEqual(callCompiled.call_args[1]["incremental"], incremental)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,84 @@
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.dreamStore import DreamStore
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint, tlist
+
+
+def dream(source, request, examples=[], features=None, logPrior=-1.):
+    return Frontier([FrontierEntry(Program.parse(source), logPrior=logPrior, logLikelihood=0.)],
+                    task=Task("Helmholtz", request, examples, features=features))
+
+
+class TestDreamStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.grammar = Grammar.uniform(bootstrapTarget())
+        self.request = arrow(tlist(tint), tlist(tint))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_deduplicates_and_persists(self):
+        bucket = DreamStore(self.directory).bucket(self.grammar, self.request)
+        examples = [(([1, 2],), [2])]
+        self.assertTrue(bucket.add(dream("(lambda (cdr $0))", self.request, examples)))
+        # Same program
+        self.assertFalse(bucket.add(dream("(lambda (cdr $0))", self.request)))
+        # Same behavior
+        self.assertFalse(bucket.add(dream("(lambda (cdr (cons (car $0) $0)))", self.request, examples)))
+        self.assertTrue(bucket.add(dream("(lambda $0)", self.request, [(([1, 2],), [1, 2])],
+                                         logPrior=-3.)))
+        self.assertEqual(len(bucket), 2)
+
+        # Another grammar or request has its own bucket
+        self.assertEqual(len(DreamStore(self.directory).bucket(self.grammar,
+                                                               arrow(tlist(tint), tint))), 0)
+        g = Grammar.uniform(bootstrapTarget()[1:])
+        self.assertEqual(len(DreamStore(self.directory).bucket(g, self.request)), 0)
+
+        frontiers = DreamStore(self.directory).bucket(self.grammar, self.request).frontiers()
+        self.assertEqual([str(f.bestPosterior.program) for f in frontiers], ["(lambda (cdr $0))", "(lambda $0)"])
+        self.assertEqual([f.bestPosterior.logPrior for f in frontiers], [-1., -3.])
+        self.assertEqual(frontiers[0].task.examples, examples)
+
+    def test_arrays_are_memory_mapped(self):
+        random.seed(0)
+        bucket = DreamStore(self.directory).bucket(self.grammar, self.request)
+        images = [np.random.rand(4, 4).astype(np.float32) for _ in range(3)]
+        for n, image in enumerate(images):
+            self.assertTrue(bucket.add(dream("(lambda (cons %d $0))" % n, self.request, features=image)))
+        self.assertFalse(bucket.add(dream("(lambda (cons 3 $0))", self.request, features=images[0])))
+        # Not the same shape as the others, so it stays in the record
+        self.assertTrue(bucket.add(dream("(lambda (cons 4 $0))", self.request, features=np.zeros(2))))
+        frontiers = DreamStore(self.directory).bucket(self.grammar, self.request).frontiers()
+        for f, image in zip(frontiers, images):
+            self.assertIsInstance(f.task.features, np.memmap)
+            self.assertTrue((f.task.features == image).all())
+        self.assertTrue((frontiers[3].task.features == np.zeros(2)).all())
+
+    def test_summaries(self):
+        bucket = DreamStore(self.directory).bucket(self.grammar, self.request)
+        f = dream("(lambda (cdr $0))", self.request)
+        summary = self.grammar.closedLikelihoodSummary(self.request, f.bestPosterior.program)
+        bucket.add(f, summaries=("Grammar", [summary]))
+        bucket = DreamStore(self.directory).bucket(self.grammar, self.request)
+        loaded = bucket.frontiers("Grammar")[0].bestPosterior.program
+        self.assertEqual({str(p): n for p, n in loaded.uses.items()}, {str(p): n for p, n in summary.uses.items()})
+        self.assertEqual({frozenset(map(str, ps)): n for ps, n in loaded.normalizers.items()},
+                         {frozenset(map(str, ps)): n for ps, n in summary.normalizers.items()})
+        self.assertIsInstance(bucket.frontiers("ContextualGrammar")[0].bestPosterior.program, Program)
+
+
+if __name__ == '__main__':
+    unittest.main()
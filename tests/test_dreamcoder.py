@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 
 class TestEcModule(unittest.TestCase):
@@ -16,6 +17,13 @@ class TestEcModule(unittest.TestCase):
         except Exception:
             self.fail('Unable to import ec module')
 
+    @mock.patch('dreamcoder.dreamcoder.multicoreEnumeration')
+    def test_wake_passes_observational_equivalence(self, mock_enumeration):
+        from dreamcoder.dreamcoder import default_wake_generative
+        mock_enumeration.return_value = ([], {})
+        default_wake_generative(None, [], solver='python', observationalEquivalence=True)
+        self.assertTrue(mock_enumeration.call_args[1]["observationalEquivalence"])
+
 
 if __name__ == '__main__':
     unittest.main()
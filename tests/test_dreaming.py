@@ -1,4 +1,31 @@
+import shutil
+import sys
+import tempfile
 import unittest
+from unittest import mock
+
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import k0, k1, addition
+from dreamcoder.dreamStore import ENUMERATED, SAMPLED, DreamStore
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+from dreamcoder.wireFormat import encodeFrontiers
+
+
+class SynchronousPool(object):
+    def __init__(self, _): pass
+
+    def apply_async(self, f, args=(), kwds={}):
+        result = f(*args, **kwds)
+        return mock.Mock(get=lambda: result)
+
+
+def enumerated(g, request, inputs, timeout, **_):
+    return encodeFrontiers(Frontier([FrontierEntry(Program.parse(source), logPrior=-1., logLikelihood=0.)],
+                                    task=Task(str(b), request, []))
+                           for b, source in enumerate(["(lambda 0)", "(lambda 1)", "(lambda $0)"]))
 
 
 class TestDreaming(unittest.TestCase):
@@ -10,6 +37,40 @@ class TestDreaming(unittest.TestCase):
         except Exception:
             self.fail('Unable to import from dreaming module')
 
+    @mock.patch('dreamcoder.dreaming.helmholtzFrontiers', side_effect=enumerated)
+    def test_only_complete_enumerations_are_reused(self, helmholtzFrontiers):
+        from dreamcoder.dreaming import backgroundHelmholtzEnumeration
+        directory = tempfile.mkdtemp()
+        pathos = mock.Mock(Pool=SynchronousPool)
+        try:
+            g = Grammar.uniform([k0, k1, addition])
+            request = arrow(tint, tint)
+            tasks = [Task("t", request, [((1,), 2)])]
+            store = DreamStore(directory)
+            # A sampled dream, and what is left of an enumeration that was killed
+            store.bucket(g, request, SAMPLED).add(
+                Frontier([FrontierEntry(Program.parse("(lambda (+ $0 1))"), logPrior=-2., logLikelihood=0.)],
+                         task=Task("Helmholtz", request, [((1,), 2)])))
+            store.bucket(g, request, ENUMERATED).add(
+                Frontier([FrontierEntry(Program.parse("(lambda 0)"), logPrior=-1., logLikelihood=0.)],
+                         task=Task("0", request, [])))
+            with mock.patch.dict(sys.modules, {'pathos': pathos, 'pathos.multiprocessing': pathos}):
+                frontiers = backgroundHelmholtzEnumeration(tasks, g, 1., store=store)()
+            self.assertEqual(helmholtzFrontiers.call_count, 1)
+            self.assertEqual(len(frontiers), 3)
+            store = DreamStore(directory)
+            self.assertTrue(store.bucket(g, request, ENUMERATED).complete)
+            self.assertFalse(store.bucket(g, request, SAMPLED).complete)
+            self.assertEqual(len(store.bucket(g, request, ENUMERATED)), 3)
+            self.assertEqual(len(store.bucket(g, request, SAMPLED)), 1)
+
+            frontiers = backgroundHelmholtzEnumeration(tasks, g, 1., store=store)()
+            self.assertEqual(helmholtzFrontiers.call_count, 1)
+            self.assertEqual(sorted(str(f.bestPosterior.program) for f in frontiers),
+                             ["(lambda $0)", "(lambda 0)", "(lambda 1)"])
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,17 @@
+import os
 import random
 import unittest
 from unittest import mock
 
-from dreamcoder.enumeration import multicoreEnumeration
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import k0, k1, addition, subtraction
+from dreamcoder.evaluationCache import EvaluationCache
+from dreamcoder.enumeration import ObservationalEquivalence, SolverPool, SolverWorker, enumerateForTasks, \
+    launchParallelProcess, multicoreEnumeration, ocamlSolverMessage
 from dreamcoder.frontier import Frontier
 from dreamcoder.grammar import Grammar
 from dreamcoder.task import Task
-from dreamcoder.type import arrow, tint
+from dreamcoder.type import Context, arrow, tint
+from dreamcoder.utilities import get_root_dir
 
 
 def add1():
@@ -57,6 +62,169 @@ class TestEnumerationMain(unittest.TestCase):
         self.assertEqual(frontiers, [])
         self.assertEqual(best_search_time, {})
 
+    def test_multicore_enumeration_python_solver(self):
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        task = get_add1_task()
+        frontiers, best_search_time = multicoreEnumeration(
+            grammar, [task], solver='python', maximumFrontier=1, enumerationTimeout=10,
+            evaluationTimeout=0.1)
+        self.assertEqual(len(frontiers), 1)
+        self.assertEqual(len(frontiers[0]), 1)
+        program = frontiers[0].bestPosterior.program
+        self.assertTrue(task.check(program, timeout=1.))
+        self.assertIsNotNone(best_search_time[task])
+
+    def test_multicore_enumeration_observational_equivalence(self):
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        task = get_add1_task()
+        frontiers, _ = multicoreEnumeration(
+            grammar, [task], solver='python', maximumFrontier=1, enumerationTimeout=10,
+            evaluationTimeout=0.1, observationalEquivalence=True)
+        self.assertEqual(len(frontiers[0]), 1)
+        self.assertTrue(task.check(frontiers[0].bestPosterior.program, timeout=1.))
+
+    def test_observational_equivalence_finds_the_same_frontiers(self):
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        tasks = [get_add1_task(), get_add2_task(),
+                 Task("zero", arrow(tint, tint, tint), [((1, 2), 0), ((3, 5), 0)])]
+        found = [multicoreEnumeration(grammar, tasks, solver='python', maximumFrontier=1,
+                                      enumerationTimeout=10, evaluationTimeout=0.1,
+                                      observationalEquivalence=observationalEquivalence)[0]
+                 for observationalEquivalence in [False, True]]
+        unpruned, pruned = [[(f.task, f.bestPosterior.logPosterior) for f in frontiers]
+                            for frontiers in found]
+        self.assertEqual(pruned, unpruned)
+        for task, frontier in zip(tasks, found[1]):
+            self.assertTrue(task.check(frontier.bestPosterior.program, timeout=1.))
+
+    def test_observational_equivalence_is_not_sharded(self):
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        task = get_add1_task()
+        with mock.patch('dreamcoder.enumeration.launchParallelProcess',
+                        wraps=launchParallelProcess) as launch:
+            frontiers, _ = multicoreEnumeration(
+                grammar, [task], solver='python', CPUs=3, maximumFrontier=1,
+                enumerationTimeout=10, evaluationTimeout=0.1, observationalEquivalence=True)
+        self.assertEqual(len(frontiers[0]), 1)
+        self.assertGreater(launch.call_count, 0)
+        self.assertTrue(all(c[1]["shard"] is None for c in launch.call_args_list))
+        with self.assertRaises(AssertionError):
+            enumerateForTasks(grammar, [task], None, timeout=1, maximumFrontiers={task: 1},
+                              observationalEquivalence=True, shard=(0, 2))
+
+    def test_multicore_enumeration_shards(self):
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        add1 = get_add1_task()
+        zero = Task("zero", arrow(tint, tint, tint), [((1, 2), 0), ((3, 5), 0)])
+        frontiers, best_search_time = multicoreEnumeration(
+            grammar, [add1, zero], solver='python', CPUs=3, maximumFrontier=1,
+            enumerationTimeout=10, evaluationTimeout=0.1)
+        self.assertEqual([len(f) for f in frontiers], [1, 1])
+        for task, frontier in zip([add1, zero], frontiers):
+            self.assertTrue(task.check(frontier.bestPosterior.program, timeout=1.))
+            self.assertIsNotNone(best_search_time[task])
+
+    def test_multicore_enumeration_shares_evaluation_cache(self):
+        EvaluationCache.CACHE = EvaluationCache()
+        try:
+            grammar = Grammar.uniform([k0, k1, addition, subtraction])
+            add1 = get_add1_task()
+            add1.cache = True
+            zero = Task("zero", arrow(tint, tint, tint), [((1, 2), 0), ((3, 5), 0)], cache=True)
+            frontiers, _ = multicoreEnumeration(
+                grammar, [add1, zero], solver='python', CPUs=2, maximumFrontier=1,
+                enumerationTimeout=10, evaluationTimeout=0.1)
+            self.assertTrue(EvaluationCache.get().statistics()["shared"])
+            self.assertEqual([len(f) for f in frontiers], [1, 1])
+        finally:
+            EvaluationCache.CACHE.close()
+            EvaluationCache.CACHE = None
+
+    def test_observational_equivalence_prunes(self):
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        task = get_add1_task()
+        pruner = ObservationalEquivalence([task], evaluationTimeout=0.1)
+        unpruned = [p for _, _, p in grammar.stackEnumeration(Context.EMPTY, [], task.request, 9.)]
+        pruned = [p for _, _, p in grammar.stackEnumeration(Context.EMPTY, [], task.request, 9.,
+                                                            pruneSubprogram=pruner)]
+        self.assertGreater(pruner.pruned, 0)
+        self.assertLess(len(pruned), len(unpruned))
+        self.assertTrue(set(pruned) < set(unpruned))
+        # every behaviour of the unpruned search is still reachable
+        behaviour = lambda p: tuple(p.runWithArguments(xs) for xs, _ in task.examples)
+        self.assertEqual({behaviour(p) for p in pruned}, {behaviour(p) for p in unpruned})
+
+    @mock.patch('dreamcoder.enumeration.SolverWorker')
+    def test_solver_pool_sends_grammar_once(self, mock_worker_class):
+        requests = []
+        def request(message):
+            requests.append(message)
+            return {"add1": [], "number_enumerated": 1}
+        worker = mock.MagicMock(grammars=set(), examples=set())
+        worker.request.side_effect = request
+        mock_worker_class.return_value = worker
+        pool = SolverPool()
+        grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        for _ in range(3):
+            self.assertEqual(pool.solve(grammar, {"tasks": []})["number_enumerated"], 1)
+        self.assertEqual(mock_worker_class.call_count, 1)
+        self.assertEqual(["DSL" in r for r in requests], [True, False, False])
+        self.assertEqual(len({r["grammarID"] for r in requests}), 1)
+
+    @mock.patch('dreamcoder.enumeration.SolverWorker')
+    def test_solver_pool_resends_forgotten_grammar(self, mock_worker_class):
+        requests = []
+        def request(message):
+            requests.append(message)
+            if "DSL" not in message:
+                return {"error": "unknown"}
+            return {"add1": []}
+        worker = mock.MagicMock(grammars=set(), examples=set())
+        worker.request.side_effect = request
+        mock_worker_class.return_value = worker
+        pool = SolverPool()
+        grammar = Grammar.uniform([k0, k1])
+        pool.solve(grammar, {"tasks": []})
+        self.assertEqual(pool.solve(grammar, {"tasks": []}), {"add1": []})
+        self.assertEqual(["DSL" in r for r in requests], [True, False, True])
+
+    @mock.patch('dreamcoder.enumeration.SolverWorker')
+    def test_solver_pool_grammar_ids(self, mock_worker_class):
+        requests = []
+        def request(message):
+            requests.append(message)
+            return {}
+        worker = mock.MagicMock(grammars=set(), examples=set())
+        worker.request.side_effect = request
+        mock_worker_class.return_value = worker
+        pool = SolverPool()
+        pool.solve(Grammar.uniform([k0, k1]), {"tasks": []})
+        # Equal as grammars, but not the same request for the solver
+        pool.solve(Grammar.uniform([k0, k1], continuationType=tint), {"tasks": []})
+        pool.solve(Grammar.uniform([k0, k1]), {"tasks": []})
+        self.assertEqual(["DSL" in r for r in requests], [True, True, False])
+        self.assertEqual(requests[0]["grammarID"], requests[2]["grammarID"])
+        self.assertNotEqual(requests[0]["grammarID"], requests[1]["grammarID"])
+
+    @mock.patch('dreamcoder.enumeration.SolverWorker')
+    def test_solver_pool_sends_examples_once(self, mock_worker_class):
+        requests = []
+        def request(message):
+            requests.append(message)
+            return {}
+        worker = mock.MagicMock(grammars=set(), examples=set())
+        worker.request.side_effect = request
+        mock_worker_class.return_value = worker
+        pool = SolverPool()
+        grammar = Grammar.uniform([k0, k1])
+        task1, task2 = get_add1_task(), get_add2_task()
+        message = lambda tasks: ocamlSolverMessage(grammar, tasks, maximumFrontiers={task1: 1, task2: 1})
+        pool.solve(grammar, message([task1]))
+        pool.solve(grammar, message([task1, task2]))
+        self.assertEqual([["examples" in t for t in r["tasks"]] for r in requests],
+                         [[True], [False, True]])
+        self.assertEqual(requests[0]["tasks"][0]["examplesID"], requests[1]["tasks"][0]["examplesID"])
+
     @mock.patch('dreamcoder.enumeration.subprocess')
     def test_multicore_enumeration_single_task(self, mock_subprocess):
         mock_process = mock.MagicMock()
@@ -116,5 +284,43 @@ class TestEnumerationMain(unittest.TestCase):
                 grammar, tasks, maximumFrontier=1, enumerationTimeout=1)
 
 
+
+@unittest.skipUnless(os.path.exists(os.path.join(get_root_dir(), 'solver')),
+                     "the OCaml solver has not been built (make solver)")
+class TestSolverServer(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        self.task = get_add1_task()
+
+    def message(self):
+        return ocamlSolverMessage(self.grammar, [self.task], CPUs=1, timeout=10, lowerBound=0.,
+                                  upperBound=100., budgetIncrement=1.5, evaluationTimeout=0.1,
+                                  maximumFrontiers={self.task: 1})
+
+    def test_round_trip(self):
+        worker = SolverWorker()
+        try:
+            message = self.message()
+            message["tasks"][0]["examplesID"] = "add1"
+            response = worker.request(dict(message, DSL=self.grammar.json(), grammarID="g"))
+            self.assertEqual(len(response["add1"]), 1)
+            # The grammar and the examples are remembered under their IDs
+            del message["tasks"][0]["examples"]
+            self.assertEqual(len(worker.request(dict(message, grammarID="g"))["add1"]), 1)
+            self.assertEqual(worker.request(dict(message, grammarID="h")), {"error": "unknown"})
+            message["tasks"][0]["examplesID"] = "add2"
+            self.assertEqual(worker.request(dict(message, grammarID="g")), {"error": "unknown"})
+        finally:
+            worker.close()
+        self.assertEqual(worker.process.returncode, 0)
+
+    def test_multicore_enumeration(self):
+        frontiers, times = multicoreEnumeration(self.grammar, [self.task], solver='ocamlPool',
+                                                maximumFrontier=1, enumerationTimeout=10,
+                                                evaluationTimeout=0.1)
+        self.assertTrue(self.task.check(frontiers[0].bestPosterior.program, timeout=1.))
+        self.assertIsNotNone(times[self.task])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import multiprocessing
+import unittest
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.evaluationCache import MISSING, EvaluationCache, evaluationKey, inputKey, programKey
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import Context, arrow, tint, tlist
+
+
+def storeInChild(cache, entries):
+    for k, v in entries:
+        cache.store(k, v)
+
+
+class TestEvaluationCache(unittest.TestCase):
+
+    def setUp(self):
+        EvaluationCache.CACHE = EvaluationCache()
+        self.keys = [evaluationKey(programKey(Program.parse("(lambda $0)")), inputKey((n,)))
+                     for n in range(10)]
+
+    def tearDown(self):
+        EvaluationCache.CACHE.close()
+        EvaluationCache.CACHE = None
+
+    def test_lru(self):
+        cache = EvaluationCache(maximumSize=4)
+        for n, k in enumerate(self.keys[:5]):
+            cache.store(k, n)
+        self.assertIs(cache.lookup(self.keys[0]), MISSING)
+        self.assertEqual(cache.lookup(self.keys[1]), 1)
+        cache.store(self.keys[5], 5)
+        # 1 was used more recently than 2
+        self.assertEqual(cache.lookup(self.keys[1]), 1)
+        self.assertIs(cache.lookup(self.keys[2]), MISSING)
+        statistics = cache.statistics()
+        self.assertEqual((statistics["hits"], statistics["misses"], statistics["size"]), (2, 2, 4))
+        self.assertEqual(statistics["hitRate"], 0.5)
+
+    def test_shared_between_processes(self):
+        cache = EvaluationCache.get()
+        cache.share(slots=64)
+        entries = [(k, [n, "output"]) for n, k in enumerate(self.keys)] + [(self.keys[0], "x" * 1000)]
+        child = multiprocessing.get_context("fork").Process(target=storeInChild, args=(cache, entries))
+        child.start()
+        child.join()
+        self.assertEqual(len(cache.table), 0)
+        found = [cache.lookup(k) for k in self.keys]
+        # The last entry was too big for a slot, slots may collide, but nothing is wrong
+        self.assertTrue(all(v is MISSING or v == [n, "output"] for n, v in enumerate(found)))
+        self.assertGreater(cache.statistics()["sharedHits"], 5)
+        # A slot halfway through being rewritten is ignored
+        cache.clear()
+        offset = cache.slot(self.keys[3])
+        cache.shared.buf[offset + 30] ^= 0xff
+        self.assertIs(cache.lookup(self.keys[3]), MISSING)
+
+    def test_tasks_share_evaluations(self):
+        g = Grammar.uniform(bootstrapTarget())
+        request = arrow(tlist(tint), tint)
+        inputs = [([1, 2, 3],), ([4, 0],), ([],)]
+        tasks = [Task(name, request, [(xs, y) for xs, y in zip(inputs, outputs)], cache=cache)
+                 for name, outputs, cache in [("sum", [6, 4, 0], True), ("length", [3, 2, 0], True),
+                                              ("uncached", [3, 2, 0], False)]]
+        programs = [p for _, _, p in g.enumeration(Context.EMPTY, [], request, 8.)]
+        for p in programs:
+            expected = tasks[2].check(p, 1.)
+            self.assertEqual(tasks[1].check(p, 1.), expected)
+            self.assertEqual(Task.checkBatch(p, tasks[:2], 1.), [tasks[0].check(p, 1.), expected])
+        statistics = EvaluationCache.get().statistics()
+        self.assertGreater(statistics["hits"], statistics["misses"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,15 @@
 import unittest
+from collections import Counter
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.fragmentGrammar import FragmentGrammar, FragmentScorer
+from dreamcoder.fragmentUtilities import RewriteFragments, SubexpressionIndex, mightMatch, nontrivial, \
+    proposeFragmentsFromFragment, proposeFragmentsFromFrontiers, proposeFragmentsFromProgram
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint, tlist
 
 
 class TestFragmentGrammar(unittest.TestCase):
@@ -10,5 +21,85 @@ class TestFragmentGrammar(unittest.TestCase):
             self.fail('Unable to import from fragmentGrammar module')
 
 
+class FrontiersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = FragmentGrammar.fromGrammar(Grammar.uniform(bootstrapTarget()))
+        sources = ["(lambda (map (lambda (+ $0 1)) $0))", "(lambda (map (lambda (+ $0 $0)) $0))",
+                   "(lambda (map (lambda (+ 1 $0)) (cdr $0)))", "(lambda (cdr (cdr $0)))",
+                   "(lambda (cdr (map (lambda (+ $0 1)) $0)))", "(lambda (cons (car $0) (cdr (cdr $0))))",
+                   "(lambda (map (lambda (- $0 1)) (cdr (cdr $0))))",
+                   "(lambda (cons 1 (map (lambda (+ $0 1)) $0)))"]
+        request = arrow(tlist(tint), tlist(tint))
+        # Some frontiers have a second entry
+        self.frontiers = [Frontier([FrontierEntry(Program.parse(s), logPrior=0., logLikelihood=0.)] +
+                                   ([FrontierEntry(Program.parse(sources[(k + 1) % len(sources)]),
+                                                   logPrior=0., logLikelihood=-1.)] if k % 3 == 0 else []),
+                                   task=Task("t%d" % k, request, []))
+                          for k, s in enumerate(sources)]
+
+
+
+class TestFragmentScorer(FrontiersTestCase):
+
+    def grammarScore(self, fragment):
+        g = FragmentGrammar.uniform(self.grammar.primitives + [fragment])
+        g = g.insideOutside(self.frontiers, 1.)
+        return FragmentScorer.penalize(g, g.jointFrontiersMDL(self.frontiers), 1., 0.001)
+
+    def test_matches_grammar_score(self):
+        scorer = FragmentScorer(self.grammar, self.frontiers)
+        fragments = [f for f in proposeFragmentsFromFrontiers(self.frontiers, 2)
+                     if f not in self.grammar.primitives]
+        self.assertGreater(len(fragments), 20)
+        for fragment in fragments:
+            expected, g1 = self.grammarScore(fragment)
+            score, g2 = scorer.score(fragment)
+            self.assertAlmostEqual(score, expected, places=6)
+            self.assertAlmostEqual(g1.logVariable, g2.logVariable, places=6)
+            for (l1, _, p1), (l2, _, p2) in zip(g1.productions, g2.productions):
+                self.assertEqual(p1, p2)
+                self.assertAlmostEqual(l1, l2, places=6)
+
+    def test_only_touched_frontiers_are_parsed(self):
+        scorer = FragmentScorer(self.grammar, self.frontiers)
+        fragment = Program.parse("(lambda (cons (car $0) $1))")
+        self.assertEqual(scorer.touched(fragment), [5])
+
+
+class TestSubexpressionIndex(FrontiersTestCase):
+
+    def test_matches_might_match(self):
+        index = SubexpressionIndex()
+        for j, f in enumerate(self.frontiers):
+            for e in f:
+                index.add(e.program, j)
+        subexpressions = {s: {j for j, f in enumerate(self.frontiers)
+                              for e in f for _, t in e.program.walk() if t == s}
+                          for f in self.frontiers for e in f for _, s in e.program.walk()}
+        self.assertEqual(len(index), len(subexpressions))
+        fragments = proposeFragmentsFromFrontiers(self.frontiers, 2)
+        for fragment in fragments + [Program.parse("(lambda $1)"), Program.parse("(map $0 $1)")]:
+            matches = {s for s in subexpressions if mightMatch(fragment, s)}
+            self.assertEqual(index.matches(fragment), matches)
+            self.assertEqual(index.keys(fragment), {j for s in matches for j in subexpressions[s]})
+
+    def test_proposals_match_brute_force(self):
+        for a in [1, 2]:
+            counts = Counter(f for frontier in self.frontiers
+                             for f in {fp for entry in frontier
+                                       for f in proposeFragmentsFromProgram(entry.program, a)
+                                       for fp in proposeFragmentsFromFragment(f)})
+            expected = {f for f, n in counts.items() if n >= 2 and f.wellTyped() and nontrivial(f)}
+            self.assertEqual(set(proposeFragmentsFromFrontiers(self.frontiers, a)), expected)
+
+    def test_rewrite_matches_brute_force(self):
+        for fragment in proposeFragmentsFromFrontiers(self.frontiers, 1):
+            rewritten = RewriteFragments.rewriteFrontiers(self.frontiers, fragment)
+            for f1, f2 in zip(rewritten, self.frontiers):
+                f2 = RewriteFragments.rewriteFrontier(f2, fragment)
+                self.assertEqual([e.program for e in f1], [e.program for e in f2])
+
+
 if __name__ == '__main__':
     unittest.main()
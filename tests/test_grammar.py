@@ -0,0 +1,151 @@
+import pickle
+import random
+import unittest
+
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import k0, k1, addition, subtraction
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.grammar import ContextualGrammar, ContextualGrammarMatrix, Grammar, SymmetryRules, \
+    violatesSymmetry
+from dreamcoder.type import Context, arrow, tint, tlist
+
+
+def uncachedGrammar(g):
+    g = Grammar(g.logVariable, g.productions, continuationType=g.continuationType)
+    g._cachedCandidates = lambda request, context, environment, mustBeLeaf, upperBound=None: \
+        (g._buildCandidates(request, context, environment, mustBeLeaf) or None, None)
+    return g
+
+
+def enumerate_programs(g, request, upperBound):
+    return [(round(l, 6), str(p))
+            for l, _, p in g.enumeration(Context.EMPTY, [], request, upperBound)]
+
+
+class TestGrammarCandidateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform(bootstrapTarget())
+        self.request = arrow(tlist(tint), tint)
+
+    def test_enumeration_matches_uncached(self):
+        cached = enumerate_programs(self.grammar, self.request, 8.)
+        uncached = enumerate_programs(uncachedGrammar(self.grammar), self.request, 8.)
+        self.assertEqual(cached, uncached)
+        statistics = self.grammar.candidateCacheStatistics()
+        self.assertGreater(statistics["hits"], statistics["misses"])
+
+    def test_likelihood_matches_uncached(self):
+        uncached = uncachedGrammar(self.grammar)
+        for l, _, p in self.grammar.enumeration(Context.EMPTY, [], self.request, 7.):
+            self.assertAlmostEqual(self.grammar.logLikelihood(self.request, p), l, places=5)
+            self.assertAlmostEqual(uncached.logLikelihood(self.request, p), l, places=5)
+
+    def test_stack_enumeration_matches_recursive(self):
+        for request in [self.request, arrow(tint, tlist(tint), tlist(tint))]:
+            recursive = enumerate_programs(self.grammar, request, 9.)
+            stack = [(round(l, 6), str(p))
+                     for l, _, p in self.grammar.stackEnumeration(Context.EMPTY, [], request, 9.)]
+            self.assertEqual(recursive, stack)
+            self.assertEqual(len(set(stack)), len(stack))
+
+    def test_stack_enumeration_bounds(self):
+        for l, _, p in self.grammar.stackEnumeration(Context.EMPTY, [], self.request, 9.,
+                                                     lowerBound=7.):
+            self.assertTrue(7. <= -l < 9.)
+
+    def test_stack_enumeration_shards(self):
+        request = arrow(tlist(tint), tlist(tint))
+        everything = sorted(enumerate_programs(self.grammar, request, 12.))
+        for count in [2, 5]:
+            shards = [[(round(l, 6), str(p))
+                       for l, _, p in self.grammar.stackEnumeration(Context.EMPTY, [], request, 12.,
+                                                                    shard=(i, count))]
+                      for i in range(count)]
+            self.assertEqual(sorted(sum(shards, [])), everything)
+            self.assertTrue(all(shards))
+
+    def test_cache_is_not_pickled(self):
+        enumerate_programs(self.grammar, self.request, 6.)
+        g = pickle.loads(pickle.dumps(self.grammar))
+        self.assertEqual(g, self.grammar)
+        self.assertEqual(g.candidateCacheStatistics()["size"], 0)
+
+
+class TestContextualGrammarMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform(bootstrapTarget())
+        self.request = arrow(tlist(tint), tint)
+        self.matrix = ContextualGrammarMatrix.fromGrammar(self.grammar)
+        self.contextual = ContextualGrammar.fromGrammar(self.grammar)
+
+    def test_matches_contextual_grammar(self):
+        programs = [p for _, _, p in self.contextual.enumeration(Context.EMPTY, [], self.request, 7.)]
+        self.assertGreater(len(programs), 10)
+        for p in programs:
+            self.assertAlmostEqual(self.matrix.logLikelihood(self.request, p),
+                                   self.contextual.logLikelihood(self.request, p), places=5)
+        self.assertEqual(sorted(str(p) for _, _, p in
+                                self.matrix.enumeration(Context.EMPTY, [], self.request, 7.)),
+                         sorted(str(p) for p in programs))
+        self.assertEqual(self.matrix.json(), self.contextual.json())
+
+    def test_summaries_are_sparse(self):
+        p = next(p for _, _, p in self.matrix.enumeration(Context.EMPTY, [], self.request, 7.)
+                 if p.size() >= 3)
+        summary = self.matrix.closedLikelihoodSummary(self.request, p)
+        self.assertLess(len(summary.rows), len(self.matrix.weights))
+        joined = self.matrix.closedLikelihoodSummary(self.request, p)
+        joined.join(summary)
+        self.assertAlmostEqual(joined.logLikelihood(self.matrix),
+                               2 * summary.logLikelihood(self.matrix), places=5)
+
+        summary = pickle.loads(pickle.dumps(summary))
+        self.assertAlmostEqual(summary.logLikelihood(self.matrix),
+                               self.contextual.logLikelihood(self.request, p), places=5)
+
+    def test_sample_and_pickle(self):
+        g = pickle.loads(pickle.dumps(self.matrix))
+        self.assertEqual(g.rowGrammars, {})
+        for _ in range(10):
+            p = g.sample(self.request, maxAttempts=100)
+            if p is not None:
+                self.assertGreater(g.logLikelihood(self.request, p), float("-inf"))
+
+
+class TestSymmetryRules(unittest.TestCase):
+
+    def test_hand_coded_rules_match_violatesSymmetry(self):
+        g = Grammar.uniform(bootstrapTarget())
+        for l, _, p in g.enumeration(Context.EMPTY, [], arrow(tlist(tint), tint), 8.):
+            for f in g.primitives:
+                for j in range(len(f.infer().functionArguments())):
+                    self.assertEqual(g.symmetryRules.violates(f, p.body, j),
+                                     violatesSymmetry(f, p.body, j))
+
+    def test_learn_arithmetic(self):
+        g = Grammar.uniform([k0, k1, addition, subtraction])
+        random.seed(1)
+        state = random.getstate()
+        learned = SymmetryRules.learn(g)
+        self.assertEqual(learned, g.symmetryRules)
+        self.assertEqual(random.getstate(), state)
+
+    def test_learned_rules_prune_enumeration(self):
+        g = Grammar.uniform(bootstrapTarget())
+        learned = g.learnSymmetryRules()
+        self.assertGreater(len(learned.symmetryRules), len(g.symmetryRules))
+        self.assertEqual(pickle.loads(pickle.dumps(learned)).symmetryRules, learned.symmetryRules)
+        # Recognition models reweight the grammar, and keep its rules
+        reweighted = learned.withLogProductions([-1.] * (len(learned.productions) + 1))
+        self.assertIs(reweighted.symmetryRules, learned.symmetryRules)
+        request = arrow(tlist(tint), tlist(tint))
+        original = {p for _, _, p in g.stackEnumeration(Context.EMPTY, [], request, 10.)}
+        pruned = [p for _, _, p in learned.stackEnumeration(Context.EMPTY, [], request, 10.)]
+        self.assertEqual(pruned, [p for _, _, p in learned.enumeration(Context.EMPTY, [], request, 10.)])
+        self.assertLess(len(pruned), len(original))
+        self.assertTrue(set(pruned) <= original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,384 @@
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
 import unittest
+from unittest import mock
+
+import torch
+import torch.nn as nn
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.dreamStore import DreamBucket, DreamStore
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import ContextualGrammar, Grammar, LikelihoodSummary
+from dreamcoder.program import Program
+from dreamcoder.recognition import ContextualGrammarNetwork, ContextualGrammarNetwork_LowRank, \
+    ContextualGrammarNetwork_Mask, GrammarNetwork, HelmholtzProducer, InferenceModel, RecognitionModel, \
+    dataParallelWorker
+from dreamcoder.task import Task
+from dreamcoder.type import Context, arrow, tint, tlist
+
+
+class FeaturesFeatureExtractor(nn.Module):
+    """Featurizes a task by passing its features through a linear layer"""
+
+    def __init__(self, dimensionality=4):
+        super(FeaturesFeatureExtractor, self).__init__()
+        self.outputDimensionality = 8
+        self.layer = nn.Linear(dimensionality, self.outputDimensionality)
+
+    def featuresOfTask(self, t):
+        if t.features is None: return None
+        return self.layer(torch.tensor(t.features).float())
+
+
+class DreamingFeatureExtractor(FeaturesFeatureExtractor):
+    """Featurizes a task by the outputs of its program on a few lists"""
+    inputs = [[1, 2, 3], [4], [5, 0, 2, 2]]
+
+    def taskOfProgram(self, p, tp):
+        try:
+            outputs = [p.runWithArguments([xs]) for xs in self.inputs]
+        except Exception:
+            return None
+        return Task("Helmholtz", tp, list(zip([(xs,) for xs in self.inputs], outputs)),
+                    features=[float(sum(y) if isinstance(y, list) else y) / 10. for y in outputs] + [1.])
 
 
 class TestRecognition(unittest.TestCase):
 
     def test_imports(self):
         try:
-            from dreamcoder.recognition import RecognitionModel
+            from dreamcoder.recognition import ContextualGrammarNetwork, ContextualGrammarNetwork_LowRank, \
+    ContextualGrammarNetwork_Mask, GrammarNetwork, RecognitionModel
         except Exception:
             self.fail('Unable to import from recognition module')
 
 
+class TestCompiledSummaries(unittest.TestCase):
+
+    def test_matches_summary_likelihoods(self):
+        torch.manual_seed(0)
+        grammar = Grammar.uniform(bootstrapTarget())
+        request = arrow(tlist(tint), tlist(tint))
+        programs = [p for _, _, p in grammar.enumeration(Context.EMPTY, [], request, 9.)][::7]
+        for network in [GrammarNetwork(8, grammar), ContextualGrammarNetwork(8, grammar),
+                        ContextualGrammarNetwork_Mask(8, grammar),
+                        ContextualGrammarNetwork_LowRank(8, grammar, 4)]:
+            g = ContextualGrammar.fromGrammar(grammar) if network.__class__ is not GrammarNetwork else grammar
+            summaries = [g.closedLikelihoodSummary(request, p) for p in programs]
+            xs = torch.randn(len(summaries), 8)
+            for _ in range(2):  # the second time, everything is already compiled
+                lls = network.batchedLogLikelihoods(xs, summaries)
+                for x, summary, ll in zip(xs, summaries, lls.tolist()):
+                    self.assertAlmostEqual(summary.logLikelihood(network(x)).item(), ll, places=3)
+            lls.sum().backward()
+
+
+class TestBatchedInference(unittest.TestCase):
+
+    def assertSameGrammar(self, g1, g2):
+        self.assertEqual([(t, p) for _, t, p in g1.productions], [(t, p) for _, t, p in g2.productions])
+        for (l1, _, _), (l2, _, _) in zip(g1.productions, g2.productions):
+            self.assertAlmostEqual(l1, l2, places=5)
+        self.assertAlmostEqual(g1.logVariable, g2.logVariable, places=5)
+
+    def test_matches_grammar_of_task(self):
+        torch.manual_seed(0)
+        grammar = Grammar.uniform(bootstrapTarget())
+        tasks = [Task("t%d" % n, arrow(tlist(tint), tint), [], features=[float(n), 1., -1., 0.5])
+                 for n in range(5)]
+        tasks[2].features = None
+        for contextual, mask, rank in [(False, False, None), (True, False, None), (True, True, None),
+                                       (True, False, 4)]:
+            model = RecognitionModel(FeaturesFeatureExtractor(), grammar, hidden=[16],
+                                     contextual=contextual, mask=mask, rank=rank)
+            grammars = model.grammarsOfTasks(tasks)
+            self.assertEqual(set(grammars), set(tasks[:2] + tasks[3:]))
+            for t, g in grammars.items():
+                expected = model.grammarOfTask(t).untorch()
+                if contextual:
+                    self.assertSameGrammar(g.noParent, expected.noParent)
+                    self.assertSameGrammar(g.variableParent, expected.variableParent)
+                    for e, gs in expected.library.items():
+                        for g1, g2 in zip(g.library[e], gs):
+                            self.assertSameGrammar(g1, g2)
+                else:
+                    self.assertSameGrammar(g, expected)
+    def assertSameContextualGrammar(self, g1, g2):
+        self.assertSameGrammar(g1.noParent, g2.noParent)
+        self.assertSameGrammar(g1.variableParent, g2.variableParent)
+        for e, gs in g2.library.items():
+            for h1, h2 in zip(g1.library[e], gs):
+                self.assertSameGrammar(h1, h2)
+
+    def test_exported_model_matches(self):
+        torch.manual_seed(0)
+        grammar = Grammar.uniform(bootstrapTarget())
+        tasks = [Task("t%d" % n, arrow(tlist(tint), tint), [], features=[float(n), 1., -1., 0.5])
+                 for n in range(5)]
+        tasks[2].features = None
+        directory = tempfile.mkdtemp()
+        try:
+            for contextual, mask, rank in [(False, False, None), (True, False, None), (True, True, None),
+                                           (True, False, 4)]:
+                model = RecognitionModel(FeaturesFeatureExtractor(), grammar, hidden=[16],
+                                         contextual=contextual, mask=mask, rank=rank)
+                path = os.path.join(directory, "inference.pickle")
+                model.exportInference(path)
+                exported = InferenceModel.load(path)
+                self.assertFalse(any(p.requires_grad for p in exported.featureExtractor.parameters()))
+                self.assertTrue(all(p.requires_grad for p in model.parameters()))
+                grammars = exported.grammarsOfTasks(tasks)
+                expected = model.grammarsOfTasks(tasks)
+                self.assertEqual(set(grammars), set(expected))
+                for t, g in grammars.items():
+                    if contextual:
+                        self.assertSameContextualGrammar(g, expected[t])
+                    else:
+                        self.assertSameGrammar(g, expected[t])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestRecognitionOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.grammar = Grammar.uniform(bootstrapTarget())
+        self.tasks = [Task("t%d" % n, arrow(tlist(tint), tint), [], features=[float(n), 1., -1., 0.5])
+                      for n in range(4)]
+
+    def test_matches_uncached_metrics(self):
+        for contextual in [False, True]:
+            model = RecognitionModel(FeaturesFeatureExtractor(), self.grammar, hidden=[16],
+                                     contextual=contextual)
+            hidden = model.taskHiddenStates(self.tasks)
+            logProductions = model.taskGrammarLogProductions(self.tasks)
+            entropies = model.taskGrammarEntropies(self.tasks)
+            auxiliary = model.taskAuxiliaryLossLayer(self.tasks)
+            for t in self.tasks:
+                features = model.featureExtractor.featuresOfTask(t)
+                self.assertTrue(torch.allclose(torch.tensor(hidden[t]), model._MLP(features), atol=1e-5))
+                self.assertTrue(torch.allclose(torch.tensor(logProductions[t]),
+                                               model.grammarLogProductionsOfTask(t), atol=1e-5))
+                self.assertAlmostEqual(float(entropies[t]), model.grammarEntropyOfTask(t).item(), places=4)
+                self.assertTrue(torch.allclose(torch.tensor(auxiliary[t]),
+                                               model._auxiliaryPrediction(features), atol=1e-5))
+
+    def test_runs_network_once_until_optimizer_steps(self):
+        model = RecognitionModel(FeaturesFeatureExtractor(), self.grammar, hidden=[16])
+        calls = []
+        featuresOfTask = model.featureExtractor.featuresOfTask
+        model.featureExtractor.featuresOfTask = lambda t: calls.append(t) or featuresOfTask(t)
+
+        before = model.taskGrammarLogProductions(self.tasks)
+        model.taskHiddenStates(self.tasks)
+        model.taskGrammarEntropies(self.tasks)
+        model.grammarsOfTasks(self.tasks)
+        self.assertEqual(len(calls), len(self.tasks))
+
+        frontiers = [Frontier([FrontierEntry(Program.parse("(lambda (car $0))"), logPrior=0., logLikelihood=0.)],
+                              task=t)
+                     for t in self.tasks]
+        model.train(frontiers, steps=3, batchSize=2, lr=0.1)
+        del calls[:]
+        after = model.taskGrammarLogProductions(self.tasks)
+        self.assertEqual(len(calls), len(self.tasks))
+        self.assertFalse(all((before[t] == after[t]).all() for t in self.tasks))
+
+
+class TestExampleCache(unittest.TestCase):
+
+    def setUp(self):
+        from dreamcoder.domains.list.main import LearnedFeatureExtractor
+        random.seed(0)
+        torch.manual_seed(0)
+        request = arrow(tlist(tint), tlist(tint))
+        self.tasks = [Task("t%d" % n, request,
+                           [((xs,), xs[::-1])
+                            for xs in [[random.randint(0, 9) for _ in range(random.randint(0, 6))]
+                                       for _ in range(random.randint(1, 8))]])
+                      for n in range(10)]
+        self.extractor = LearnedFeatureExtractor(self.tasks)
+
+    def test_matches_forward(self):
+        batched = self.extractor.featuresOfTasks(self.tasks)
+        for t, features in zip(self.tasks, batched):
+            expected = self.extractor(t.examples)
+            self.assertLess((self.extractor.featuresOfTask(t) - expected).abs().max().item(), 1e-5)
+            self.assertLess((features - expected).abs().max().item(), 1e-5)
+
+    def test_cache(self):
+        t = self.tasks[0]
+        indices = self.extractor.exampleIndices(t)
+        self.assertIs(self.extractor.exampleIndices(t), indices)
+        # Another task with the same name is not the same task
+        self.assertIsNot(self.extractor.exampleIndices(Task(t.name, t.request, t.examples)), indices)
+        self.extractor.symbolToIndex = dict(self.extractor.symbolToIndex)
+        self.assertIsNot(self.extractor.exampleIndices(t), indices)
+        self.assertEqual(len(self.extractor.exampleCache), 1)
+
+
+class TestHelmholtzProducer(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        torch.manual_seed(0)
+        self.model = RecognitionModel(DreamingFeatureExtractor(), Grammar.uniform(bootstrapTarget()),
+                                      hidden=[16])
+        self.requests = [arrow(tlist(tint), tint)]
+
+    def test_produces_dreams(self):
+        for CPUs in [1, 3]:
+            producer = HelmholtzProducer(self.model, self.requests, CPUs=CPUs, batch=10, prefetch=20)
+            dreams = [producer.get() for _ in range(30)]
+            statistics = producer.statistics()
+            self.assertEqual(statistics["workers"], CPUs - 1)
+            producer.close()
+            for f in dreams:
+                self.assertEqual(f.task.request, self.requests[0])
+                self.assertTrue(all(isinstance(e.program, LikelihoodSummary) for e in f))
+            self.assertGreater(statistics["dreams"], 0)
+            self.assertLessEqual(statistics["starvation"], 1.)
+
+    def test_reuses_stored_dreams(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = DreamStore(directory)
+            producer = HelmholtzProducer(self.model, self.requests, batch=10, store=store)
+            for _ in range(10): producer.get()
+            stored = len(store.bucket(self.model.generativeModel, self.requests[0]))
+            self.assertGreater(stored, 0)
+            producer = HelmholtzProducer(self.model, self.requests, batch=10, store=DreamStore(directory))
+            for _ in range(stored): producer.get()
+            self.assertEqual(producer.statistics()["dreams"], 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_workers_store_dreams(self):
+        directory = tempfile.mkdtemp()
+        try:
+            producer = HelmholtzProducer(self.model, self.requests, CPUs=3, batch=10, prefetch=20,
+                                         store=DreamStore(directory))
+            with mock.patch.object(DreamBucket, "add", autospec=True, side_effect=DreamBucket.add) as add:
+                producer.start()
+                for _ in range(30): producer.get()
+                producer.close()
+            # Only the workers, which were forked with the mock, added dreams
+            self.assertEqual(add.call_count, 0)
+            self.assertGreater(len(DreamStore(directory).bucket(self.model.generativeModel,
+                                                                self.requests[0])), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_train_on_dreams(self):
+        self.model.train([], steps=20, helmholtzRatio=1., helmholtzBatch=10, CPUs=2,
+                         defaultRequest=self.requests[0], batchSize=4)
+        self.assertTrue(self.model.trained)
+
+
+class TestMinibatchTraining(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        torch.manual_seed(0)
+        self.grammar = Grammar.uniform(bootstrapTarget())
+        request = arrow(tlist(tint), tlist(tint))
+        sources = ["(lambda (cdr $0))", "(lambda (map (lambda (+ $0 1)) $0))",
+                   "(lambda (cons (car $0) $0))", "(lambda (map (lambda (+ $0 $0)) (cdr $0)))",
+                   "(lambda (cdr (cdr $0)))"]
+        self.frontiers = [Frontier([FrontierEntry(Program.parse(s), logPrior=0., logLikelihood=-float(k))
+                                    for k, s in enumerate(sources[n:n + 1 + n % 3])],
+                                   task=Task("t%d" % n, request, [],
+                                             features=[random.random() for _ in range(4)]))
+                          for n in range(len(sources))]
+
+    def model(self, contextual):
+        return RecognitionModel(FeaturesFeatureExtractor(), self.grammar, hidden=[16],
+                                contextual=contextual)
+
+    def test_matches_single_frontier_losses(self):
+        for contextual in [False, True]:
+            model = self.model(contextual)
+            frontiers = [model.replaceProgramsWithLikelihoodSummaries(f).normalize()
+                         for f in self.frontiers]
+            loss, al, used, losses = model.minibatchLoss(frontiers, True)
+            self.assertEqual(used, frontiers)
+            expected = [model.frontierBiasOptimal(f)[0].item() for f in frontiers]
+            for actual, e in zip(losses.tolist(), expected):
+                self.assertAlmostEqual(actual, e, places=4)
+            self.assertAlmostEqual(loss.item(), sum(expected) / len(expected), places=4)
+            self.assertAlmostEqual(al.item(),
+                                   sum(model.frontierBiasOptimal(f)[1].item() for f in frontiers) / len(frontiers),
+                                   places=4)
+
+            # With one entry per frontier there is nothing to sample
+            single = [Frontier(f.entries[:1], task=f.task) for f in frontiers]
+            _, _, _, losses = model.minibatchLoss(single, False)
+            for actual, f in zip(losses.tolist(), single):
+                self.assertAlmostEqual(actual, model.frontierKL(f)[0].item(), places=4)
+
+    def test_drops_frontiers_without_features(self):
+        model = self.model(False)
+        frontiers = [model.replaceProgramsWithLikelihoodSummaries(f) for f in self.frontiers]
+        frontiers[1].task.features = None
+        _, _, used, losses = model.minibatchLoss(frontiers, False)
+        self.assertEqual(used, frontiers[:1] + frontiers[2:])
+        self.assertEqual(len(losses), len(used))
+
+    def test_train(self):
+        for biasOptimal in [False, True]:
+            model = self.model(True)
+            frontiers = [model.replaceProgramsWithLikelihoodSummaries(f).normalize()
+                         for f in self.frontiers]
+            before = model.minibatchLoss(frontiers, True)[0].item()
+            model.train(self.frontiers, steps=60, batchSize=3, biasOptimal=biasOptimal, lr=0.01)
+            self.assertTrue(model.trained)
+            self.assertLess(model.minibatchLoss(frontiers, True)[0].item(), before)
+
+    def test_train_data_parallel(self):
+        model = self.model(True)
+        frontiers = [model.replaceProgramsWithLikelihoodSummaries(f).normalize() for f in self.frontiers]
+        before = model.minibatchLoss(frontiers, True)[0].item()
+        threads = torch.get_num_threads()
+        torch.set_num_threads(4)
+        torchState = torch.get_rng_state()
+        try:
+            model.train(self.frontiers, steps=40, batchSize=2, biasOptimal=True, lr=0.01, dataParallel=2)
+            # Training in this process leaves its threads and random numbers alone
+            self.assertEqual(torch.get_num_threads(), 4)
+            self.assertTrue(torch.equal(torch.get_rng_state(), torchState))
+        finally:
+            torch.set_num_threads(threads)
+        self.assertTrue(model.trained)
+        self.assertLess(model.minibatchLoss(frontiers, True)[0].item(), before)
+
+    def test_all_reduce(self):
+        """Every process ends up with the same parameters"""
+        model = self.model(False)
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        processes = [context.Process(target=trainAndReport, args=(model, self.frontiers, rank, port, queue))
+                     for rank in range(2)]
+        for process in processes: process.start()
+        parameters = [queue.get(timeout=120) for _ in processes]
+        for process in processes: process.join()
+        self.assertEqual(parameters[0], parameters[1])
+        self.assertNotEqual(parameters[0], [p.detach().numpy().tolist() for p in model.parameters()])
+
+
+def trainAndReport(model, frontiers, rank, port, queue):
+    dataParallelWorker(model, frontiers, {"steps": 10, "batchSize": 2, "biasOptimal": False},
+                       rank, 2, port, 0.5, 1, 1)
+    queue.put([p.detach().numpy().tolist() for p in model.parameters()])
+
+
 if __name__ == '__main__':
     unittest.main()
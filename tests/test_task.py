@@ -0,0 +1,81 @@
+import random
+import unittest
+from unittest import mock
+
+from dreamcoder.domains.list.listPrimitives import basePrimitives, bootstrapTarget
+from dreamcoder.grammar import Grammar
+from dreamcoder.likelihoodModel import AllOrNothingLikelihoodModel
+from dreamcoder.program import FAILED, VECTORIZED, EvaluationTimeout, Program
+from dreamcoder.task import Task
+from dreamcoder.type import Context, arrow, tint, tlist
+
+
+def makeTask(name, request, source, inputs):
+    f = Program.parse(source).evaluate([])
+    examples = []
+    for xs in inputs:
+        y = f
+        for x in xs:
+            y = y(x)
+        examples.append((xs, y))
+    return Task(name, request, examples)
+
+
+class TestBatchEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        basePrimitives()
+        bootstrapTarget()
+        random.seed(0)
+        self.request = arrow(tlist(tint), tint, tint)
+        # Enough examples for the integer primitives to go through numpy
+        inputs = [([random.randint(-5, 5) for _ in range(random.randint(0, 4))], random.randint(-3, 3))
+                  for _ in range(40)]
+        self.tasks = [makeTask("add", self.request, "(lambda (lambda (+ $0 $0)))", inputs),
+                      makeTask("head", self.request,
+                               "(lambda (lambda (if (empty? $1) $0 (car $1))))", inputs),
+                      makeTask("product", self.request, "(lambda (lambda (* $0 (car $1))))",
+                               [xs for xs in inputs if xs[0]])]
+
+    def programs(self, primitives, upperBound):
+        g = Grammar.uniform(primitives)
+        return [p for _, _, p in g.enumeration(Context.EMPTY, [], self.request, upperBound)]
+
+    def test_matches_check(self):
+        for primitives in [basePrimitives(), bootstrapTarget()]:
+            successes = 0
+            for p in self.programs(primitives, 10.):
+                batch = Task.checkBatch(p, self.tasks, 1.)
+                self.assertEqual(batch, [t.check(p, 1.) for t in self.tasks], str(p))
+                successes += sum(batch)
+            self.assertGreater(successes, 0)
+
+    def test_failures_and_partial_application(self):
+        car = Program.parse("(lambda (lambda (car $1)))")
+        self.assertEqual(car.evaluateBatch([([], 1), ([5], 1)]), [FAILED, 5])
+        # Fewer abstractions than arguments
+        self.assertEqual(Program.parse("(lambda car)").evaluateBatch([([5], [7]), ([5], [])]),
+                         [7, FAILED])
+        self.assertEqual(Program.parse("(lambda (lambda (+ $0)))").evaluateBatch([([], 1)])[0](2), 3)
+
+    def test_timeout_fails_the_remaining_tasks(self):
+        p = Program.parse("(lambda (lambda (+ $0 $0)))")
+        with mock.patch.object(Program, "evaluateBatch", side_effect=EvaluationTimeout()), \
+             mock.patch.object(Task, "check") as check:
+            self.assertEqual(Task.checkBatch(p, self.tasks, 1.), [False] * len(self.tasks))
+        # The tasks are not run again one by one
+        check.assert_not_called()
+
+    def test_builtins_are_not_vectorized(self):
+        self.assertNotIn(len, VECTORIZED)
+        self.assertNotIn(sum, VECTORIZED)
+
+    def test_score_batch(self):
+        model = AllOrNothingLikelihoodModel(timeout=1.)
+        for p in self.programs(bootstrapTarget(), 8.):
+            self.assertEqual(model.scoreBatch(p, self.tasks),
+                             [model.score(p, t) for t in self.tasks])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import random
+import unittest
+
+from dreamcoder.type import Context, Substitution, TypeVariable, UnificationFailure, \
+    arrow, baseType, tint, tlist
+
+
+class TestSubstitution(unittest.TestCase):
+
+    def test_matches_dictionary(self):
+        random.seed(0)
+        s = Substitution.EMPTY
+        d = {}
+        snapshots = []
+        for _ in range(500):
+            v = random.randint(0, 3000)
+            if v in d:
+                continue
+            snapshots.append((s, dict(d)))
+            t = baseType("t%d" % v)
+            s = s.extend(v, t)
+            d[v] = t
+        for v in range(3100):
+            self.assertEqual(s.lookup(v), d.get(v))
+        self.assertEqual(list(s.items()), sorted(d.items(), key=lambda vt: vt[0]))
+        # older versions are unaffected by later extensions
+        for old, oldD in snapshots[::25]:
+            self.assertEqual(dict(old.items()), oldD)
+
+
+class TestContext(unittest.TestCase):
+
+    def test_unify(self):
+        k, a = Context.EMPTY.makeVariable()
+        k, b = k.makeVariable()
+        k = k.unify(arrow(a, tlist(b)), arrow(tint, tlist(tint)))
+        self.assertEqual(a.apply(k), tint)
+        self.assertEqual(arrow(a, b).apply(k), arrow(tint, tint))
+        with self.assertRaises(UnificationFailure):
+            k.unify(a, tlist(tint))
+
+    def test_legacy_substitution_list(self):
+        k = Context(2, [(0, tint), (1, tlist(TypeVariable(0)))])
+        self.assertEqual(TypeVariable(1).apply(k), tlist(tint))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import pickle
+import unittest
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint, tlist
+from dreamcoder.vs import VersionTable
+
+
+class TestVersionTable(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform(bootstrapTarget())
+        self.programs = [Program.parse(s) for s in
+                         ["(lambda (map (lambda (+ $0 1)) $0))", "(lambda (cdr (cdr $0)))",
+                          "(lambda (cons (car $0) (cdr (cdr $0))))",
+                          "(lambda (map (lambda (+ $0 1)) (cdr $0)))"]]
+        self.frontiers = [Frontier([FrontierEntry(p, logPrior=0., logLikelihood=0.)],
+                                   task=Task("t%d" % k, arrow(tlist(tint), tlist(tint)), []))
+                          for k, p in enumerate(self.programs)]
+
+    def test_nodes_are_interned(self):
+        v = VersionTable(typed=False, identity=False)
+        heads = [v.incorporate(p) for p in self.programs]
+        n = len(v)
+        self.assertEqual([v.incorporate(p) for p in self.programs], heads)
+        self.assertEqual(len(v), n)
+        self.assertEqual([next(v.extract(h)) for h in heads], self.programs)
+        self.assertEqual(v.union(heads[::-1]), v.union(heads))
+        self.assertEqual(v.union([heads[0], v.union(heads[1:])]), v.union(heads))
+        self.assertEqual(set(v.extract(v.union(heads))), set(self.programs))
+
+    def test_version_spaces_survive_rehashing(self):
+        v = VersionTable(typed=False, identity=False)
+        spaces = [v.superVersionSpace(v.incorporate(p), 2) for p in self.programs]
+        self.assertGreater(len(v), len(v.slots) // 4)
+        for p, j in zip(self.programs, spaces):
+            extension = set(v.extract(j))
+            self.assertIn(p, extension)
+            for e in list(extension)[:200]:
+                self.assertEqual(e.betaNormalForm(), p)
+        v = pickle.loads(pickle.dumps(v))
+        self.assertEqual([v.superVersionSpace(v.incorporate(p), 2) for p in self.programs], spaces)
+
+    def test_sharded_construction_matches_serial(self):
+        serial = VersionTable(typed=False, identity=False)
+        expected = serial.superVersionSpaces(self.programs, 2)
+        v = VersionTable(typed=False, identity=False)
+        spaces = v.superVersionSpaces(self.programs, 2, CPUs=2)
+        self.assertEqual(len(v), len(serial))
+        for j, k in zip(spaces, expected):
+            self.assertEqual(set(v.extract(j)), set(serial.extract(k)))
+
+    def test_shared_table_reads_like_original(self):
+        v = VersionTable(typed=False, identity=False)
+        spaces = v.superVersionSpaces(self.programs, 1)
+        candidates = v.bestInventions([[j] for j in spaces])[:5]
+        self.assertGreater(len(candidates), 0)
+        expected = {}
+        for k in candidates:
+            g, frontiers = v.addInventionToGrammar(k, self.grammar, self.frontiers)
+            expected[k] = (g.productions, [(e.program, e.logPrior) for f in frontiers for e in f])
+        shared = v.share()
+        unpickled = pickle.loads(pickle.dumps(shared))
+        try:
+            for table in [shared.attach(), unpickled.attach()]:
+                self.assertEqual([table.superCache[table.incorporate(p)] for p in self.programs], spaces)
+                for k in candidates:
+                    self.assertEqual(table.rewriteWithInvention(k, spaces), v.rewriteWithInvention(k, spaces))
+                    # What the scoring workers do with the table
+                    g, frontiers = table.addInventionToGrammar(k, self.grammar, self.frontiers)
+                    self.assertEqual((g.productions, [(e.program, e.logPrior) for f in frontiers for e in f]),
+                                     expected[k])
+        finally:
+            unpickled.close()
+            shared.close()
+
+    def test_incremental_beams_match_fresh_ones(self):
+        programs = self.programs + [Program.parse(s) for s in
+                                    ["(lambda (cdr (cdr (cdr $0))))", "(lambda (cons (car $0) (cdr $0)))"]]
+        v = VersionTable(typed=False, identity=False)
+        for n in [2, 4, len(programs)]:
+            versions = [[j] for j in v.superVersionSpaces(programs[:n], 1)]
+            incremental = v.bestInventions(versions, bs=10**6, incremental=True)
+            fresh = v.bestInventions(versions, bs=10**6)
+            self.assertEqual(set(incremental), set(fresh))
+        self.assertGreater(len(fresh), 0)
+
+    def test_scores_are_repeatable(self):
+        v = VersionTable(typed=False, identity=False)
+        spaces = v.superVersionSpaces(self.programs, 1)
+        k = v.bestInventions([[j] for j in spaces])[0]
+        g1, _ = v.addInventionToGrammar(k, self.grammar, self.frontiers)
+        g2, _ = v.addInventionToGrammar(k, self.grammar, self.frontiers)
+        self.assertEqual(g1.productions, g2.productions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import io
+import unittest
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Invented, Program
+from dreamcoder.task import Task
+from dreamcoder.type import Context, arrow, baseType, tint, tlist
+from dreamcoder.wireFormat import WireEncoder, WireFormatError, decode, decodeFrontiers, \
+    decodeStream, encodeFrontiers
+
+
+class TestWireFormat(unittest.TestCase):
+
+    def setUp(self):
+        primitives = bootstrapTarget()
+        self.invented = Invented(Program.parse("(lambda (map (lambda (+ $0 1)) $0))"))
+        self.grammar = Grammar(-1.5, [(-0.5 * i, p.infer(), p)
+                                      for i, p in enumerate(primitives + [self.invented])],
+                               continuationType=baseType("tower"))
+        self.request = arrow(tlist(tint), tlist(tint))
+        self.programs = [p for _, _, p in
+                         self.grammar.enumeration(Context.EMPTY, [], self.request, 9.)]
+
+    def test_grammar_and_programs(self):
+        e = WireEncoder()
+        e.encodeGrammar(self.grammar)
+        for p in self.programs:
+            e.encodeProgram(p)
+        records = decode(e.getvalue())
+        self.assertEqual(records[0][1], self.grammar)
+        self.assertEqual(records[0][1].continuationType, self.grammar.continuationType)
+        self.assertEqual([p for _, p in records[1:]], self.programs)
+
+    def test_frontiers_share_subterms(self):
+        tasks = [Task("t%d" % i, self.request, []) for i in range(3)]
+        frontiers = [Frontier([FrontierEntry(p, logPrior=-float(j), logLikelihood=0.)
+                               for j, p in enumerate(self.programs[i::3])], task=t)
+                     for i, t in enumerate(tasks)]
+        data = encodeFrontiers(frontiers)
+        decoded = decodeFrontiers(data, tasks)
+        for f, g in zip(frontiers, decoded):
+            self.assertIs(f.task, g.task)
+            self.assertEqual([(e.program, e.logPrior, e.logPosterior) for e in f],
+                             [(e.program, e.logPrior, e.logPosterior) for e in g])
+
+    def test_shared_subterms_are_decoded_once(self):
+        task = Task("shared", self.request, [])
+        programs = [Program.parse("(lambda (map (lambda (+ $0 1)) $0))"),
+                    Program.parse("(lambda (cdr (map (lambda (+ $0 1)) $0)))")]
+        data = encodeFrontiers([Frontier([FrontierEntry(p, logPrior=0., logLikelihood=0.)
+                                          for p in programs], task=task)])
+        [f] = decodeFrontiers(data, [task])
+        first, second = [e.program for e in f]
+        self.assertEqual([first, second], programs)
+        self.assertIs(first.body, second.body.x)
+
+    def test_frontiers_are_matched_to_tasks_by_position(self):
+        tasks = [Task("same", self.request, []) for _ in range(2)]
+        frontiers = [Frontier([FrontierEntry(p, logPrior=0., logLikelihood=0.)], task=t)
+                     for p, t in zip(self.programs, tasks)]
+        decoded = decodeFrontiers(encodeFrontiers(frontiers), tasks)
+        for f, g, t in zip(frontiers, decoded, tasks):
+            self.assertIs(g.task, t)
+            self.assertEqual(g.bestPosterior.program, f.bestPosterior.program)
+        with self.assertRaises(WireFormatError):
+            decodeFrontiers(encodeFrontiers(frontiers), tasks[:1])
+
+    def test_examples(self):
+        task = Task("examples", arrow(tlist(tint), tint),
+                    [(([1, -2, 300000],), 7), (([],), None),
+                     (((True, "text", 1.5),), [[1], []])])
+        e = WireEncoder()
+        e.encodeExamples(task)
+        [(_, name, request, examples)] = decode(e.getvalue())
+        self.assertEqual((name, request, examples), (task.name, task.request, task.examples))
+
+    def test_streaming_and_errors(self):
+        e = WireEncoder()
+        for p in self.programs[:5]:
+            e.encodeProgram(p)
+        data = e.getvalue()
+        records = decodeStream(io.BytesIO(data))
+        self.assertEqual(next(records), ("program", self.programs[0]))
+        with self.assertRaises(WireFormatError):
+            decode(data[:3] + bytes([data[3] + 1]) + data[4:])
+        with self.assertRaises(WireFormatError):
+            decode(data[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()